@@ -0,0 +1,330 @@
+"""
+Hot path benchmarks, run with:
+    python benchmark.py [name ...]
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from rpi_ws import buffer, compression, framing, settings
+from rpi_ws.server import equation, store
+from rpi_ws.server.state import RPIStreamState
+
+REPEAT = 5
+
+
+class BenchProtocol(object):
+    debug = False
+    store = None
+
+    def __init__(self):
+        self.factory = self
+        self.sent_bytes = 0
+
+    def sendMessage(self, msg, binary=False):
+        self.sent_bytes += len(msg)
+
+
+class BenchClient(object):
+    def __init__(self, mac):
+        self.mac = mac
+        self.protocol = BenchProtocol()
+        self.framing = framing.FRAMING_JSON
+        self.inter_face = {}
+
+
+def report(name, number, seconds):
+    print '%-40s %10.1f us/op' % (name, min(seconds) / number * 1e6)
+
+
+def make_stream_states(rpis, channels, equations):
+    states = []
+    for i in range(rpis):
+        reads = {}
+        for port in range(channels):
+            key = 'cls:ADC, port:%d' % port
+            reads[key] = {'cls_name': 'ADC', 'ch_port': port, 'equations': list(equations)}
+        states.append(RPIStreamState(BenchClient('00:00:00:00:00:%02X' % i), reads, {}))
+    return states
+
+
+def bench_equations(rpis=4, channels=64):
+    """
+    Per value vs batched equation evaluation of one DATA frame from every RPI
+    """
+    equations = ['', 'x * 0.1 + 3', '(x - 32) / 1.8', 'sqrt(abs(x)) * 2']
+    states = make_stream_states(rpis, channels, equations)
+    frames = [dict(('cls:ADC, port:%d' % port, random.randint(0, 1023)) for port in range(channels))
+              for state in states]
+
+    def per_value():
+        for state, frame in zip(states, frames):
+            state.pending_reads.update(frame)
+            state.evaluate_pending()
+
+    batch = equation.EquationBatch()
+
+    def batched():
+        for state, frame in zip(states, frames):
+            state.pending_reads.update(frame)
+            state.evaluate_pending(batch)
+        batch.evaluate()
+        for state in states:
+            state.equations_evaluated()
+
+    # both paths have to agree
+    per_value()
+    expected = [dict(state.read_data_buffer_eq) for state in states]
+    batched()
+    assert expected == [state.read_data_buffer_eq for state in states]
+
+    number = 200
+    title = '%d rpis x %d channels x %d eqs' % (rpis, channels, len(equations))
+    report('equations per value, %s' % title, number, timeit.repeat(per_value, number=number, repeat=REPEAT))
+    report('equations batched, %s' % title, number, timeit.repeat(batched, number=number, repeat=REPEAT))
+
+
+def bench_update_dict(keys=5000):
+    """
+    One send cycle on an UpdateDict: refresh every key, check len() twice
+    and encode the changed keys
+    """
+    for changed in (0, 10, keys):
+        update_dict = buffer.UpdateDict()
+        values = dict(('cls:ADC, port:%d' % i, i) for i in range(keys))
+        for key, value in values.iteritems():
+            update_dict[key] = value
+        json.dumps(update_dict)
+        changed_keys = values.keys()[:changed]
+
+        def cycle():
+            for key in changed_keys:
+                values[key] += 1
+            for key, value in values.iteritems():
+                update_dict[key] = value
+            if len(update_dict) > 0 or len(update_dict) > 0:
+                json.dumps(update_dict)
+
+        def length():
+            len(update_dict)
+
+        number = 200
+        title = '%d keys, %d changed' % (keys, changed)
+        report('update dict cycle, %s' % title, number, timeit.repeat(cycle, number=number, repeat=REPEAT))
+        report('update dict len, %s' % title, number * 100,
+               timeit.repeat(length, number=number * 100, repeat=REPEAT))
+
+
+def bench_versioned_dict(keys=2000, users=100):
+    """
+    Per user catch-up after a few channels changed, changes since the
+    user's version vs copying every key into the user's UpdateDict
+    """
+    store = buffer.VersionedDict()
+    for i in range(keys):
+        store['cls:ADC, port:%d' % i] = i
+    changed_keys = store.keys()[:5]
+    copies = [buffer.UpdateDict(store) for i in range(users)]
+    for copy in copies:
+        json.dumps(copy)
+
+    def change():
+        for key in changed_keys:
+            store[key] += 1
+
+    def full_copy():
+        change()
+        for copy in copies:
+            for key, value in store.iteritems():
+                copy[key] = value
+            json.dumps(copy)
+
+    def versioned():
+        version = buffer.version_clock.version
+        change()
+        for i in range(users):
+            json.dumps(store.changed_since(version))
+
+    number = 20
+    title = '%d keys, %d users, %d changed' % (keys, users, len(changed_keys))
+    report('catch-up full copy, %s' % title, number, timeit.repeat(full_copy, number=number, repeat=REPEAT))
+    report('catch-up versioned, %s' % title, number, timeit.repeat(versioned, number=number, repeat=REPEAT))
+
+
+def bench_framing(analogue=32, digital=32):
+    """
+    One DATA frame with every channel changed, JSON vs binary,
+    bytes per frame and encode (RPI) / decode (server) time
+    """
+    reads = {}
+    values = {}
+    for port in range(analogue):
+        key = 'cls:MODIO_Analogue_Input, port:%d' % port
+        reads[key] = {'cls_name': 'MODIO_Analogue_Input', 'ch_port': port, 'equations': ['']}
+        values[key] = random.randint(0, 1023)
+    for port in range(digital):
+        key = 'cls:GPIO_Input, port:%d' % port
+        reads[key] = {'cls_name': 'GPIO_Input', 'ch_port': port, 'equations': ['']}
+        values[key] = random.randint(0, 1)
+    io_types = {'MODIO_Analogue_Input': framing.IO_TYPE_INTEGER, 'GPIO_Input': framing.IO_TYPE_BINARY}
+    codec = framing.DataFrameCodec.from_config(reads, {}, lambda key, io: io_types[io['cls_name']])
+
+    for changed in (4, analogue + digital):
+        frame_values = dict(values.items()[:changed])
+        msg = {'cmd': 'data', 'read': frame_values, 'write': {}}
+        text = json.dumps(msg)
+        frame = codec.encode(frame_values, {})
+        assert codec.decode(frame) == (frame_values, {}, None)
+
+        number = 2000
+        title = '%d/%d channels' % (changed, analogue + digital)
+        print '%-40s %10d bytes' % ('json frame, %s' % title, len(text))
+        print '%-40s %10d bytes' % ('binary frame, %s' % title, len(frame))
+        report('json encode, %s' % title, number,
+               timeit.repeat(lambda: json.dumps(msg), number=number, repeat=REPEAT))
+        report('binary encode, %s' % title, number,
+               timeit.repeat(lambda: codec.encode(frame_values, {}), number=number, repeat=REPEAT))
+        report('json decode, %s' % title, number,
+               timeit.repeat(lambda: json.loads(text), number=number, repeat=REPEAT))
+        report('binary decode, %s' % title, number,
+               timeit.repeat(lambda: codec.decode(frame), number=number, repeat=REPEAT))
+
+
+def bench_history(channels=5000, samples=100000):
+    """
+    Recording into the per channel history and building a backfill frame,
+    memory stays within the RPI's budget however many channels it has
+    """
+    history = buffer.ChannelHistory(range(channels))
+    items = [(channel, random.random()) for channel in range(channels)]
+
+    def record():
+        history.record(time.time(), items[:64])
+
+    for i in range(samples // 64):
+        history.record(i, random.sample(items, 64))
+    print '%-40s %10d bytes, %d samples/channel' % ('history %d channels' % channels,
+                                                     history.nbytes(), history.capacity)
+
+    number = 2000
+    report('history record, 64 channels', number, timeit.repeat(record, number=number, repeat=REPEAT))
+    report('history window, %d channels' % channels, 1,
+           timeit.repeat(lambda: history.window(0, range(channels)), number=1, repeat=REPEAT))
+
+
+def bench_store(samples=200000):
+    """
+    On-disk history of one channel: queueing from the reactor, writing and
+    sealing in the worker, scanning a range back and bytes per sealed sample
+    """
+    root = tempfile.mkdtemp()
+    try:
+        history_store = store.HistoryStore(root)
+        t0 = time.time()
+        value = 512
+        data = []
+        for i in range(samples):
+            value = max(0, min(1023, value + random.randint(-2, 2)))
+            data.append((t0 + i * 0.01, value))
+
+        start = time.time()
+        for i in range(0, samples, 64):
+            history_store.append('00:00:00:00:00:00', u'cls:ADC, port:0, eq:', data[i:i + 64])
+        queued = time.time() - start
+        history_store.close()
+        written = time.time() - start
+        report('store queue, 64 samples', samples // 64, [queued])
+        report('store queue + write + seal, 1 sample', samples, [written])
+
+        scan_range = (t0 + samples * 0.0025, t0 + samples * 0.0075)
+        timestamps, values = history_store.range('00:00:00:00:00:00', u'cls:ADC, port:0, eq:', *scan_range)
+        assert len(timestamps) == samples // 2 + 1
+        report('store range scan, %d samples' % len(timestamps), 1,
+               timeit.repeat(lambda: history_store.range('00:00:00:00:00:00', u'cls:ADC, port:0, eq:', *scan_range),
+                             number=1, repeat=REPEAT))
+        history_store.close()
+
+        path = history_store.channel_path('00:00:00:00:00:00', u'cls:ADC, port:0, eq:')
+        sealed = [os.path.join(path, name) for name in os.listdir(path) if name.endswith('.seg')]
+        sealed_samples = len(sealed) * settings.STORE_SEGMENT_SAMPLES
+        print '%-40s %10.2f bytes' % ('store sealed, 1 sample', sum(map(os.path.getsize, sealed)) / float(sealed_samples))
+    finally:
+        shutil.rmtree(root)
+
+
+def record_traffic(frames=1000, analogue=16, digital=16):
+    """
+    DATA frames of a streaming RPI as the server receives them, analogue
+    channels drift, digital ones flip now and then, each frame carries what changed
+    """
+    values = {}
+    for port in range(analogue):
+        values['cls:MODIO_Analogue_Input, port:%d' % port] = random.randint(0, 1023)
+    for port in range(digital):
+        values['cls:GPIO_Input, port:%d' % port] = random.randint(0, 1)
+
+    traffic = []
+    for i in range(frames):
+        changed = {}
+        for key, value in values.iteritems():
+            if key.startswith('cls:GPIO'):
+                if random.random() < 0.05:
+                    changed[key] = values[key] = 1 - value
+            elif random.random() < 0.5:
+                changed[key] = values[key] = max(0, min(1023, value + random.randint(-3, 3)))
+        traffic.append(json.dumps({'cmd': 'data', 'read': changed, 'write': {}}))
+    return traffic
+
+
+def bench_compression(frames=1000):
+    """
+    Deflate of a recorded DATA stream per compression option, bytes on the
+    wire vs compression time per message
+    """
+    traffic = record_traffic(frames)
+    raw = sum(len(msg) for msg in traffic)
+    print '%-40s %10d bytes, %d msgs' % ('uncompressed', raw, len(traffic))
+
+    for level in (1, 6, 9):
+        for context_takeover in (True, False):
+            options = compression.CompressionOptions(level, context_takeover, min_size=64)
+            compressor = compression.MessageCompressor(options)
+            decompressor = compression.MessageDecompressor()
+            sent = [compressor.compress(msg) for msg in traffic]
+            assert [decompressor.decompress(payload)[0] if binary else payload
+                    for payload, binary in sent] == traffic
+            wire = sum(len(payload) for payload, binary in sent)
+
+            def run():
+                compressor = compression.MessageCompressor(options)
+                for msg in traffic:
+                    compressor.compress(msg)
+
+            title = 'level %d, %s' % (level, 'context takeover' if context_takeover else 'no context')
+            print '%-40s %10d bytes, %.0f%% saved' % ('deflate %s' % title, wire, 100.0 * (raw - wire) / raw)
+            report('deflate %s' % title, len(traffic), timeit.repeat(run, number=1, repeat=REPEAT))
+
+
+BENCHMARKS = {
+    'compression': bench_compression,
+    'equations': bench_equations,
+    'framing': bench_framing,
+    'history': bench_history,
+    'store': bench_store,
+    'update_dict': bench_update_dict,
+    'versioned_dict': bench_versioned_dict,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
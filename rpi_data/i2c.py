@@ -0,0 +1,190 @@
+__author__ = 'kenny'
+
+import heapq
+import itertools
+import threading
+from time import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+import smbus
+
+
+class I2CTransaction(object):
+    def __init__(self, priority, address, method, args):
+        self.priority = priority
+        self.address = address
+        self.method = method
+        self.args = args
+        self.queued = time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        # called from the bus worker once done, see I2CBus.submit
+        self.on_done = None
+
+
+class I2CBus(object):
+    """
+    Owns one SMBus, transactions are queued and run one at a time by a single worker thread.
+    Writes go ahead of reads, a device is left alone for its minimum gap after each
+    transaction while transactions for other devices carry on.
+    """
+    PRIORITY_WRITE = 0
+    PRIORITY_READ = 1
+
+    def __init__(self, bus_number, bus=None):
+        self.bus_number = bus_number
+        self.bus = bus if bus is not None else smbus.SMBus(bus_number)
+
+        self.condition = threading.Condition()
+        # (priority, sequence, transaction)
+        self.queue = []
+        self.sequence = itertools.count()
+        # address: seconds
+        self.min_gaps = {}
+        # address: end time of its last transaction
+        self.last_transaction = {}
+        self.worker = None
+        self.running = False
+
+        # stats, latency is queued to done
+        self.transactions = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def set_min_gap(self, address, seconds):
+        with self.condition:
+            self.min_gaps[address] = seconds
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.worker = threading.Thread(target=self.run, name='i2c-%d' % self.bus_number)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def queue_transaction(self, priority, address, method, args, on_done=None):
+        self.start()
+        transaction = I2CTransaction(priority, address, method, args)
+        transaction.on_done = on_done
+        with self.condition:
+            heapq.heappush(self.queue, (priority, next(self.sequence), transaction))
+            self.condition.notify()
+        return transaction
+
+    def call(self, priority, address, method, *args):
+        """
+        Queues smbus method(address, *args) and waits for its result,
+        not for use in the reactor thread
+        """
+        transaction = self.queue_transaction(priority, address, method, args)
+        transaction.done.wait()
+        if transaction.error is not None:
+            raise transaction.error
+        return transaction.result
+
+    def submit(self, priority, address, method, *args):
+        """
+        Queues smbus method(address, *args), returns a Deferred firing with its result
+        """
+        d = defer.Deferred()
+
+        def done(transaction):
+            if transaction.error is not None:
+                reactor.callFromThread(d.errback, transaction.error)
+            else:
+                reactor.callFromThread(d.callback, transaction.result)
+
+        self.queue_transaction(priority, address, method, args, done)
+        return d
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def stats(self):
+        with self.condition:
+            return {'queue_depth': len(self.queue),
+                    'transactions': self.transactions,
+                    'errors': self.errors,
+                    'latency_avg': self.latency_total / self.transactions if self.transactions else 0.0,
+                    'latency_max': self.latency_max}
+
+    def next_transaction(self):
+        """
+        Called with the condition held, waits for the highest priority
+        transaction whose device is past its gap. None once stopped.
+        """
+        while self.running:
+            now = time()
+            wait = None
+            for entry in sorted(self.queue):
+                transaction = entry[2]
+                ready_at = self.last_transaction.get(transaction.address, 0) + \
+                    self.min_gaps.get(transaction.address, 0)
+                if ready_at <= now:
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+                    return transaction
+                if wait is None or ready_at - now < wait:
+                    wait = ready_at - now
+            self.condition.wait(wait)
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                transaction = self.next_transaction()
+            if transaction is None:
+                return
+
+            try:
+                transaction.result = getattr(self.bus, transaction.method)(transaction.address, *transaction.args)
+            except Exception, e:
+                transaction.error = e
+
+            with self.condition:
+                done_time = time()
+                self.last_transaction[transaction.address] = done_time
+                latency = done_time - transaction.queued
+                self.transactions += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                if transaction.error is not None:
+                    self.errors += 1
+
+            transaction.done.set()
+            if transaction.on_done is not None:
+                try:
+                    transaction.on_done(transaction)
+                except Exception, e:
+                    log.err('I2CBus.run - %s' % e)
+
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+def get_bus(bus_number):
+    with _buses_lock:
+        if bus_number not in _buses:
+            _buses[bus_number] = I2CBus(bus_number)
+        return _buses[bus_number]
+
+
+def bus_stats():
+    """
+    Returns {bus number: I2CBus.stats()} of every bus in use, sent with the RPI's STATS reports
+    """
+    with _buses_lock:
+        buses = _buses.items()
+    return dict((str(bus_number), bus.stats()) for bus_number, bus in buses)
@@ -1,11 +1,16 @@
 # SPI adc by blaisejarrett
 #from RPiBJ import SPIADC
 # GPIO: http://code.google.com/p/raspberry-gpio-python/
-from glob import glob
-from time import sleep, time
-
+from time import time
 from RPi import GPIO
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 import mod_io
+import one_wire
+
+# threads available for blocking hardware access, see IRead.read_async
+HARDWARE_THREADS = 4
 
 
 class CHPortInUseException(Exception):
@@ -16,6 +21,54 @@ class CHPortDoesntExistException(Exception):
     pass
 
 
+class HardwareTimeoutException(Exception):
+    pass
+
+
+class HardwareBusyException(Exception):
+    pass
+
+
+_hardware_pool = None
+
+
+def get_hardware_pool():
+    """
+    Bounded thread pool dedicated to hardware access, started on first use
+    """
+    global _hardware_pool
+    if _hardware_pool is None:
+        _hardware_pool = ThreadPool(minthreads=0, maxthreads=HARDWARE_THREADS, name='hardware')
+        _hardware_pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', _hardware_pool.stop)
+    return _hardware_pool
+
+
+def timeout_deferred(d, timeout, desc):
+    """
+    Returns a Deferred firing with the result of d, or failing with
+    HardwareTimeoutException if d hasn't fired after timeout seconds
+    """
+    result = defer.Deferred()
+
+    def timed_out():
+        result.errback(HardwareTimeoutException('%s timed out after %ss' % (desc, timeout)))
+
+    timeout_call = reactor.callLater(timeout, timed_out)
+
+    def done(value):
+        if timeout_call.active():
+            timeout_call.cancel()
+            if isinstance(value, failure.Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+        # else: too late, the caller moved on
+
+    d.addBoth(done)
+    return result
+
+
 class IBase(object):
     IO_TYPE_BINARY = 'B'
     IO_TYPE_INTEGER = 'I'
@@ -30,8 +83,24 @@ class IBase(object):
     ALLOW_DUPLICATE_PORTS = False
     channels_in_use = {}
 
+    # default seconds between samples, CONFIG can set 'sample_period' per channel
+    SAMPLE_PERIOD = 0.1
+
+    # override with False if read/write return without waiting on hardware,
+    # read_async/write_async then call them directly instead of in the hardware thread pool
+    BLOCKING_READ = True
+    BLOCKING_WRITE = True
+    # seconds before an asynchronous read/write is given up on
+    IO_TIMEOUT = 2
+    # True if start_edges is implemented, changes are then pushed instead of polled
+    EDGE_DETECT = False
+
     def __init__(self, ch_port):
         self.ch_port = ch_port
+        # asynchronous read still running in the hardware thread pool
+        self.read_in_progress = False
+        # keeps asynchronous writes in order
+        self.write_lock = defer.DeferredLock()
 
         port_exists = False
         for existing_port, existing_port_name in self.IO_CHOICES:
@@ -69,6 +138,29 @@ class IBase(object):
         """
         return cls(*args, **kwargs)
 
+    def read_async(self):
+        """
+        Non blocking read, returns a Deferred firing with read()
+        Fails with HardwareBusyException while a previous read is still running,
+        a hung read therefore never occupies more then one thread.
+        """
+        if self.read_in_progress:
+            return defer.fail(HardwareBusyException('%s %s read in progress' %
+                                                    (self.__class__.__name__, self.ch_port)))
+
+        if not self.BLOCKING_READ:
+            return defer.maybeDeferred(self.read)
+
+        self.read_in_progress = True
+        d = threads.deferToThreadPool(reactor, get_hardware_pool(), self.read)
+
+        def done(result):
+            self.read_in_progress = False
+            return result
+
+        d.addBoth(done)
+        return timeout_deferred(d, self.IO_TIMEOUT, '%s %s read' % (self.__class__.__name__, self.ch_port))
+
 
 class IRead(IBase):
     """
@@ -98,6 +190,9 @@ class IWrite(IBase):
     """
     # this is the default value assumed when no data has been written
     DEFAULT_VALUE = None
+    # read only returns the last written value, writes are sent right away
+    BLOCKING_READ = False
+    SAMPLE_PERIOD = 1
 
     def __init__(self, ch_port):
         super(IWrite, self).__init__(ch_port)
@@ -113,6 +208,17 @@ class IWrite(IBase):
     def write(self, value):
         self.last_written_value = value
 
+    def write_async(self, value):
+        """
+        Non blocking write, returns a Deferred firing once value is written
+        Writes are done one after the other in the order they were made.
+        """
+        if not self.BLOCKING_WRITE:
+            return defer.maybeDeferred(self.write, value)
+
+        d = self.write_lock.run(threads.deferToThreadPool, reactor, get_hardware_pool(), self.write, value)
+        return timeout_deferred(d, self.IO_TIMEOUT, '%s %s write' % (self.__class__.__name__, self.ch_port))
+
 
 # SPIADC.setup(0, 100000)
 #
@@ -145,17 +251,19 @@ class IWrite(IBase):
 #     def read(self):
 #         return SPIADC.read(self.ch_port)
 
-def temperature_io_choices():
-    base_dir = '/sys/bus/w1/devices/'
+def temperature_io_choices(base_dir=one_wire.W1_BASE_DIR):
     io_choices = (())
 
-    for device_folder in glob(base_dir + '28*'):
-        device_file = device_folder + '/w1_slave'
+    for device_file in one_wire.find_devices(base_dir):
         io_choices += ((device_file, device_file),)
 
     return io_choices
 
 
+# background acquisition of every 1-Wire temperature sensor
+one_wire_service = one_wire.OneWireService(update_time=5, pool=get_hardware_pool)
+
+
 class Temperature(IRead):
     """
         Temperature
@@ -164,54 +272,30 @@ class Temperature(IRead):
     IO_TYPE = IBase.IO_TYPE_INTEGER
     channels_in_use = {}
     IO_CHOICES = temperature_io_choices()
+    # the sensor is only re-read every one_wire_service.update_time anyway
+    SAMPLE_PERIOD = 5
+    # reads are cache lookups, one_wire_service talks to the bus
+    BLOCKING_READ = False
 
     def __init__(self, ch_port):
         self.temp_value = 0
-        self.update_time_min = 5
-        self.set_update_time()
+        # time of the last conversion of temp_value, None before the first
+        self.timestamp = None
         super(Temperature, self).__init__(ch_port)
+        one_wire_service.start()
+
+    def close(self):
+        one_wire_service.stop()
+        super(Temperature, self).close()
 
     def read(self):
-        if self.can_update():
-            self.temp_value = self.read_temp(self.ch_port)
-            self.set_update_time()
+        value, timestamp = one_wire_service.get(self.ch_port)
+        if value is not None:
+            self.temp_value = value
+            self.timestamp = timestamp
 
         return self.temp_value
 
-    def read_temp_raw(self, device_file):
-        f = open(device_file, 'r')
-        lines = f.readlines()
-        f.close()
-        return lines
-
-    def read_temp(self, device_file):
-        temp_raw = self.read_temp_raw(device_file)
-
-        count_max_wile = 0
-        while temp_raw[0].strip()[-3:] != 'YES' and temp_raw[1].find('t=') != -1:
-            sleep(0.6)
-            temp_raw = self.read_temp_raw(device_file)
-            count_max_wile += 1
-            if count_max_wile > 2:
-                raise
-
-        temp_string = temp_raw[1][temp_raw[1].find('t=') + 2:]
-        temp_string = temp_string.replace("\n", "").replace(" ", "")
-        return int(temp_string)
-
-    def get_time(self):
-        return time()
-
-    def can_update(self):
-        if (self.get_time() - self.update_time) > self.update_time_min:
-            return True
-        else:
-            sleep(0.03)
-            return False
-
-    def set_update_time(self):
-        self.update_time = self.get_time()
-
 
 class MODIO_Digital_Input(IRead):
     """
@@ -227,6 +311,8 @@ class MODIO_Digital_Input(IRead):
     )
 
     channels_in_use = {}
+    # matches mod_io.MOD_IO_Device.update_time_min
+    SAMPLE_PERIOD = 0.4
 
     def read(self):
         ch_port = int(self.ch_port)
@@ -247,6 +333,8 @@ class MODIO_Analogue_Input(IRead):
     )
 
     channels_in_use = {}
+    # matches mod_io.MOD_IO_Device.update_time_min
+    SAMPLE_PERIOD = 0.4
 
     def read(self):
         ch_port = int(self.ch_port)
@@ -266,6 +354,8 @@ class MODIO_Relay_Input(IRead):
     )
 
     channels_in_use = {}
+    # relay state only changes on writes
+    SAMPLE_PERIOD = 0.4
 
     def read(self):
         ch_port = int(self.ch_port)
@@ -293,6 +383,73 @@ class MODIO_Relay_Output(IWrite):
 
 GPIO.setmode(GPIO.BCM)
 
+GPIO_EDGES = {
+    'rising': GPIO.RISING,
+    'falling': GPIO.FALLING,
+    'both': GPIO.BOTH,
+}
+
+# value the pin reads after an edge, None for either
+EDGE_VALUES = {
+    'rising': 1,
+    'falling': 0,
+    'both': None,
+}
+
+# pin: {'edge': detected edge, 'debounce': ms, 'callbacks': [(callback, edge value), ...]}
+# RPi.GPIO allows one event detection per pin, every listener of a pin shares it
+_edge_callbacks = {}
+
+
+def _detect(pin, edge, debounce):
+    kwargs = {}
+    if debounce:
+        kwargs['bouncetime'] = int(debounce)
+    GPIO.add_event_detect(pin, GPIO_EDGES[edge], callback=_dispatch_edge, **kwargs)
+
+
+def add_edge_callback(pin, callback, edge='both', debounce=None):
+    """
+    callback(value, timestamp) is called from the RPi.GPIO event thread on every edge of kind edge.
+    The pin detects both edges once its listeners want different ones, debounce (ms) is set by the first.
+    """
+    listeners = _edge_callbacks.get(pin)
+    if listeners is None:
+        GPIO.setup(pin, GPIO.IN)
+        _detect(pin, edge, debounce)
+        listeners = _edge_callbacks[pin] = {'edge': edge, 'debounce': debounce, 'callbacks': []}
+    elif listeners['edge'] not in (edge, 'both'):
+        GPIO.remove_event_detect(pin)
+        _detect(pin, 'both', listeners['debounce'])
+        listeners['edge'] = 'both'
+    listeners['callbacks'].append((callback, EDGE_VALUES[edge]))
+
+
+def remove_edge_callback(pin, callback):
+    listeners = _edge_callbacks.get(pin)
+    if listeners is None:
+        return
+    for listener in listeners['callbacks']:
+        if listener[0] == callback:
+            listeners['callbacks'].remove(listener)
+            break
+    if not listeners['callbacks']:
+        GPIO.remove_event_detect(pin)
+        del _edge_callbacks[pin]
+
+
+def _dispatch_edge(pin):
+    timestamp = time()
+    value = GPIO.input(pin)
+    listeners = _edge_callbacks.get(pin)
+    if listeners is None:
+        return
+    # a pin detecting one kind of edge only has listeners of that kind
+    both = listeners['edge'] == 'both'
+    for callback, edge_value in list(listeners['callbacks']):
+        if not both or edge_value is None or edge_value == value:
+            callback(value, timestamp)
+
 
 class GPIO_Input(IRead):
     """
@@ -320,10 +477,14 @@ class GPIO_Input(IRead):
     )
 
     ports_in_use = {}
+    SAMPLE_PERIOD = 0.02
+    BLOCKING_READ = False
+    EDGE_DETECT = True
 
     def __init__(self, ch_port):
         super(GPIO_Input, self).__init__(ch_port)
         GPIO.setup(ch_port, GPIO.IN)
+        self.edge_callback = None
 
     def read(self):
         """
@@ -331,6 +492,96 @@ class GPIO_Input(IRead):
         """
         return GPIO.input(self.ch_port)
 
+    def start_edges(self, callback, edge='both', debounce=None):
+        """
+        Edge mode, callback(value, timestamp) is called in the reactor thread on every edge
+        """
+        self.stop_edges()
+        self.edge_callback = callback
+        add_edge_callback(self.ch_port, self.edge, edge, debounce)
+
+    def stop_edges(self):
+        if self.edge_callback is not None:
+            remove_edge_callback(self.ch_port, self.edge)
+            self.edge_callback = None
+
+    def edge(self, value, timestamp):
+        reactor.callFromThread(self.edge_callback, value, timestamp)
+
+    def close(self):
+        self.stop_edges()
+        super(GPIO_Input, self).close()
+
+
+class GPIO_Edge_Counter(IRead):
+    """
+    Counts rising edges on a GPIO
+    """
+    IO_TYPE = IBase.IO_TYPE_INTEGER
+    IO_CHOICES = GPIO_Input.IO_CHOICES
+
+    channels_in_use = {}
+    SAMPLE_PERIOD = 1
+    BLOCKING_READ = False
+    EDGE = 'rising'
+    # ms, None to count every edge
+    DEBOUNCE = None
+
+    def __init__(self, ch_port):
+        super(GPIO_Edge_Counter, self).__init__(ch_port)
+        # only the RPi.GPIO event thread writes count
+        self.count = 0
+        add_edge_callback(ch_port, self.edge, self.EDGE, self.DEBOUNCE)
+
+    def edge(self, value, timestamp):
+        self.count += 1
+
+    def read(self):
+        return self.count
+
+    def close(self):
+        remove_edge_callback(self.ch_port, self.edge)
+        super(GPIO_Edge_Counter, self).close()
+
+
+class GPIO_Edge_Frequency(IRead):
+    """
+    Rising edges per second on a GPIO, averaged since the previous sample
+    """
+    IO_TYPE = IBase.IO_TYPE_INTEGER
+    IO_CHOICES = GPIO_Input.IO_CHOICES
+
+    channels_in_use = {}
+    SAMPLE_PERIOD = 1
+    BLOCKING_READ = False
+    EDGE = 'rising'
+    DEBOUNCE = None
+
+    def __init__(self, ch_port):
+        super(GPIO_Edge_Frequency, self).__init__(ch_port)
+        self.count = 0
+        self.last_count = 0
+        self.last_time = time()
+        add_edge_callback(ch_port, self.edge, self.EDGE, self.DEBOUNCE)
+
+    def edge(self, value, timestamp):
+        self.count += 1
+
+    def read(self):
+        now = time()
+        count = self.count
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return 0.0
+        frequency = (count - self.last_count) / elapsed
+        self.last_count = count
+        self.last_time = now
+        return frequency
+
+    def close(self):
+        remove_edge_callback(self.ch_port, self.edge)
+        super(GPIO_Edge_Frequency, self).close()
+
 
 class GPIO_Output(IWrite):
     """
@@ -357,6 +608,7 @@ class GPIO_Output(IWrite):
         (27, 'GPIO27 P13'),
     )
     DEFAULT_VALUE = False
+    BLOCKING_WRITE = False
 
     def __init__(self, ch_port):
         super(GPIO_Output, self).__init__(ch_port)
@@ -1,8 +1,86 @@
 __author__ = 'kenny'
 
-from time import sleep, time
+from threading import RLock
+from time import time
 from twisted.python import log
-import smbus
+
+import i2c
+
+
+class MOD_IO_Device(object):
+    """
+    One MOD-IO board on the I2C bus, shared by every MOD_IO view of the same address.
+    All inputs are read in one sweep, the snapshot is reused for update_time_min.
+    Transactions go through the bus worker, which keeps min_gap between them.
+    """
+    REG_RELAYS = 0x10
+    REG_DIGITAL_INPUTS = 0x20
+    REG_ANALOGUE_INPUTS = 0x30
+
+    def __init__(self, address, bus_number=1, analogue_ports=4, bus=None, block_read=False):
+        self.address = address
+        self.analogue_ports = analogue_ports
+
+        self.bus = bus if bus is not None else i2c.get_bus(bus_number)
+        # minimum gap between two transactions
+        self.min_gap = 0.02
+        self.bus.set_min_gap(self.address, self.min_gap)
+
+        # refresh can come from several hardware threads, only one of them reads
+        self.lock = RLock()
+        self.update_time_min = 0.4
+        # MOD-IO firmware answers one command per transaction and is not known to
+        # auto-increment the register, a block read from 0x30 may return garbage for
+        # channels 2-4 without any error. Only set for firmware confirmed to
+        # auto-increment, cleared if it doesn't answer block reads at all.
+        self.block_read = block_read
+
+        self.update_time = None
+        self.digital_inputs = 0
+        self.analogue_inputs = [0] * self.analogue_ports
+
+    def get_time(self):
+        return time()
+
+    def read(self, method, *args):
+        return self.bus.call(i2c.I2CBus.PRIORITY_READ, self.address, method, *args)
+
+    def refresh(self):
+        """
+        Reads every input unless the snapshot is younger then update_time_min
+        """
+        with self.lock:
+            if self.update_time is not None and (self.get_time() - self.update_time) <= self.update_time_min:
+                return
+            self.analogue_inputs = self.read_analogue_inputs()
+            self.digital_inputs = int(self.read('read_byte_data', self.REG_DIGITAL_INPUTS))
+            self.update_time = self.get_time()
+
+    def read_analogue_inputs(self):
+        if self.block_read:
+            try:
+                # every channel is a little endian word, one after the other
+                data = self.read('read_i2c_block_data', self.REG_ANALOGUE_INPUTS, 2 * self.analogue_ports)
+                return [data[2 * i] | (data[2 * i + 1] << 8) for i in range(self.analogue_ports)]
+            except (IOError, IndexError), e:
+                log.msg("%s - block read unsupported at 0x%x, reading channels one by one %s" %
+                        (self.__class__.__name__, self.address, e))
+                self.block_read = False
+
+        return [self.read('read_word_data', self.REG_ANALOGUE_INPUTS + i) for i in range(self.analogue_ports)]
+
+    def write_relays(self, state):
+        # relays go ahead of any queued input reads
+        self.bus.call(i2c.I2CBus.PRIORITY_WRITE, self.address, 'write_byte_data', self.REG_RELAYS, state)
+
+
+_devices = {}
+
+
+def get_device(address):
+    if address not in _devices:
+        _devices[address] = MOD_IO_Device(address)
+    return _devices[address]
 
 
 class MOD_IO(object):
@@ -10,11 +88,7 @@ class MOD_IO(object):
         self.address = address
         self.number_of_ports = number_of_ports
 
-        self.bus = smbus.SMBus(1)
-
-        self.update_time_min = 0.4
-        self.sleep_time = 0.02
-        self.set_update_time()
+        self.device = get_device(address)
 
         self.ports_state = [0 for x in range(self.number_of_ports)]
 
@@ -39,20 +113,6 @@ class MOD_IO(object):
     def set_state(self, port_number, port_state):
         pass
 
-    def get_time(self):
-        return time()
-
-    def can_update(self):
-        if (self.get_time() - self.update_time) > self.update_time_min:
-            return True
-        else:
-            sleep(0.001)
-            return False
-
-    def set_update_time(self):
-        self.update_time = self.get_time()
-
-
 
 class MOD_IO_Relay(MOD_IO):
     def __init__(self, address, number_of_ports=4):
@@ -60,9 +120,8 @@ class MOD_IO_Relay(MOD_IO):
         #self.write()
 
     def write(self):
-        sleep(self.sleep_time)
         state_boll = int("0000" + "".join(str(x) for x in self.ports_state), 2)
-        self.bus.write_byte_data(self.address, 0x10, state_boll)
+        self.device.write_relays(state_boll)
 
     def set_state(self, port_number, port_state):
         port_number = int(port_number)
@@ -72,8 +131,9 @@ class MOD_IO_Relay(MOD_IO):
         elif port_state == self.ports_state[port_number]:
             return 2
         else:
-            self.ports_state[port_number] = port_state
-            self.write()
+            with self.device.lock:
+                self.ports_state[port_number] = port_state
+                self.write()
             return 1
 
 
@@ -86,12 +146,10 @@ class MOD_IO_DigitalInput(MOD_IO):
         self.ports_state = "0" * self.number_of_ports
 
     def read(self):
-        if self.can_update():
-            sleep(self.sleep_time)
-            input_state = "{0:b}".format(int(self.bus.read_byte_data(self.address, 0x20)))
-            add_zero = self.number_of_ports - len(input_state)
-            self.ports_state = "%s%s" % ("0" * add_zero, input_state)
-            self.set_update_time()
+        self.device.refresh()
+        input_state = "{0:b}".format(self.device.digital_inputs)
+        add_zero = self.number_of_ports - len(input_state)
+        self.ports_state = "%s%s" % ("0" * add_zero, input_state)
 
 
 MOD_IO_DIGITAL_INPUT = MOD_IO_DigitalInput(0x58)
@@ -100,17 +158,10 @@ MOD_IO_DIGITAL_INPUT = MOD_IO_DigitalInput(0x58)
 class MOD_IO_AnalogueInput(MOD_IO):
     def __init__(self, address, number_of_ports=4):
         super(MOD_IO_AnalogueInput, self).__init__(address, number_of_ports)
-        # save time regenerating range
-        self.number_range = range(self.number_of_ports)
 
     def read(self):
-        if self.can_update():
-            for i in self.number_range:
-                sleep(self.sleep_time)
-                self.ports_state[i] = self.bus.read_word_data(self.address, 0x30 + i)
-
-            #print " self.ports_state ", self.ports_state
-            self.set_update_time()
+        self.device.refresh()
+        self.ports_state = self.device.analogue_inputs
 
 
 MOD_IO_Analogue_INPUT = MOD_IO_AnalogueInput(0x58)
@@ -0,0 +1,180 @@
+__author__ = 'kenny'
+
+import os
+from glob import glob
+from time import sleep, time
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
+
+W1_BASE_DIR = '/sys/bus/w1/devices/'
+# DS18B20 family code
+TEMPERATURE_FAMILY = '28'
+# a 12 bit conversion takes up to 750ms
+CONVERSION_TIME = 0.75
+CRC_RETRIES = 2
+CRC_RETRY_SLEEP = 0.6
+
+
+class OneWireReadException(Exception):
+    pass
+
+
+def find_devices(base_dir=W1_BASE_DIR, family=TEMPERATURE_FAMILY):
+    """
+    Returns list of w1_slave files of every device of family on every bus
+    """
+    return [os.path.join(device_folder, 'w1_slave')
+            for device_folder in sorted(glob(os.path.join(base_dir, family + '*')))]
+
+
+def find_bulk_masters(base_dir=W1_BASE_DIR):
+    """
+    Returns list of therm_bulk_read files, bus masters that can start
+    a conversion on every sensor at once
+    """
+    return sorted(glob(os.path.join(base_dir, 'w1_bus_master*', 'therm_bulk_read')))
+
+
+def parse_w1_slave(lines):
+    """
+    w1_slave looks like:
+        72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        72 01 4b 46 7f ff 0e 10 57 t=23125
+    Returns temperature in thousandths of a degree, None if the CRC check failed
+    """
+    if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+        return None
+    position = lines[1].find('t=')
+    if position == -1:
+        return None
+    return int(lines[1][position + 2:].strip())
+
+
+def read_device(device_file):
+    """
+    Blocking read of one sensor, retries on CRC errors
+    """
+    for attempt in range(CRC_RETRIES + 1):
+        if attempt:
+            sleep(CRC_RETRY_SLEEP)
+        with open(device_file, 'r') as f:
+            value = parse_w1_slave(f.readlines())
+        if value is not None:
+            return value
+    raise OneWireReadException('%s failed the CRC check %d times' % (device_file, CRC_RETRIES + 1))
+
+
+class OneWireService(object):
+    """
+    Keeps the latest temperature of every 1-Wire sensor in a cache.
+    Sweeps run in the background every update_time seconds, conversions start
+    on every sensor at once through therm_bulk_read when the kernel supports it,
+    otherwise sensors are read in parallel.
+    """
+
+    def __init__(self, base_dir=W1_BASE_DIR, update_time=5, pool=None, clock=reactor):
+        self.base_dir = base_dir
+        self.update_time = update_time
+        # callable returning the thread pool used for blocking reads
+        self.pool = pool
+        self.clock = clock
+        # device file: (value, timestamp)
+        self.cache = {}
+        self.users = 0
+        self.sweeping = False
+        self.loop = None
+
+    def get(self, device_file):
+        """
+        Returns (value, timestamp) of the last successful read, (None, None) before that
+        """
+        return self.cache.get(device_file, (None, None))
+
+    def start(self):
+        """
+        Called once per user, sweeping starts with the first
+        """
+        self.users += 1
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.sweep)
+            self.loop.clock = self.clock
+            self.loop.start(self.update_time, now=True)
+
+    def stop(self):
+        """
+        Called once per user, sweeping stops with the last
+        """
+        self.users = max(0, self.users - 1)
+        if self.users == 0 and self.loop is not None:
+            if self.loop.running:
+                self.loop.stop()
+            self.loop = None
+
+    def _defer(self, func, *args):
+        if self.pool is None:
+            return threads.deferToThread(func, *args)
+        return threads.deferToThreadPool(reactor, self.pool(), func, *args)
+
+    def sweep(self):
+        if self.sweeping:
+            # last sweep still waiting on the bus
+            return
+        devices = find_devices(self.base_dir)
+        if not devices:
+            return
+        self.sweeping = True
+
+        masters = find_bulk_masters(self.base_dir)
+        if masters:
+            d = self._defer(self.read_bulk, masters, devices)
+        else:
+            reads = [self._defer(self.read_one, device_file) for device_file in devices]
+            d = defer.gatherResults(reads)
+
+        d.addCallback(self.store)
+        d.addErrback(lambda failure: log.err(failure, 'OneWireService.sweep failed'))
+        d.addBoth(self.sweep_done)
+        return d
+
+    def sweep_done(self, ignored):
+        self.sweeping = False
+
+    def read_bulk(self, masters, devices):
+        """
+        Blocking, one conversion for every sensor then read them all
+        """
+        for master in masters:
+            with open(master, 'w') as f:
+                f.write('trigger\n')
+
+        # therm_bulk_read reads -1 while a conversion is running
+        deadline = time() + CONVERSION_TIME * 2
+        pending = list(masters)
+        while pending and time() < deadline:
+            sleep(0.05)
+            pending = [master for master in pending if self._bulk_converting(master)]
+
+        return [self.read_one(device_file) for device_file in devices]
+
+    @staticmethod
+    def _bulk_converting(master):
+        with open(master, 'r') as f:
+            return f.read().strip() == '-1'
+
+    @staticmethod
+    def read_one(device_file):
+        """
+        Returns (device file, value), value is None if the read failed
+        """
+        try:
+            return device_file, read_device(device_file)
+        except (IOError, OneWireReadException, ValueError), e:
+            log.msg('OneWireService - %s' % e)
+            return device_file, None
+
+    def store(self, results):
+        timestamp = time()
+        for device_file, value in results:
+            if value is not None:
+                self.cache[device_file] = (value, timestamp)
@@ -0,0 +1,146 @@
+"""
+1-Wire reads against a fake sysfs tree, run with:
+    trial rpi_data.test
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from rpi_data import one_wire
+
+__author__ = 'kenny'
+
+GOOD = ('72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+        '72 01 4b 46 7f ff 0e 10 57 t=23125\n')
+BAD_CRC = ('72 01 4b 46 7f ff 0e 10 57 : crc=00 NO\n'
+           '72 01 4b 46 7f ff 0e 10 57 t=85000\n')
+
+
+class FakeW1Tree(object):
+    """
+    Temporary /sys/bus/w1/devices/ lookalike
+    """
+
+    def __init__(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def add_device(self, name, contents=GOOD):
+        os.mkdir(os.path.join(self.base_dir, name))
+        device_file = os.path.join(self.base_dir, name, 'w1_slave')
+        self.write(device_file, contents)
+        return device_file
+
+    def add_bulk_master(self, name='w1_bus_master1'):
+        os.mkdir(os.path.join(self.base_dir, name))
+        master = os.path.join(self.base_dir, name, 'therm_bulk_read')
+        self.write(master, '1\n')
+        return master
+
+    @staticmethod
+    def write(path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def remove(self):
+        shutil.rmtree(self.base_dir)
+
+
+class ReadDeviceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = FakeW1Tree()
+        self.addCleanup(self.tree.remove)
+        self.patch(one_wire, 'sleep', lambda seconds: None)
+
+    def test_find_devices(self):
+        first = self.tree.add_device('28-000004b1c2d3')
+        second = self.tree.add_device('28-000004b1c2d4')
+        # other families and the bus master are left out
+        self.tree.add_device('10-000801e2a5f3')
+        self.tree.add_bulk_master()
+        self.assertEqual(one_wire.find_devices(self.tree.base_dir), [first, second])
+
+    def test_read(self):
+        device_file = self.tree.add_device('28-000004b1c2d3')
+        self.assertEqual(one_wire.read_device(device_file), 23125)
+
+    def test_crc_failure(self):
+        device_file = self.tree.add_device('28-000004b1c2d3', BAD_CRC)
+        self.assertRaises(one_wire.OneWireReadException, one_wire.read_device, device_file)
+        self.assertEqual(one_wire.OneWireService.read_one(device_file), (device_file, None))
+
+    def test_crc_failure_retried(self):
+        device_file = self.tree.add_device('28-000004b1c2d3', BAD_CRC)
+        # the sensor answers properly on the next attempt
+        self.patch(one_wire, 'sleep', lambda seconds: self.tree.write(device_file, GOOD))
+        self.assertEqual(one_wire.read_device(device_file), 23125)
+
+    def test_missing_device(self):
+        device_file = os.path.join(self.tree.base_dir, '28-000004b1c2d3', 'w1_slave')
+        self.assertRaises(IOError, one_wire.read_device, device_file)
+        self.assertEqual(one_wire.OneWireService.read_one(device_file), (device_file, None))
+
+    def test_parse(self):
+        self.assertEqual(one_wire.parse_w1_slave(GOOD.splitlines()), 23125)
+        self.assertEqual(one_wire.parse_w1_slave(BAD_CRC.splitlines()), None)
+        self.assertEqual(one_wire.parse_w1_slave([]), None)
+        self.assertEqual(one_wire.parse_w1_slave(GOOD.splitlines()[:1] + ['72 01 4b 46']), None)
+
+
+class OneWireServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = FakeW1Tree()
+        self.addCleanup(self.tree.remove)
+        self.patch(one_wire, 'sleep', lambda seconds: None)
+        self.service = one_wire.OneWireService(self.tree.base_dir)
+
+    def test_sweep(self):
+        first = self.tree.add_device('28-000004b1c2d3')
+        second = self.tree.add_device('28-000004b1c2d4', GOOD.replace('t=23125', 't=-1250'))
+        self.assertEqual(self.service.get(first), (None, None))
+
+        def check(ignored):
+            self.assertEqual(self.service.get(first)[0], 23125)
+            self.assertEqual(self.service.get(second)[0], -1250)
+            self.assertFalse(self.service.sweeping)
+        return self.service.sweep().addCallback(check)
+
+    def test_sweep_keeps_last_good_value(self):
+        device_file = self.tree.add_device('28-000004b1c2d3')
+
+        def fail_crc(ignored):
+            self.good = self.service.get(device_file)
+            self.tree.write(device_file, BAD_CRC)
+            return self.service.sweep()
+
+        def check(ignored):
+            self.assertEqual(self.service.get(device_file), self.good)
+        return self.service.sweep().addCallback(fail_crc).addCallback(check)
+
+    def test_sweep_missing_device(self):
+        present = self.tree.add_device('28-000004b1c2d3')
+        missing = self.tree.add_device('28-000004b1c2d4')
+        # unplugged after it was found, the folder lingers without w1_slave
+        os.remove(missing)
+
+        def check(ignored):
+            self.assertEqual(self.service.get(present)[0], 23125)
+            self.assertEqual(self.service.get(missing), (None, None))
+        return self.service.sweep().addCallback(check)
+
+    def test_sweep_bulk(self):
+        device_file = self.tree.add_device('28-000004b1c2d3')
+        master = self.tree.add_bulk_master()
+
+        def check(ignored):
+            with open(master) as f:
+                self.assertEqual(f.read(), 'trigger\n')
+            self.assertEqual(self.service.get(device_file)[0], 23125)
+        return self.service.sweep().addCallback(check)
+
+    def test_no_devices(self):
+        self.assertEqual(self.service.sweep(), None)
+        self.assertFalse(self.service.sweeping)
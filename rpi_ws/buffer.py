@@ -1,34 +1,372 @@
+from array import array
+from bisect import bisect_right
+
+import settings
+
+
 class UpdateDict(dict):
-    # (sent_value, stored_value)
+    """
+    Dict that only exposes keys whose value changed since it was last read.
+    Reading a value (item access, iteritems, json.dumps) marks it read.
+    Changed keys are tracked in a set so len() and iteration cost
+    O(changed keys) rather than O(all keys).
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        # key: value when last read, unread keys compare against None
+        self.sent_values = {}
+        self.dirty = set()
+        self.update(*args, **kwargs)
+
     def __setitem__(self, key, value):
-        if key not in self:
-            dict.__setitem__(self, key, (None, value))
-            return
-        sent_value, stored_value = dict.__getitem__(self, key)
-        dict.__setitem__(self, key, (sent_value, value))
+        dict.__setitem__(self, key, value)
+        if self.sent_values.get(key) != value:
+            self.dirty.add(key)
+        else:
+            self.dirty.discard(key)
 
     def __getitem__(self, item):
-        sent_value, stored_value = dict.__getitem__(self, item)
+        stored_value = dict.__getitem__(self, item)
         # mark read
-        dict.__setitem__(self, item, (stored_value, stored_value))
+        self.sent_values[item] = stored_value
+        self.dirty.discard(item)
         return stored_value
 
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.sent_values.pop(key, None)
+        self.dirty.discard(key)
+
     def __iter__(self):
-        for key, (sent_value, stored_value) in dict.iteritems(self):
-            if sent_value != stored_value:
-                yield key
+        # copy, reading while iterating (json.dumps) marks keys read
+        return iter(list(self.dirty))
 
     def iteritems(self):
-        for key, (sent_value, stored_value) in dict.iteritems(self):
-            if sent_value != stored_value:
-                # mark read
-                dict.__setitem__(self, key, (stored_value, stored_value))
-                yield (key, stored_value)
+        for key in list(self.dirty):
+            yield (key, self[key])
+
+    def __len__(self):
+        return len(self.dirty)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+
+# marks a key that isn't in a dict yet
+_MISSING = object()
+
+
+class VersionClock(object):
+    """
+    Monotonic version counter, shared by every VersionedDict so one
+    version (cursor) covers any number of dicts, including ones created later
+    """
+
+    def __init__(self):
+        self.version = 0
+
+    def tick(self):
+        self.version += 1
+        return self.version
+
+
+version_clock = VersionClock()
+
+
+class VersionedDict(dict):
+    """
+    Dict recording the version at which each key last changed.
+    changed_since(cursor) costs O(keys changed after cursor), not O(all keys).
+    """
+
+    # compact the change log once it holds this many entries more than keys
+    LOG_SLACK = 64
+
+    def __init__(self, clock=None):
+        dict.__init__(self)
+        self.clock = clock if clock is not None else version_clock
+        # change log, parallel lists in version order
+        self.log_keys = []
+        self.log_versions = []
+        self.compact_at = self.LOG_SLACK
+
+    def __setitem__(self, key, value):
+        if dict.get(self, key, _MISSING) == value:
+            return
+        dict.__setitem__(self, key, value)
+        clock = self.clock
+        clock.version += 1
+        self.log_keys.append(key)
+        self.log_versions.append(clock.version)
+        if len(self.log_keys) > self.compact_at:
+            self.compact()
+
+    def update(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and not hasattr(args[0], 'keys'):
+            # iterable of pairs, ex) izip(keys, values)
+            items = args[0]
+        else:
+            items = dict(*args, **kwargs).iteritems()
+
+        # __setitem__ inlined, this is the batch equation scatter path
+        get = self.get
+        set_item = super(VersionedDict, self).__setitem__
+        clock = self.clock
+        log_keys = self.log_keys
+        log_versions = self.log_versions
+        for key, value in items:
+            if get(key, _MISSING) == value:
+                continue
+            set_item(key, value)
+            clock.version += 1
+            log_keys.append(key)
+            log_versions.append(clock.version)
+        if len(log_keys) > self.compact_at:
+            self.compact()
+
+    def compact(self):
+        """
+        Drops log entries superseded by a later change of the same key
+        """
+        seen = set()
+        log_keys = []
+        log_versions = []
+        for key, version in zip(reversed(self.log_keys), reversed(self.log_versions)):
+            if key not in seen:
+                seen.add(key)
+                log_keys.append(key)
+                log_versions.append(version)
+        log_keys.reverse()
+        log_versions.reverse()
+        self.log_keys = log_keys
+        self.log_versions = log_versions
+        self.compact_at = 2 * len(log_keys) + self.LOG_SLACK
+
+    def changed_since(self, version):
+        """
+        Returns dict of keys changed after version with their current value
+        """
+        start = bisect_right(self.log_versions, version)
+        return dict((key, dict.__getitem__(self, key)) for key in self.log_keys[start:])
+
+
+def to_float(value):
+    """
+    History values are floats, None and values that aren't numbers are NaN
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+NAN = float('nan')
+
+
+class RingBuffer(object):
+    """
+    Last capacity (timestamp, value) samples of a channel, oldest first,
+    in two array('d') grown up to capacity then overwritten in place.
+    Timestamps never go back, an older one is recorded at the newest so far.
+    """
+    # bytes per sample
+    SAMPLE_SIZE = 16
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d')
+        self.values = array('d')
+        # index of the oldest sample once full
+        self.start = 0
+        self.newest = NAN
+
+    def append(self, timestamp, value):
+        value = to_float(value)
+        if timestamp < self.newest:
+            # since() bisects the timestamps
+            timestamp = self.newest
+        else:
+            self.newest = timestamp
+        if len(self.timestamps) < self.capacity:
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+        else:
+            start = self.start
+            self.timestamps[start] = timestamp
+            self.values[start] = value
+            self.start = (start + 1) % self.capacity
+
+    def update(self, samples):
+        """
+        Appends iterable of (timestamp, value), EquationBatch scatters results with this
+        """
+        for timestamp, value in samples:
+            self.append(timestamp, value)
+
+    def since(self, timestamp):
+        """
+        Returns (timestamps, values) arrays of the samples after timestamp
+        """
+        start = self.start
+        timestamps = self.timestamps[start:] + self.timestamps[:start]
+        i = bisect_right(timestamps, timestamp)
+        if i == len(timestamps):
+            return array('d'), array('d')
+        values = self.values[start:] + self.values[:start]
+        return timestamps[i:], values[i:]
+
+    def last(self):
+        """
+        Returns the newest (timestamp, value), None if empty
+        """
+        if not self.timestamps:
+            return None
+        i = self.start - 1
+        return self.timestamps[i], self.values[i]
 
     def __len__(self):
-        counter = 0
-        for key, (sent_value, stored_value) in dict.iteritems(self):
-            if sent_value != stored_value:
-                counter += 1
-        return counter
+        return len(self.timestamps)
+
+    def __iter__(self):
+        start = self.start
+        order = range(start, len(self.timestamps)) + range(start)
+        return ((self.timestamps[i], self.values[i]) for i in order)
+
+
+class ChannelHistory(object):
+    """
+    RingBuffer per channel of one RPI. Every channel gets the same capacity,
+    max_samples or less so all of them together fit in budget bytes.
+    """
+
+    def __init__(self, channels, budget=None, max_samples=None):
+        if budget is None:
+            budget = settings.HISTORY_BUDGET
+        if max_samples is None:
+            max_samples = settings.HISTORY_LENGTH
+        channels = list(channels)
+        per_channel = budget // (RingBuffer.SAMPLE_SIZE * max(1, len(channels)))
+        self.capacity = max(1, min(max_samples, per_channel))
+        self.buffers = dict((channel, RingBuffer(self.capacity)) for channel in channels)
+
+    def __getitem__(self, channel):
+        return self.buffers[channel]
+
+    def __contains__(self, channel):
+        return channel in self.buffers
+
+    def record(self, timestamp, items):
+        """
+        Appends the (channel, value) items at timestamp
+        """
+        buffers = self.buffers
+        for channel, value in items:
+            buffers[channel].append(timestamp, value)
+
+    def window(self, since, channels):
+        """
+        Returns {channel: (timestamps, values)} after since, channels without samples are left out
+        """
+        ret = {}
+        for channel in channels:
+            timestamps, values = self.buffers[channel].since(since)
+            if timestamps:
+                ret[channel] = (timestamps, values)
+        return ret
+
+    def nbytes(self):
+        return sum(len(ring) for ring in self.buffers.itervalues()) * RingBuffer.SAMPLE_SIZE
+
+
+class Tee(object):
+    """
+    Scatter target passing update(items) on to every target
+    """
+
+    def __init__(self, *targets):
+        self.targets = targets
+
+    def update(self, items):
+        items = list(items)
+        for target in self.targets:
+            target.update(items)
+
+
+class Aggregates(object):
+    """
+    Incremental last/min/max/mean/count of every channel, one set per update
+    window. A value costs O(windows) however often values arrive, min/max/mean
+    only count values that are numbers.
+    """
+    # aggregates are [last, min, max, total, numbers, count]
+
+    def __init__(self, skip=None):
+        # period: {channel: aggregate}
+        self.windows = {}
+        # channels update() leaves out, their values are added as samples
+        self.skip = skip if skip is not None else set()
+
+    def __nonzero__(self):
+        return bool(self.windows)
+
+    def add_window(self, period):
+        self.windows.setdefault(period, {})
+
+    def remove_window(self, period):
+        self.windows.pop(period, None)
+
+    def add(self, channel, value):
+        number = to_float(value)
+        is_number = number == number
+        for window in self.windows.itervalues():
+            aggregate = window.get(channel)
+            if aggregate is None:
+                aggregate = window[channel] = [value, None, None, 0.0, 0, 0]
+            aggregate[0] = value
+            aggregate[5] += 1
+            if is_number:
+                if not aggregate[4] or number < aggregate[1]:
+                    aggregate[1] = number
+                if not aggregate[4] or number > aggregate[2]:
+                    aggregate[2] = number
+                aggregate[3] += number
+                aggregate[4] += 1
+
+    def update(self, items):
+        """
+        Adds iterable of (channel, value), EquationBatch scatters results with this
+        """
+        skip = self.skip
+        for channel, value in items:
+            if channel not in skip:
+                self.add(channel, value)
+
+    def samples(self, channel):
+        """
+        Scatter target adding (timestamp, value) samples of channel
+        """
+        return _ChannelSamples(self, channel)
+
+    def take(self, period):
+        """
+        Returns {channel: [last, min, max, mean, count]} of the window and starts the next one
+        """
+        window = self.windows.get(period)
+        if window is None:
+            return {}
+        self.windows[period] = {}
+        return dict((channel, [last, low, high, total / numbers if numbers else None, count])
+                    for channel, (last, low, high, total, numbers, count) in window.iteritems())
+
+
+class _ChannelSamples(object):
+    def __init__(self, aggregates, channel):
+        self.aggregates = aggregates
+        self.channel = channel
 
+    def update(self, samples):
+        add = self.aggregates.add
+        for timestamp, value in samples:
+            add(self.channel, value)
@@ -1,4 +1,5 @@
-from twisted.internet import reactor
+from time import time
+from twisted.internet import defer, reactor, task
 from twisted.python import log
 from autobahn.websocket import WebSocketClientProtocol, WebSocketClientFactory
 from twisted.internet.protocol import ReconnectingClientFactory
@@ -8,32 +9,122 @@ import hmac
 import binascii
 
 import rpi_data.interface as interface
+import rpi_data.i2c as i2c
 import rpi_data.utility
 import settings
 import common_protocol
 import buffer
+import compression
+import flow
+import framing
+import metrics
+import scheduler
 
 
 class StreamState(common_protocol.State):
     def __init__(self, protocol, reads, writes):
         # reads/writes look like this
-        # {u'cls:ADC, port:3': {'equations': [u'zzzz', u'asdfadfad'], 'obj': <rpi_data.interface.ADC object at 0x036D18D0>}}
+        # {u'cls:ADC, port:3': {'equations': [u'zzzz', u'asdfadfad'], 'obj': <rpi_data.interface.ADC object at 0x036D18D0>,
+        #                       'sample_period': 0.5, 'edge': 'both', 'debounce': 5}}
+        # sample_period is optional, defaults to the interface SAMPLE_PERIOD
+        # edge ('rising', 'falling' or 'both') is optional, interfaces with EDGE_DETECT then
+        # push every change instead of being sampled, debounce is in ms
         super(StreamState, self).__init__(protocol)
 
         self.config_reads = reads
         self.config_writes = writes
+        # servers assigning channel IDs get them instead of keys
+        self.channel_ids = all('id' in io for io in reads.values() + writes.values())
+        # channel ID: key, for WRITE_DATA
+        self.write_id_keys = dict((io['id'], key) for key, io in writes.iteritems() if 'id' in io)
 
         self.polldata_read = buffer.UpdateDict()
         self.polldata_write = buffer.UpdateDict()
 
-        self.ackcount = 0
+        # key: [(timestamp, value), ...] timestamped samples not sent yet, edges and batched samples
+        self.read_samples = {}
+        self.write_samples = {}
+        # batching, samples wait for the window/count then go in one frame
+        self.batch_window = settings.SAMPLE_BATCH_WINDOW_MS / 1000.0
+        self.batch_count = settings.SAMPLE_BATCH_COUNT
+        self.batching = bool(self.batch_window or self.batch_count)
+        self.batch_size = 0
+        self.batch_call = None
+        # batch complete but held back by the ack window
+        self.batch_due = False
+
+        # binary DATA frames if the server agreed to them
+        self.codec = None
+        if self.protocol.framing == framing.FRAMING_BINARY:
+            self.codec = framing.DataFrameCodec.from_config(
+                reads, writes, lambda key, io: getattr(interface, io['cls_name']).IO_TYPE)
+
+        # DATA frames in flight, the server grants the window
+        self.flow = flow.FlowSender()
         self.paused = True
 
+        # ('read' or 'write', key): metrics.IOTimings of hardware calls since the last STATS report
+        self.io_timings = {}
+        self.stats_call = None
+
+        # every channel is sampled on its own period, due channels are sent together
+        self.scheduler = scheduler.SampleScheduler(self.sample)
+        # channels pushing their edges, only sampled once on resume
+        self.edge_keys = []
+        for key, value in self.config_reads.iteritems():
+            if self.start_edges(key, value):
+                self.edge_keys.append(key)
+            else:
+                self.scheduler.add((False, key), self.sample_period(value))
+        for key, value in self.config_writes.iteritems():
+            self.scheduler.add((True, key), self.sample_period(value))
+
+    @staticmethod
+    def sample_period(config):
+        if config.get('sample_period'):
+            return float(config['sample_period'])
+        if config['obj'] is not None:
+            return config['obj'].SAMPLE_PERIOD
+        # nothing to read
+        return interface.IBase.SAMPLE_PERIOD
+
+    def start_edges(self, key, config):
+        obj = config['obj']
+        if obj is None or not obj.EDGE_DETECT or not config.get('edge'):
+            return False
+
+        def edge(value, timestamp):
+            self.store_edge(key, value, timestamp)
+
+        try:
+            obj.start_edges(edge, config['edge'], config.get('debounce'))
+        except (KeyError, RuntimeError), e:
+            # unknown edge or the pin refused event detection, keep sampling it
+            log.err("%s - edge detection failed on %s, %s" % (self.__class__.__name__, key, e))
+            return False
+        return True
+
+    def stop_edges(self):
+        """
+        Pins of edge channels stop calling back into this state
+        """
+        for key in self.edge_keys:
+            self.config_reads[key]['obj'].stop_edges()
+        self.edge_keys = []
+
     def onMessage(self, msg):
         msg = json.loads(msg)
 
+        if 'ack_count' in msg:
+            # acks and credit come on ACK_DATA or piggybacked on other messages
+            self.flow.acked(msg['ack_count'], msg.get('window'), msg.get('ts'))
+            if self.flow.can_send() and (self.batch_due or not self.batching):
+                # send what was sampled while the window was full
+                self.send_data()
+
         if msg['cmd'] == common_protocol.ServerCommands.DROP_TO_CONFIG:
             # wrong state, drop
+            self.pause_streaming()
             # flush IO
             io_clss = interface.get_interface_desc()
             for cls in io_clss['read']:
@@ -46,12 +137,6 @@ class StreamState(common_protocol.State):
             self.sendJsonMessage(resp_msg)
             return
 
-        elif msg['cmd'] == common_protocol.ServerCommands.ACK_DATA:
-            server_ackcount = msg['ack_count']
-            self.ackcount += server_ackcount
-            if self.ackcount > -10:
-                self.poll_and_send()
-
         elif msg['cmd'] == common_protocol.ServerCommands.RESUME_STREAMING:
             self.resume_streaming()
 
@@ -59,51 +144,224 @@ class StreamState(common_protocol.State):
             self.pause_streaming()
 
         elif msg['cmd'] == common_protocol.ServerCommands.WRITE_DATA:
-            key = msg['inter_face_port']
+            if 'channel_id' in msg:
+                key = self.write_id_keys.get(msg['channel_id'])
+            else:
+                key = msg['inter_face_port']
             value = msg['value']
             self.write_to_inter_face(key, value)
 
     def write_to_inter_face(self, inter_face_port, value):
         if inter_face_port not in self.config_writes or self.config_writes[inter_face_port]['obj'] is None:
             return
-        self.config_writes[inter_face_port]['obj'].write(value)
-
-    def poll_and_send(self):
-        if self.ackcount <= -10 or self.paused:
-            return
-
-        for key, value in self.config_reads.iteritems():
-            if value['obj'] is not None:
-                self.polldata_read[key] = value['obj'].read()
+        start = time()
+        d = self.config_writes[inter_face_port]['obj'].write_async(value)
+
+        def written(ignored):
+            self.io_timed('write', inter_face_port, start)
+            # report the new state without waiting for the channel's next sample
+            if not self.paused:
+                self.sample([(True, inter_face_port)])
+
+        d.addCallbacks(written, self.io_failed, errbackArgs=(inter_face_port, 'write', start))
+
+    def sample(self, items):
+        """
+        Called by the scheduler with the (is_write, key) channels that are due.
+        Reads that return right away are sent immediately, reads waiting on
+        hardware are sent together once they all completed or timed out.
+        When batching they wait for the batch instead.
+        """
+        waiting = []
+        for is_write, key in items:
+            if is_write:
+                value = self.config_writes[key]
             else:
-                #log.err("value['obj'] is None ")
-                self.polldata_write[key] = None
+                value = self.config_reads[key]
 
-        for key, value in self.config_writes.iteritems():
             if value['obj'] is not None:
-                self.polldata_write[key] = value['obj'].read()
+                start = time()
+                d = value['obj'].read_async()
+                d.addCallbacks(self.store_sample, self.io_failed,
+                               callbackArgs=(is_write, key, start), errbackArgs=(key, 'read', start))
+                if not d.called:
+                    waiting.append(d)
             else:
                 #log.err("value['obj'] is None ")
                 self.polldata_write[key] = None
 
-        if len(self.polldata_read) > 0 or len(self.polldata_write) > 0:
+        if not self.batching:
+            self.send_data()
+            if waiting:
+                defer.DeferredList(waiting).addCallback(lambda ignored: self.send_data())
+
+    def store_sample(self, data, is_write, key, start=None):
+        if start is not None:
+            self.io_timed('read', key, start)
+        if self.batching:
+            self.add_sample(is_write, key, time(), data)
+        elif is_write:
+            self.polldata_write[key] = data
+        else:
+            self.polldata_read[key] = data
+
+    def store_edge(self, key, value, timestamp):
+        if self.paused:
+            # levels are read again on resume
+            return
+        self.add_sample(False, key, timestamp, value)
+        if not self.batching:
+            self.polldata_read[key] = value
+            self.send_data()
+
+    def add_sample(self, is_write, key, timestamp, value):
+        if self.paused:
+            # reads still in flight when paused
+            return
+        samples = (self.write_samples if is_write else self.read_samples).setdefault(key, [])
+        samples.append((timestamp, value))
+        if len(samples) > settings.SAMPLE_BUFFER_SIZE:
+            # window full for a while, oldest samples go first
+            del samples[0]
+        else:
+            self.batch_size += 1
+
+        if self.batching:
+            if self.batch_count and self.batch_size >= self.batch_count:
+                self.flush_batch()
+            elif self.batch_window and self.batch_call is None:
+                self.batch_call = reactor.callLater(self.batch_window, self.flush_batch)
+
+    def flush_batch(self):
+        if self.batch_call is not None and self.batch_call.active():
+            self.batch_call.cancel()
+        self.batch_call = None
+        self.batch_due = True
+        self.send_data()
+
+    def io_failed(self, failure, key, op=None, start=None):
+        # the channel keeps its last value
+        if start is not None:
+            self.io_timed(op, key, start, failure)
+        if not failure.check(interface.HardwareBusyException) and self.protocol.factory.debug:
+            log.err("%s - IO failed on %s, %s" % (self.__class__.__name__, key, failure.getErrorMessage()))
+
+    def io_timed(self, op, key, start, failure=None):
+        timings = self.io_timings.get((op, key))
+        if timings is None:
+            timings = self.io_timings[(op, key)] = metrics.IOTimings()
+        if failure is not None and failure.check(interface.HardwareBusyException):
+            # refused right away, the previous call is still running
+            timings.busy += 1
+            return
+        timings.latency.observe(time() - start)
+        if failure is not None:
+            timings.errors += 1
+
+    def send_stats(self):
+        """
+        STATS report of the windows since the last one, channels without calls are left out
+        """
+        io = {'read': {}, 'write': {}}
+        for (op, key), timings in self.io_timings.iteritems():
+            if timings.latency.count or timings.busy:
+                io[op][key] = timings.summary()
+                timings.reset()
+        reactor_lag = self.protocol.factory.reactor_lag.histogram
+        msg = {'cmd': common_protocol.RPIClientCommands.STATS,
+               'io': io,
+               'reactor_lag': reactor_lag.summary(),
+               'i2c': i2c.bus_stats()}
+        reactor_lag.reset()
+        self.sendJsonMessage(msg)
+
+    def send_data(self):
+        if not self.flow.can_send() or self.paused:
+            # samples keep coalescing in the buffers until acks come in
+            return
+
+        has_samples = bool(self.read_samples or self.write_samples)
+        if len(self.polldata_read) > 0 or len(self.polldata_write) > 0 or has_samples:
+            # reading marks the values sent
+            reads = dict(self.polldata_read.iteritems())
+            writes = dict(self.polldata_write.iteritems())
+            self.flow.sent()
+            echo = self.flow.take_echo()
+
+            if self.codec is not None and not has_samples:
+                frame = self.codec.encode(reads, writes, echo)
+                if frame is not None:
+                    self.protocol.sendMessage(frame, binary=True)
+                    return
+
+            read_samples = self.read_samples
+            write_samples = self.write_samples
+            self.read_samples = {}
+            self.write_samples = {}
+            self.batch_size = 0
+            self.batch_due = False
+            if self.batch_call is not None and self.batch_call.active():
+                self.batch_call.cancel()
+            self.batch_call = None
+
+            if self.channel_ids:
+                reads = self.to_ids(reads, self.config_reads)
+                writes = self.to_ids(writes, self.config_writes)
+                read_samples = self.to_ids(read_samples, self.config_reads)
+                write_samples = self.to_ids(write_samples, self.config_writes)
+
             msg = {'cmd': common_protocol.RPIClientCommands.DATA,
-                   'read': self.polldata_read,
-                   'write': self.polldata_write
+                   'read': reads,
+                   'write': writes
                   }
+            if has_samples:
+                msg['samples'] = self.format_samples(read_samples, write_samples)
+            if echo is not None:
+                msg['echo'] = echo
 
-            self.ackcount -= 1
             self.sendJsonMessage(msg)
 
+    @staticmethod
+    def format_samples(read_samples, write_samples):
+        """
+        {'t0': timestamp, 'read': {key: [[ms after t0, value], ...]}, 'write': {...}}
+        """
+        t0 = min(samples[0][0] for samples in read_samples.values() + write_samples.values())
+
+        def offsets(data):
+            return dict((key, [[round((timestamp - t0) * 1000, 3), value] for timestamp, value in samples])
+                        for key, samples in data.iteritems())
+
+        return {'t0': t0, 'read': offsets(read_samples), 'write': offsets(write_samples)}
 
-        reactor.callLater(0, self.poll_and_send)
+    @staticmethod
+    def to_ids(data, config):
+        return dict((config[key]['id'], value) for key, value in data.iteritems())
 
     def pause_streaming(self):
         self.paused = True
+        self.scheduler.stop()
+        if self.stats_call is not None and self.stats_call.running:
+            self.stats_call.stop()
+        self.stats_call = None
+        if self.batch_call is not None and self.batch_call.active():
+            self.batch_call.cancel()
+        self.batch_call = None
+        # nobody is listening, resume starts from fresh samples
+        self.read_samples = {}
+        self.write_samples = {}
+        self.batch_size = 0
+        self.batch_due = False
 
     def resume_streaming(self):
         self.paused = False
-        self.poll_and_send()
+        self.scheduler.start()
+        if settings.STATS_INTERVAL and self.stats_call is None:
+            self.stats_call = task.LoopingCall(self.send_stats)
+            self.stats_call.start(settings.STATS_INTERVAL, now=False)
+        if self.edge_keys:
+            # current level of edge channels, edges only report changes
+            self.sample([(False, key) for key in self.edge_keys])
 
 
 class Config_Register_State(common_protocol.State):
@@ -134,8 +392,13 @@ class Config_Register_State(common_protocol.State):
             return
 
         if self.hmac_reply_expected and msg['cmd'] == common_protocol.ServerCommands.ACK:
+            # older servers don't pick a framing
+            self.protocol.framing = msg.get('framing', framing.FRAMING_JSON)
+            if msg.get('compression') == compression.COMPRESSION_DEFLATE:
+                self.protocol.start_compression(self.protocol.factory.compression)
             if self.protocol.factory.debug:
-                log.msg("RegisterState.onMessage - Registration Ack")
+                log.msg("RegisterState.onMessage - Registration Ack, %s framing, %s compression" %
+                        (self.protocol.framing, msg.get('compression')))
 
         if msg['cmd'] == common_protocol.ServerCommands.CONFIG:
             read_settings = msg['payload']['read']
@@ -156,7 +419,9 @@ class Config_Register_State(common_protocol.State):
             self.protocol.push_state(StreamState(self.protocol, reads=read_settings, writes=writes_settings))
 
             # there should be some feedback done here if something fails
-            msg = {'cmd': common_protocol.RPIClientCommands.CONFIG_OK}
+            # channel_ids, DATA/WRITE_DATA use the IDs of the CONFIG payload if it had them
+            msg = {'cmd': common_protocol.RPIClientCommands.CONFIG_OK,
+                   'channel_ids': True}
             self.sendJsonMessage(msg)
 
     def instantiate_io(self, io_collection):
@@ -184,7 +449,9 @@ class Config_Register_State(common_protocol.State):
 
     def _send_desc(self):
         desc = {'inter_face': {},
-                'mac': self.protocol.mac}
+                'mac': self.protocol.mac,
+                'framing': framing.SUPPORTED_FRAMINGS,
+                'compression': self.protocol.factory.compression.offer()}
 
         def inter_desc(inter_faces):
             # list of classes
@@ -213,12 +480,33 @@ class RPIClientProtocol(WebSocketClientProtocol, common_protocol.ProtocolState):
         common_protocol.ProtocolState.__init__(self)
         self.mac = rpi_data.utility.get_mac()
         self.interfaces = interface.get_interface_desc()
+        # DATA framing, negotiated in Config_Register_State
+        self.framing = framing.FRAMING_JSON
+        # set once compression is negotiated in Config_Register_State
+        self.compressor = None
+        self.decompressor = None
+
+    def start_compression(self, options):
+        self.compressor = compression.MessageCompressor(options)
+        self.decompressor = compression.MessageDecompressor()
+
+    def sendMessage(self, payload, binary=False, payload_frag_size=None, sync=False):
+        if self.compressor is not None:
+            payload, binary = self.compressor.compress(payload, binary)
+        WebSocketClientProtocol.sendMessage(self, payload, binary, payload_frag_size, sync)
 
     def onOpen(self):
         # push the initial state
         self.push_state(Config_Register_State(self))
 
     def onMessage(self, msg, binary):
+        if binary and self.decompressor is not None:
+            try:
+                msg, binary = self.decompressor.decompress(msg)
+            except compression.CompressionError, e:
+                log.err("%s.onMessage - Bad compressed message, %s" % (self.__class__.__name__, e))
+                self.failConnection()
+                return
         try:
             state = self.state_stack.pop_wr()
             state.onMessage(msg)
@@ -226,6 +514,30 @@ class RPIClientProtocol(WebSocketClientProtocol, common_protocol.ProtocolState):
             if self.factory.debug:
                 log.err("%s.onMessage - Received a message in an unknown state, ignored %s" % (self.__class__.__name__, e))
 
+    def onClose(self, wasClean, code, reason):
+        WebSocketClientProtocol.onClose(self, wasClean, code, reason)
+        # stop sampling and edge callbacks, a reconnect starts over with new states
+        for state in self.state_stack:
+            if isinstance(state, StreamState):
+                state.pause_streaming()
+                state.stop_edges()
+
 
 class ReconnectingWebSocketClientFactory(ReconnectingClientFactory, WebSocketClientFactory):
-    maxDelay = 30
\ No newline at end of file
+    maxDelay = 30
+
+    def __init__(self, *args, **kwargs):
+        # deflate options of the /rpi/ endpoint, see compression
+        options = kwargs.pop('compression', settings.COMPRESSION_RPI)
+        WebSocketClientFactory.__init__(self, *args, **kwargs)
+        self.compression = compression.CompressionOptions(**options)
+        # reported with the hardware timings, see StreamState.send_stats
+        self.reactor_lag = metrics.ReactorLag(settings.METRICS_LAG_INTERVAL)
+
+    def startFactory(self):
+        WebSocketClientFactory.startFactory(self)
+        self.reactor_lag.start()
+
+    def stopFactory(self):
+        WebSocketClientFactory.stopFactory(self)
+        self.reactor_lag.stop()
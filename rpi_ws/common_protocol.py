@@ -10,6 +10,13 @@ class State(object):
     def onMessage(self, msg):
         raise NotImplementedError("Should have implemented this")
 
+    def onBinaryMessage(self, msg):
+        """
+        Binary frames are only expected once a state negotiated them
+        """
+        if self.protocol.debug:
+            log.msg("%s.onBinaryMessage - Unexpected binary message, ignored" % self.__class__.__name__)
+
     def activated(self):
         """
         When state has become the top of the stack
@@ -38,6 +45,16 @@ class ServerCommands(object):
     WRITE_DATA = 'write_data'
 
     RPI_STATE_CHANGE = 'rpi_schange'
+    # eq ID: name table of an RPI, for users that asked for IDs
+    RPI_CHANNELS = 'rpi_channels'
+    # recent history of an RPI's equation outputs, sent before streaming starts
+    RPI_HISTORY = 'rpi_history'
+    # per channel [last, min, max, mean, count] of a window, for users with a max update rate
+    AGGREGATE_DATA = 'aggregate_data'
+    # {mac: latest state} of watched RPIs that changed since the last one, for users that sent RPI_WATCH
+    RPI_STATE_DIGEST = 'rpi_states'
+    # {'rpis': {mac: {'read': ..., 'write': ...}}} changes of every RPI a user subscribed to with SUBSCRIBE_RPIS
+    RPI_DATA = 'rpi_data'
 
 
 class RPIClientCommands(object):
@@ -45,12 +62,18 @@ class RPIClientCommands(object):
     CONFIG_FAIL = 'c_fail'
     DROP_TO_CONFIG_OK = 'drop_to_config_ok'
     DATA = 'data'
+    # hardware timings and reactor lag since the last one and I2C bus totals, every STATS_INTERVAL while streaming
+    STATS = 'stats'
 
 
 class UserClientCommands(object):
     CONNECT_RPI = 'rpi_connect'
     ACK_DATA = 'ack_data'
     WRITE_DATA = 'write_data'
+    # RPI macs whose state changes the user wants besides the connected one's
+    RPI_WATCH = 'rpi_watch'
+    # stream every RPI of a list on this connection, CONNECT_RPI options apply
+    SUBSCRIBE_RPIS = 'rpi_subscribe'
 
 
 class StateStack(list):
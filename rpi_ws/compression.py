@@ -0,0 +1,142 @@
+"""
+Per-message deflate between the RPI, the server and users.
+
+autobahn 0.5 has no WebSocket extensions, so instead of permessage-deflate
+compression is negotiated in the protocol's own handshake (RPI register
+desc/ACK, user CONNECT_RPI). Once it is on, every binary message starts
+with a header byte:
+
+    FLAG_DEFLATE payload is deflated
+    FLAG_BINARY  payload is a binary message, else text
+
+Text messages under the endpoint's min_size stay plain text messages.
+Like permessage-deflate, payloads are raw deflate ending on a sync flush
+with the trailing 00 00 ff ff stripped. With context takeover a sender
+keeps its window across messages, the best ratio on repetitive JSON for
+~300KB of zlib state per connection, without it every message stands
+alone and broadcasts are compressed once for every user.
+"""
+import zlib
+from time import time
+
+__author__ = 'kenny'
+
+COMPRESSION_DEFLATE = 'deflate'
+SUPPORTED_COMPRESSIONS = [COMPRESSION_DEFLATE]
+
+FLAG_DEFLATE = 0x01
+FLAG_BINARY = 0x02
+
+_TAIL = '\x00\x00\xff\xff'
+
+
+class CompressionError(Exception):
+    pass
+
+
+class CompressionOptions(object):
+    """
+    Deflate settings of one endpoint, level 0 disables compression
+    """
+
+    def __init__(self, level=6, context_takeover=True, min_size=128, mem_level=8):
+        self.level = level
+        self.context_takeover = context_takeover
+        self.min_size = min_size
+        self.mem_level = mem_level
+
+    @property
+    def enabled(self):
+        return self.level > 0
+
+    def offer(self):
+        return list(SUPPORTED_COMPRESSIONS) if self.enabled else []
+
+    def choose(self, offered):
+        """
+        Returns the compression to use of the ones offered by the peer, None for
+        peers that offer none (older RPIs, browsers) or when disabled here
+        """
+        if not self.enabled or not offered:
+            return None
+        for compression in SUPPORTED_COMPRESSIONS:
+            if compression in offered:
+                return compression
+        return None
+
+
+class MessageCompressor(object):
+    """
+    Outgoing messages of one connection
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.context_takeover = options.context_takeover
+        self.compressor = None
+
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def deflate(self, payload):
+        if self.compressor is None or not self.context_takeover:
+            self.compressor = zlib.compressobj(self.options.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                               self.options.mem_level)
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-len(_TAIL)]
+
+    def compress(self, payload, binary=False):
+        """
+        Returns (payload, binary) to send for a message
+        """
+        if not binary and len(payload) < self.options.min_size:
+            return payload, False
+
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        flags = FLAG_BINARY if binary else 0
+        start = time()
+        if len(payload) >= self.options.min_size:
+            flags |= FLAG_DEFLATE
+            data = self.deflate(payload)
+        else:
+            data = payload
+        self.seconds += time() - start
+        self.messages += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(data) + 1
+        return chr(flags) + data, True
+
+    def stats(self):
+        return {'messages': self.messages,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': float(self.bytes_out) / self.bytes_in if self.bytes_in else 1.0,
+                'seconds': self.seconds}
+
+
+class MessageDecompressor(object):
+    """
+    Incoming messages of one connection, the window is kept whether or not
+    the sender takes over its context, fresh streams don't reference it
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, message):
+        """
+        Returns (payload, binary) of a binary message received once compression is on
+        """
+        if not message:
+            raise CompressionError('empty message')
+        flags = ord(message[0])
+        payload = message[1:]
+        if flags & FLAG_DEFLATE:
+            try:
+                payload = self.decompressor.decompress(payload + _TAIL)
+            except zlib.error, e:
+                raise CompressionError(str(e))
+        return payload, bool(flags & FLAG_BINARY)
@@ -0,0 +1,178 @@
+"""
+Credit based flow control of DATA frames.
+
+The receiver grants a window, the number of frames the sender may have
+in flight, sized to cover a round trip at the rate the receiver can take
+frames. Grants ride on acks:
+    {'ack_count': frames acked, 'window': frames, 'ts': receiver time}
+The sender echoes the last ts on its next frame, plus the time it held it,
+which gives the receiver its RTT. Receivers that don't grant (browsers,
+older servers) get a window the sender estimates from its own RTT.
+"""
+from collections import deque
+import math
+from time import time
+
+import settings
+
+__author__ = 'kenny'
+
+# weight of a new sample in the moving averages
+EWMA_WEIGHT = 0.2
+
+
+def ewma(average, sample):
+    if average is None:
+        return sample
+    return average + EWMA_WEIGHT * (sample - average)
+
+
+def window_for(rate, rtt):
+    """
+    Frames needed in flight to keep rate frames/s flowing over rtt seconds
+    when acks come at half the window or FLOW_ACK_DELAY late
+    """
+    if not rate or rtt is None:
+        return settings.FLOW_INITIAL_WINDOW
+    window = 2 * int(math.ceil(rate * (rtt + settings.FLOW_ACK_DELAY)))
+    return max(settings.FLOW_MIN_WINDOW, min(settings.FLOW_MAX_WINDOW, window))
+
+
+class RateMeter(object):
+    """
+    Events per second, moving average of the time between events
+    """
+
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.last = None
+        self.interval = None
+
+    def tick(self):
+        now = self.clock()
+        if self.last is not None:
+            self.interval = ewma(self.interval, now - self.last)
+        self.last = now
+
+    @property
+    def rate(self):
+        if not self.interval:
+            return 0.0
+        return 1.0 / self.interval
+
+
+class FlowSender(object):
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.in_flight = 0
+        # frames sent, ever
+        self.frames_sent = 0
+        # window granted by the receiver, None if it never granted one
+        self.granted = None
+        self.rtt = None
+        self.rate = RateMeter(clock)
+        # send time of every frame in flight, oldest first
+        self.send_times = deque()
+        # (receiver ts, local time it arrived) of the last grant, echoed once
+        self.echo = None
+
+    @property
+    def window(self):
+        if self.granted is not None:
+            return self.granted
+        return window_for(self.rate.rate, self.rtt)
+
+    def can_send(self):
+        return self.in_flight < self.window
+
+    def sent(self):
+        self.in_flight += 1
+        self.frames_sent += 1
+        self.send_times.append(self.clock())
+        self.rate.tick()
+
+    def acked(self, count, window=None, ts=None):
+        now = self.clock()
+        sent_time = None
+        for i in xrange(min(count, len(self.send_times))):
+            sent_time = self.send_times.popleft()
+        if sent_time is not None:
+            self.rtt = ewma(self.rtt, now - sent_time)
+        self.in_flight = max(0, self.in_flight - count)
+        if window is not None:
+            self.granted = int(window)
+        if ts is not None:
+            self.echo = (ts, now)
+
+    def take_echo(self):
+        """
+        Returns the receiver ts to echo on the next frame, adjusted for how long
+        it was held here, None if there's nothing to echo
+        """
+        if self.echo is None:
+            return None
+        ts, received = self.echo
+        self.echo = None
+        return ts + (self.clock() - received)
+
+    def reset(self):
+        self.in_flight = 0
+        self.send_times.clear()
+        self.echo = None
+
+    def stats(self):
+        return {'window': self.window,
+                'granted': self.granted,
+                'in_flight': self.in_flight,
+                'sent': self.frames_sent,
+                'rtt': self.rtt,
+                'rate': self.rate.rate}
+
+
+class FlowReceiver(object):
+    def __init__(self, clock=time):
+        self.clock = clock
+        # frames received and not acked yet
+        self.unacked = 0
+        self.window = settings.FLOW_INITIAL_WINDOW
+        self.rtt = None
+        self.rate = RateMeter(clock)
+        # seconds spent handling one frame
+        self.processing = None
+
+    def received(self, echo=None):
+        self.unacked += 1
+        self.rate.tick()
+        if echo is not None:
+            self.rtt = ewma(self.rtt, max(0.0, self.clock() - echo))
+
+    def processed(self, seconds):
+        self.processing = ewma(self.processing, seconds)
+
+    def should_ack(self):
+        return self.unacked >= max(1, self.window // 2)
+
+    def grant(self):
+        """
+        Returns the ack fields for the frames received so far with a new window
+        """
+        rate = self.rate.rate
+        if rate:
+            # room for the sender to speed up, not past what this end handles
+            rate *= 2
+            if self.processing:
+                rate = min(rate, 1.0 / self.processing)
+        self.window = window_for(rate, self.rtt)
+
+        ack = {'ack_count': self.unacked,
+               'window': self.window,
+               'ts': self.clock()}
+        self.unacked = 0
+        return ack
+
+    def stats(self):
+        return {'window': self.window,
+                'unacked': self.unacked,
+                'rtt': self.rtt,
+                'rate': self.rate.rate,
+                'processing': self.processing}
@@ -0,0 +1,201 @@
+"""
+Binary DATA frames between the RPI client and the server.
+
+Both ends build the same channel table from the CONFIG payload: read keys
+then write keys, each sorted. A frame only carries values, keys are implied
+by their position in the table:
+
+    '<BBH' version, flags, number of channels in the table
+    '<d'   flow control echo, if FLAG_ECHO is set, see flow
+    bitmap channels present in this frame
+    bitmap 'I' channels holding a float, the others hold an integer
+    values of the present channels in table order
+        IO_TYPE_BINARY  1 byte, index in BINARY_VALUES
+        IO_TYPE_INTEGER 8 bytes, '<q' or '<d', None is a float NaN
+
+A frame with a value that doesn't fit is sent as JSON instead.
+"""
+from itertools import izip
+import struct
+
+__author__ = 'kenny'
+
+FRAMING_JSON = 'json'
+FRAMING_BINARY = 'binary'
+# preferred first
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_JSON]
+
+FRAME_VERSION = 2
+FLAG_ECHO = 0x01
+
+# matches rpi_data.interface.IBase, not imported so the server doesn't need the hardware modules
+IO_TYPE_BINARY = 'B'
+IO_TYPE_INTEGER = 'I'
+
+# every value a binary channel reports, MOD-IO ports report characters
+BINARY_VALUES = (0, 1, False, True, None, u'0', u'1', -1)
+# type and value, False == 0 in a plain dict
+_BINARY_CODES = dict(((type(value), value), code) for code, value in enumerate(BINARY_VALUES))
+_BINARY_CODES[(str, '0')] = BINARY_VALUES.index(u'0')
+_BINARY_CODES[(str, '1')] = BINARY_VALUES.index(u'1')
+
+_NAN = float('nan')
+
+
+class FrameFormatError(Exception):
+    pass
+
+
+def choose_framing(offered):
+    """
+    Returns the preferred framing of the ones offered by the RPI, JSON for older clients
+    """
+    for framing in SUPPORTED_FRAMINGS:
+        if offered and framing in offered:
+            return framing
+    return FRAMING_JSON
+
+
+class DataFrameCodec(object):
+    def __init__(self, channels):
+        # [(is_write, key, io type), ...] in frame order
+        self.channels = channels
+        # key: position in the table
+        self.read_index = {}
+        self.write_index = {}
+        for i, (is_write, key, io_type) in enumerate(channels):
+            if is_write:
+                self.write_index[key] = i
+            else:
+                self.read_index[key] = i
+        self.binary = [io_type == IO_TYPE_BINARY for is_write, key, io_type in channels]
+        self.bitmap_size = (len(channels) + 7) // 8
+        self.header_format = '<BBH%ds%ds' % (self.bitmap_size, self.bitmap_size)
+        self.header_size = struct.calcsize(self.header_format)
+
+    @classmethod
+    def from_config(cls, reads, writes, io_type):
+        """
+        reads/writes are CONFIG payload dicts, io_type(key, config) returns the IO_TYPE of a channel
+        """
+        channels = [(False, key, io_type(key, reads[key])) for key in sorted(reads)]
+        channels += [(True, key, io_type(key, writes[key])) for key in sorted(writes)]
+        return cls(channels)
+
+    def encode(self, reads, writes, echo=None):
+        """
+        Returns the binary frame of reads/writes, None if a value has no binary form
+        """
+        fields = []
+        for index, data in ((self.read_index, reads), (self.write_index, writes)):
+            for key, value in data.iteritems():
+                i = index.get(key)
+                if i is None:
+                    return None
+                fields.append((i, value))
+        fields.sort()
+
+        present = bytearray(self.bitmap_size)
+        floats = bytearray(self.bitmap_size)
+        # every field is packed in one go
+        value_format = []
+        values = []
+        binary = self.binary
+        for i, value in fields:
+            present[i >> 3] |= 1 << (i & 7)
+            value_type = type(value)
+            if binary[i]:
+                code = _BINARY_CODES.get((value_type, value))
+                if code is None:
+                    return None
+                value_format.append('B')
+                values.append(code)
+            elif value_type is int or value_type is long:
+                value_format.append('q')
+                values.append(value)
+            elif value_type is float or value is None:
+                floats[i >> 3] |= 1 << (i & 7)
+                value_format.append('d')
+                values.append(_NAN if value is None else value)
+            else:
+                return None
+
+        flags = 0
+        if echo is not None:
+            flags |= FLAG_ECHO
+            value_format.insert(0, 'd')
+            values.insert(0, echo)
+
+        try:
+            return struct.pack(self.header_format + ''.join(value_format),
+                               FRAME_VERSION, flags, len(self.channels), str(present), str(floats), *values)
+        except struct.error:
+            # integer out of range
+            return None
+
+    def decode(self, frame):
+        """
+        Returns (reads, writes, echo) of a binary frame, echo is None if the frame has none
+        """
+        try:
+            version, flags, count, present, floats = struct.unpack_from(self.header_format, frame)
+        except struct.error, e:
+            raise FrameFormatError('short frame, %s' % e)
+        if version != FRAME_VERSION or count != len(self.channels):
+            raise FrameFormatError('frame version %s with %s channels, expected version %s with %s' %
+                                   (version, count, FRAME_VERSION, len(self.channels)))
+
+        present = bytearray(present)
+        floats = bytearray(floats)
+        channels = []
+        value_format = []
+        if flags & FLAG_ECHO:
+            value_format.append('d')
+        binary = self.binary
+        for byte in xrange(self.bitmap_size):
+            bits = present[byte]
+            if not bits:
+                continue
+            for bit in xrange(8):
+                if bits & (1 << bit):
+                    i = (byte << 3) | bit
+                    if i >= count:
+                        # padding bits of the last byte
+                        raise FrameFormatError('channel %d present, frame has %d channels' % (i, count))
+                    channels.append(i)
+                    if binary[i]:
+                        value_format.append('B')
+                    elif floats[byte] & (1 << bit):
+                        value_format.append('d')
+                    else:
+                        value_format.append('q')
+
+        try:
+            values = struct.unpack_from('<' + ''.join(value_format), frame, self.header_size)
+        except struct.error, e:
+            raise FrameFormatError('truncated frame, %s' % e)
+
+        echo = None
+        if flags & FLAG_ECHO:
+            echo = values[0]
+            values = values[1:]
+
+        reads = {}
+        writes = {}
+        table = self.channels
+        for i, value in izip(channels, values):
+            is_write, key, io_type = table[i]
+            if binary[i]:
+                try:
+                    value = BINARY_VALUES[value]
+                except IndexError:
+                    raise FrameFormatError('unknown binary value %s for %s' % (value, key))
+            elif value != value:
+                # NaN
+                value = None
+            if is_write:
+                writes[key] = value
+            else:
+                reads[key] = value
+
+        return reads, writes, echo
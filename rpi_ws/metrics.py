@@ -0,0 +1,205 @@
+"""
+Hot path counters and their Prometheus text exposition.
+
+Counters are plain int attributes on the objects they count and
+histograms keep a fixed list of bucket counts, nothing is allocated per
+sample. Gauges are read from live objects when metrics are scraped.
+RPIs report their histograms upstream as summary() windows the server
+merges into its own.
+"""
+from bisect import bisect_left
+from time import time
+
+from twisted.internet import reactor
+
+__author__ = 'kenny'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# upper bounds in users
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    """
+    Cumulative on exposition, counts[i] holds observations up to bounds[i], the last one past every bound
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        for i in xrange(len(self.counts)):
+            self.counts[i] = 0
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def summary(self):
+        """
+        Compact form for the wire, {'counts': bucket counts without trailing zeros, 'sum', 'max'}
+        """
+        counts = list(self.counts)
+        while counts and not counts[-1]:
+            counts.pop()
+        return {'counts': counts, 'sum': self.sum, 'max': self.max}
+
+    def merge(self, summary):
+        """
+        Adds a summary() of a histogram with the same bounds
+        """
+        counts = summary['counts']
+        if len(counts) > len(self.counts):
+            raise ValueError('%d buckets, %d expected' % (len(counts), len(self.counts)))
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.count += sum(counts)
+        self.sum += summary['sum']
+        self.max = max(self.max, summary['max'])
+
+    def buckets(self):
+        """
+        [(upper bound, cumulative count), ...], +Inf last
+        """
+        ret = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+
+class IOTimings(object):
+    """
+    Hardware calls of one channel, seconds from the call to its result or
+    failure (timeouts included) and calls refused while one was still running
+    """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.busy = 0
+        # slowest call of the last merged window
+        self.last_max = 0.0
+
+    def reset(self):
+        self.latency.reset()
+        self.errors = 0
+        self.busy = 0
+
+    def summary(self):
+        summary = self.latency.summary()
+        summary['errors'] = self.errors
+        summary['busy'] = self.busy
+        return summary
+
+    def merge(self, summary):
+        self.latency.merge(summary)
+        self.errors += summary['errors']
+        self.busy += summary['busy']
+        self.last_max = summary['max']
+
+
+class ReactorLag(object):
+    """
+    How late a call scheduled every interval runs, how long the reactor was
+    busy before it could get to it
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.histogram = Histogram()
+        self.last = 0.0
+        self.expected = None
+        self.call = None
+
+    def start(self):
+        self.expected = time() + self.interval
+        self.call = reactor.callLater(self.interval, self.tick)
+
+    def tick(self):
+        now = time()
+        self.last = max(0.0, now - self.expected)
+        self.histogram.observe(self.last)
+        self.expected = now + self.interval
+        self.call = reactor.callLater(self.interval, self.tick)
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in sorted(labels.iteritems()))
+
+
+def _value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Exposition(object):
+    """
+    Builds a scrape, every family declared once before its samples
+    """
+
+    def __init__(self, prefix='rpi_ws_'):
+        self.prefix = prefix
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        name = self.prefix + name
+        self.lines.append('# HELP %s %s' % (name, help_text))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+
+    def sample(self, name, value, labels=None):
+        self.lines.append('%s%s%s %s' % (self.prefix, name, _labels(labels), _value(value)))
+
+    def histogram(self, name, histogram, labels=None):
+        labels = dict(labels or {})
+        for bound, count in histogram.buckets():
+            labels['le'] = _value(bound)
+            self.sample(name + '_bucket', count, labels)
+        del labels['le']
+        self.sample(name + '_sum', histogram.sum, labels)
+        self.sample(name + '_count', histogram.count, labels)
+
+    def stats(self, name, kinds, help_texts, rows):
+        """
+        Families from stats() dicts, rows are [(labels, stats dict or None), ...],
+        kinds and help_texts are keyed by stats key, counters get _total
+        """
+        for key in sorted(kinds):
+            family = '%s_%s' % (name, key)
+            if kinds[key] == 'counter':
+                family += '_total'
+            self.family(family, kinds[key], help_texts[key])
+            for labels, stats in rows:
+                if stats is not None:
+                    self.sample(family, stats[key], labels)
+
+    def text(self):
+        return (u'\n'.join(self.lines) + u'\n').encode('utf-8')
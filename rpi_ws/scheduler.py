@@ -0,0 +1,87 @@
+import heapq
+import itertools
+from twisted.internet import reactor
+
+import settings
+
+__author__ = 'kenny'
+
+
+class SampleScheduler(object):
+    """
+    Calls callback(items) with every item that is due, each item is due once per its own period.
+    Items due within `coalesce` seconds of each other are handed over in the same call.
+    Nothing is scheduled between due times, so an idle scheduler costs no CPU.
+    """
+
+    def __init__(self, callback, clock=reactor, coalesce=None):
+        if coalesce is None:
+            coalesce = settings.SAMPLE_COALESCE
+        self.callback = callback
+        self.clock = clock
+        self.coalesce = coalesce
+        # item: period in seconds
+        self.periods = {}
+        # (due time, sequence, item)
+        self.heap = []
+        self.sequence = itertools.count()
+        self.call = None
+        self.running = False
+
+    def add(self, item, period):
+        period = max(period, settings.MIN_SAMPLE_PERIOD)
+        self.periods[item] = period
+        if self.running:
+            heapq.heappush(self.heap, (self.clock.seconds(), next(self.sequence), item))
+            self._reschedule()
+
+    def start(self):
+        """
+        Starts scheduling, every item is due immediately
+        """
+        if self.running:
+            return
+        self.running = True
+        now = self.clock.seconds()
+        self.heap = [(now, next(self.sequence), item) for item in self.periods]
+        heapq.heapify(self.heap)
+        self._reschedule()
+
+    def stop(self):
+        self.running = False
+        self.heap = []
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def _reschedule(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if not self.running or not self.heap:
+            return
+        delay = max(0, self.heap[0][0] - self.clock.seconds())
+        self.call = self.clock.callLater(delay, self._tick)
+
+    def _tick(self):
+        self.call = None
+        now = self.clock.seconds()
+        horizon = now + self.coalesce
+
+        due = []
+        while self.heap and self.heap[0][0] <= horizon:
+            due.append(heapq.heappop(self.heap))
+
+        for due_time, sequence, item in due:
+            next_time = due_time + self.periods[item]
+            if next_time <= now:
+                # fell behind, skip the missed samples instead of bursting
+                next_time = now + self.periods[item]
+            heapq.heappush(self.heap, (next_time, sequence, item))
+
+        if due:
+            self.callback([item for due_time, sequence, item in due])
+
+        # callback may have stopped the scheduler
+        if self.running and self.call is None:
+            self._reschedule()
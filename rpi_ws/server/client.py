@@ -1,8 +1,8 @@
 import json
-from twisted.internet import reactor
 from twisted.python import log
-from rpi_ws import common_protocol, buffer
+from rpi_ws import common_protocol, flow, framing, metrics, settings
 from rpi_ws.server.state import RPIRegisterState, RPIStreamState, RPIConfigState
+from rpi_ws.server import equation
 
 __author__ = 'kenny'
 
@@ -13,10 +13,13 @@ class Client(common_protocol.ProtocolState):
 
         self.protocol = protocol
 
-    def onMessage(self, msg):
+    def onMessage(self, msg, binary=False):
         try:
             state = self.state_stack.pop_wr()
-            state.onMessage(msg)
+            if binary:
+                state.onBinaryMessage(msg)
+            else:
+                state.onMessage(msg)
         except IndexError, e:
             if self.protocol.factory.debug:
                 log.err("%s.onMessage - Received a message in an unknown state, ignored %s" % (self.__class__.__name__, e))
@@ -28,56 +31,289 @@ class Client(common_protocol.ProtocolState):
         pass
 
 
+class Subscription(object):
+    """
+    One RPI streamed to a user that subscribed to several with SUBSCRIBE_RPIS
+    """
+
+    def __init__(self, rpi):
+        self.rpi = rpi
+        # version of the RPI data the user has been sent up to
+        self.data_version = 0
+        # True while the user has every broadcast of the RPI, else it catches up with a diff
+        self.synced = False
+        # (encoded part, data version) of a broadcast waiting for the next send cycle
+        self.pending = None
+
+
 class UserClient(Client):
     def __init__(self, protocol):
         super(UserClient, self).__init__(protocol)
         self.associated_rpi = None
-        self.streaming_buffer_read = None
-        self.streaming_buffer_write = None
-        self.ackcount = 0
+        # version of the RPI data this user has been sent up to
+        self.data_version = 0
+        # data frames in flight, browsers that don't grant a window get an estimated one
+        self.flow = flow.FlowSender()
         self.paused = True
+        # True while this user has every broadcast frame of the associated RPI,
+        # users out of sync catch up with an individual diff
+        self.synced = False
+        # True once SUBSCRIBE_RPIS was sent, RPIs are then streamed through
+        # subscriptions in RPI_DATA frames instead of associated_rpi
+        self.multiplexed = False
+        # mac: Subscription of the online RPIs subscribed to
+        self.subscriptions = {}
+        # frames carry eq IDs instead of names, asked for on CONNECT_RPI
+        self.channel_ids = False
+        # seconds of history sent before streaming, asked for on CONNECT_RPI
+        self.history = settings.HISTORY_BACKFILL
+        # seconds between AGGREGATE_DATA frames instead of every change, None for every change
+        self.update_period = None
+        # macs of the last CONNECT_RPI or SUBSCRIBE_RPIS, online or not
+        self.rpi_macs = frozenset()
+        # macs from RPI_WATCH, None for every RPI (clients that never sent one)
+        self.watched = None
+        # macs the factory indexes this user under, None for every RPI, see RPISocketServerFactory.set_rpi_interest
+        self.interest = frozenset()
+        # mac: latest state of RPIs not sent yet, see send_rpi_states
+        self.pending_rpi_states = {}
+
+    def rpi_interest(self):
+        """
+        macs whose state changes this user gets, None for every RPI
+        """
+        if self.watched is None:
+            return None
+        return frozenset(self.watched) | self.rpi_macs
+
+    def streams(self, rpi):
+        """
+        True if this user is streaming rpi
+        """
+        if self.associated_rpi is rpi:
+            return True
+        subscription = self.subscriptions.get(rpi.mac)
+        return subscription is not None and subscription.rpi is rpi
+
+    def streamed_rpis(self):
+        if self.multiplexed:
+            return [subscription.rpi for subscription in self.subscriptions.itervalues()]
+        if self.associated_rpi is not None:
+            return [self.associated_rpi]
+        return []
+
+    def set_options(self, msg):
+        """
+        Streaming options of CONNECT_RPI and SUBSCRIBE_RPIS
+        """
+        self.channel_ids = bool(msg.get('channel_ids', False))
+        self.history = float(msg.get('history', settings.HISTORY_BACKFILL))
+        # updates per second, None or 0 for every change
+        max_rate = msg.get('max_rate')
+        self.update_period = 1.0 / float(max_rate) if max_rate else None
+        if self.protocol.compressor is None:
+            # browsers offering deflate get binary messages from now on, see compression
+            options = self.protocol.factory.user_compression
+            if options.choose(msg.get('compression')) is not None:
+                self.protocol.start_compression(options)
 
     def register_to_rpi(self, rpi_mac):
+        self.unsubscribe_rpis()
+        self.rpi_macs = frozenset([rpi_mac])
+        self.protocol.factory.set_rpi_interest(self, self.rpi_interest())
         # notify factory we want to unregister if registered first
-        self.ackcount = 0
+        self.flow = flow.FlowSender()
         if self.associated_rpi is not None:
             self.protocol.factory.unregister_user_to_rpi(self, self.associated_rpi)
         rpi = self.protocol.factory.get_rpi(rpi_mac)
         if rpi:
-            self.streaming_buffer_read = buffer.UpdateDict()
-            self.streaming_buffer_write = buffer.UpdateDict()
+            self.data_version = 0
             self.associated_rpi = rpi
             self.protocol.factory.register_user_to_rpi(self, self.associated_rpi)
+            # an RPI that isn't streaming yet sends its table once it does
+            self.send_symbol_table(rpi)
+            self.send_history(rpi)
+            self.subscribe_aggregates(rpi)
             # begin streaming
             self.resume_streaming()
 
+    def subscribe_rpis(self, rpi_macs):
+        """
+        Streams every RPI of rpi_macs on this connection, RPIs that are
+        still subscribed to keep their place in the stream
+        """
+        factory = self.protocol.factory
+        if self.associated_rpi is not None:
+            factory.unregister_user_to_rpi(self, self.associated_rpi)
+        if not self.multiplexed:
+            self.flow = flow.FlowSender()
+            self.multiplexed = True
+        self.rpi_macs = frozenset(rpi_macs)
+        factory.set_rpi_interest(self, self.rpi_interest())
+        self.refresh_subscriptions()
+
+    def refresh_subscriptions(self):
+        """
+        Subscribes to the RPIs of rpi_macs that are online, drops the ones that went away
+        """
+        factory = self.protocol.factory
+        for mac, subscription in self.subscriptions.items():
+            if mac not in self.rpi_macs or factory.get_rpi(mac) is not subscription.rpi:
+                del self.subscriptions[mac]
+                factory.remove_user_from_rpi(self, subscription.rpi)
+        for mac in self.rpi_macs:
+            rpi = factory.get_rpi(mac)
+            if rpi and mac not in self.subscriptions:
+                self.subscriptions[mac] = Subscription(rpi)
+                factory.register_user_to_rpi(self, rpi)
+                self.send_symbol_table(rpi)
+                self.send_history(rpi)
+                self.subscribe_aggregates(rpi)
+        self.resume_streaming()
+
+    def unsubscribe_rpis(self):
+        for subscription in self.subscriptions.itervalues():
+            self.protocol.factory.remove_user_from_rpi(self, subscription.rpi)
+        self.subscriptions = {}
+        self.multiplexed = False
+
+    def send_symbol_table(self, rpi):
+        if not self.channel_ids:
+            return
+        table = rpi.symbol_table()
+        if table is None:
+            return
+        msg = {'cmd': common_protocol.ServerCommands.RPI_CHANNELS,
+               'rpi_mac': rpi.mac,
+               'read': table['read'],
+               'write': table['write']}
+        self.protocol.sendMessage(json.dumps(msg))
+
+    def send_history(self, rpi):
+        if not self.history:
+            return
+        msg = rpi.history_message(self.history, self.channel_ids)
+        if msg is not None:
+            self.protocol.sendMessage(json.dumps(msg))
+
+    def subscribe_aggregates(self, rpi):
+        if self.update_period:
+            rpi.subscribe_aggregates(self.update_period)
+
     def resume_streaming(self):
         self.paused = False
+        self.synced = False
+        for subscription in self.subscriptions.itervalues():
+            subscription.synced = False
         self.copy_and_send()
 
     def pause_streaming(self):
         self.paused = True
 
     def copy_and_send(self):
-        if self.ackcount <= -10 or self.paused:
+        """
+        Catch up, sends everything that changed since the data version this user has
+        """
+        if self.multiplexed:
+            self.send_subscriptions()
+            return
+        if not self.flow.can_send() or self.paused or self.synced:
             return
 
-        # copy buffers
-        self.protocol.factory.copy_rpi_buffers(self.associated_rpi,
-                                               self.streaming_buffer_read,
-                                               self.streaming_buffer_write)
+        changes = self.protocol.factory.copy_rpi_buffers(self.associated_rpi, self.data_version)
+        if changes is not None:
+            read_changes, write_changes, self.data_version = changes
+            if len(read_changes) > 0 or len(write_changes) > 0:
+                msg = self.associated_rpi.data_message(read_changes, write_changes, self.channel_ids)
+                self.flow.sent()
+                self.protocol.sendMessage(json.dumps(msg))
 
-        if len(self.streaming_buffer_read) > 0 or len(self.streaming_buffer_write) > 0:
-            msg = {'cmd': common_protocol.ServerCommands.WRITE_DATA,
-                   'read': self.streaming_buffer_read,
-                   'write': self.streaming_buffer_write}
-            self.ackcount -= 1
-            self.protocol.sendMessage(json.dumps(msg))
-            # keep polling until we run out of data
-            reactor.callLater(0, self.copy_and_send)
+        # following broadcast frames apply on top of this
+        self.synced = True
+
+    def send_broadcast(self, payload, prepared=None, data_version=None):
+        """
+        Sends a WRITE_DATA frame encoded once for every user of the RPI
+        """
+        if self.paused or self.update_period:
+            # rate limited users get the window's aggregates instead
+            return
+        if not self.synced or not self.flow.can_send():
+            # this frame is missed, catch up once acks come in
+            self.synced = False
+            return
+
+        if data_version is not None:
+            self.data_version = data_version
+        self.flow.sent()
+        if prepared is not None:
+            self.protocol.sendPreparedMessage(prepared)
         else:
-            # when there's new data resume will be called
-            self.pause_streaming()
+            self.protocol.sendMessage(payload)
+
+    def queue_broadcast(self, rpi, part, data_version):
+        """
+        Queues an RPI's broadcast, part encoded once for every subscribed user,
+        for the next send cycle
+        """
+        subscription = self.subscriptions.get(rpi.mac)
+        if self.paused or self.update_period or subscription is None or subscription.rpi is not rpi:
+            return
+        if subscription.pending is not None:
+            # two broadcasts in one cycle, a diff covers both
+            subscription.pending = None
+            subscription.synced = False
+        elif subscription.synced:
+            subscription.pending = (part, data_version)
+        self.protocol.factory.queue_send_cycle(self)
+
+    def send_subscriptions(self):
+        """
+        One RPI_DATA frame with what changed on every subscribed RPI: the
+        broadcasts queued since the last cycle and diffs for RPIs this user is
+        out of sync with. RPIs share one ack window.
+        """
+        if self.paused or not self.flow.can_send():
+            # queued broadcasts are missed, catch up once acks come in
+            for subscription in self.subscriptions.itervalues():
+                if subscription.pending is not None:
+                    subscription.pending = None
+                    subscription.synced = False
+            return
+
+        parts = []
+        for mac, subscription in self.subscriptions.iteritems():
+            part = None
+            if subscription.pending is not None:
+                part, subscription.data_version = subscription.pending
+                subscription.pending = None
+            elif not subscription.synced:
+                changes = self.protocol.factory.copy_rpi_buffers(subscription.rpi, subscription.data_version)
+                if changes is not None:
+                    read_changes, write_changes, subscription.data_version = changes
+                    if len(read_changes) > 0 or len(write_changes) > 0:
+                        part = subscription.rpi.data_part(read_changes, write_changes, self.channel_ids)
+                # following broadcasts apply on top of this
+                subscription.synced = True
+            if part is not None:
+                parts.append('%s: %s' % (json.dumps(mac), part))
+
+        if parts:
+            self.flow.sent()
+            self.protocol.sendMessage('{"cmd": "%s", "rpis": {%s}}' %
+                                      (common_protocol.ServerCommands.RPI_DATA, ', '.join(parts)))
+
+    def send_aggregates(self, payload):
+        """
+        Sends an AGGREGATE_DATA frame, a window missed while the ack window is full is dropped
+        """
+        if self.paused or not self.flow.can_send():
+            return
+        self.flow.sent()
+        self.protocol.sendMessage(payload)
+
+    def flow_stats(self):
+        return self.flow.stats()
 
     def unregister_to_rpi(self):
         self.pause_streaming()
@@ -86,14 +322,28 @@ class UserClient(Client):
 
     def notifyRPIState(self, rpi, state):
         if state == 'config':
-            if self.associated_rpi is not rpi:
+            if not self.streams(rpi):
                 return
         msg = {'cmd': common_protocol.ServerCommands.RPI_STATE_CHANGE,
                'rpi_mac': rpi.mac,
                'rpi_state': state}
         self.protocol.sendMessage(json.dumps(msg))
+        if state == 'stream' and self.streams(rpi):
+            # new config, new IDs
+            self.send_symbol_table(rpi)
+            self.subscribe_aggregates(rpi)
+
+    def send_rpi_states(self):
+        """
+        Sends the state changes queued since the last digest
+        """
+        msg = {'cmd': common_protocol.ServerCommands.RPI_STATE_DIGEST,
+               'rpi_states': self.pending_rpi_states}
+        self.pending_rpi_states = {}
+        self.protocol.sendMessage(json.dumps(msg))
 
-    def onMessage(self, msg):
+    def onMessage(self, msg, binary=False):
+        # users only speak JSON
         try:
             msg = json.loads(msg)
         except:
@@ -102,21 +352,33 @@ class UserClient(Client):
             self.protocol.failConnection()
 
         if msg['cmd'] == common_protocol.UserClientCommands.CONNECT_RPI:
-            mac = msg['rpi_mac']
-            self.register_to_rpi(mac)
+            self.set_options(msg)
+            self.register_to_rpi(msg['rpi_mac'])
+
+        elif msg['cmd'] == common_protocol.UserClientCommands.SUBSCRIBE_RPIS:
+            self.set_options(msg)
+            self.subscribe_rpis(msg['rpi_macs'])
 
         elif msg['cmd'] == common_protocol.UserClientCommands.ACK_DATA:
-            ackcount = msg['ack_count']
-            self.ackcount += ackcount
-            if self.ackcount > -10:
+            self.flow.acked(msg['ack_count'], msg.get('window'), msg.get('ts'))
+            if self.flow.can_send():
                 self.copy_and_send()
 
         elif msg['cmd'] == common_protocol.UserClientCommands.WRITE_DATA:
             port = msg['inter_face_port']
             value = msg['value']
-            if self.associated_rpi is not None:
+            if self.multiplexed:
+                # subscribed users say which RPI
+                subscription = self.subscriptions.get(msg.get('rpi_mac'))
+                if subscription is not None:
+                    subscription.rpi.write_interface_data(port, value)
+            elif self.associated_rpi is not None:
                 self.associated_rpi.write_interface_data(port, value)
 
+        elif msg['cmd'] == common_protocol.UserClientCommands.RPI_WATCH:
+            self.watched = frozenset(msg['rpi_macs'])
+            self.protocol.factory.set_rpi_interest(self, self.rpi_interest())
+
     def onClose(self, wasClean, code, reason):
         self.protocol.factory.disconnect_user(self)
 
@@ -127,6 +389,16 @@ class UserClient(Client):
 class RPIClient(Client):
     def __init__(self, protocol):
         super(RPIClient, self).__init__(protocol)
+        # DATA framing, negotiated at registration
+        self.framing = framing.FRAMING_JSON
+        # messages received while streaming and their size as received, after decompression
+        self.data_frames = 0
+        self.data_bytes = 0
+        # merged STATS reports, ('read' or 'write', key): metrics.IOTimings
+        self.io_timings = {}
+        self.reactor_lag = metrics.Histogram()
+        # bus number: I2CBus.stats() totals of the last STATS report
+        self.i2c_stats = {}
 
     def onClose(self, wasClean, code, reason):
         # if we're registered remove ourselves from active client list
@@ -136,21 +408,112 @@ class RPIClient(Client):
     def onOpen(self):
         self.push_state(RPIRegisterState(self))
 
-    def copy_buffers(self, read_buffer, write_buffer):
+    def copy_buffers(self, data_version):
+        """
+        Returns (read changes, write changes, version) after data_version,
+        None if the RPI isn't streaming
+        """
         try:
             state = self.current_state()
         except IndexError:
             # RPI has no states
-            return False
+            return None
+        if isinstance(state, RPIStreamState):
+            return state.changes_since(data_version)
+        return None
+
+    def symbol_table(self):
+        """
+        eq ID: name tables of the current config, None if the RPI isn't streaming
+        """
+        try:
+            state = self.current_state()
+        except IndexError:
+            # RPI has no states
+            return None
         if isinstance(state, RPIStreamState):
-            for key, value in state.read_data_buffer_eq.iteritems():
-                read_buffer[key] = value
-            for key, value in state.write_data_buffer_eq.iteritems():
-                write_buffer[key] = value
+            return state.symbol_table()
+        return None
+
+    def history_message(self, seconds, channel_ids):
+        """
+        RPI_HISTORY frame of the last seconds, None if the RPI isn't streaming or has no history
+        """
+        try:
+            state = self.current_state()
+        except IndexError:
+            # RPI has no states
+            return None
+        if isinstance(state, RPIStreamState):
+            return state.history_message(seconds, channel_ids)
+        return None
+
+    def subscribe_aggregates(self, period):
+        try:
+            state = self.current_state()
+        except IndexError:
+            # RPI has no states
+            return False
 
+        if isinstance(state, RPIStreamState):
+            state.subscribe_aggregates(period)
             return True
         return False
 
+    def data_message(self, read_changes, write_changes, channel_ids):
+        """
+        WRITE_DATA frame for users of changes from copy_buffers/broadcast_buffers
+        """
+        return self.current_state().data_message(read_changes, write_changes, channel_ids)
+
+    def data_part(self, read_changes, write_changes, channel_ids):
+        """
+        Encoded RPI_DATA entry of this RPI, data_message without the cmd
+        """
+        msg = self.data_message(read_changes, write_changes, channel_ids)
+        del msg['cmd']
+        return json.dumps(msg)
+
+    def broadcast_buffers(self):
+        """
+        Returns (read changes, write changes, version) since
+        the last broadcast, None if the RPI isn't streaming
+        """
+        try:
+            state = self.current_state()
+        except IndexError:
+            # RPI has no states
+            return None
+        if isinstance(state, RPIStreamState):
+            return state.broadcast_changes()
+        return None
+
+    def flow_stats(self):
+        """
+        Flow control stats of the DATA stream, None if the RPI isn't streaming
+        """
+        try:
+            state = self.current_state()
+        except IndexError:
+            # RPI has no states
+            return None
+        if isinstance(state, RPIStreamState):
+            return state.flow.stats()
+        return None
+
+    def merge_stats(self, msg):
+        """
+        Adds a STATS report to the totals
+        """
+        for op in ('read', 'write'):
+            for key, summary in msg['io'].get(op, {}).iteritems():
+                timings = self.io_timings.get((op, key))
+                if timings is None:
+                    timings = self.io_timings[(op, key)] = metrics.IOTimings()
+                timings.merge(summary)
+        self.reactor_lag.merge(msg['reactor_lag'])
+        self.i2c_stats = msg['i2c']
+
     def pause_streaming(self):
         try:
             state = self.current_state()
@@ -183,8 +546,7 @@ class RPIClient(Client):
             return False
 
         if isinstance(state, RPIStreamState):
-            state.write_interface_data(key, data)
-            return True
+            return state.write_interface_data(key, data)
         return False
 
     def config_io(self, reads, writes):
@@ -208,7 +570,12 @@ class RPIClient(Client):
             # RPI was waiting for config
             pass
         elif isinstance(state, RPIStreamState):
-            # RPI is being re-configured
+            # RPI is being re-configured, don't drop it for a config that will be rejected
+            try:
+                equation.compile_all([io['equation'] for io in reads + writes])
+            except equation.EquationError, e:
+                log.err('RPIClient.config_io - Config rejected, %s' % e)
+                return False
             state.drop_to_config(reads, writes)
             # config has to be delegated
             return True
@@ -0,0 +1,153 @@
+"""
+Downsampling of history scans for charts.
+
+Input is the (timestamps, values) chunks of HistoryStore.scan, output is
+(timestamp, value) points, generated as chunks come in. Only the samples
+of the bucket being reduced are kept (and the previous one's for lttb),
+a bucket holds every sample of its time span however many chunks it
+takes. Buckets split start to end in equal time, NaN values (None) are
+left out.
+
+    min_max  first min and max of every bucket in time order, keeps spikes
+    lttb     largest triangle three buckets, one point per bucket that best
+             keeps the shape of the line
+"""
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # python loops
+    numpy = None
+
+__author__ = 'kenny'
+
+
+def _concatenate(pieces):
+    if len(pieces) == 1:
+        return pieces[0]
+    if numpy is not None:
+        return numpy.concatenate(pieces)
+    ret = array('d')
+    for piece in pieces:
+        ret.extend(piece)
+    return ret
+
+
+def _split(timestamps, values, start, width, points):
+    """
+    Returns [(bucket, timestamps, values), ...] of one chunk, NaN values dropped
+    """
+    if numpy is not None:
+        keep = values == values
+        if not keep.all():
+            timestamps = timestamps[keep]
+            values = values[keep]
+        if not len(timestamps):
+            return []
+        indexes = numpy.clip(((timestamps - start) // width).astype(int), 0, points - 1)
+        edges = [0] + list(numpy.flatnonzero(numpy.diff(indexes)) + 1) + [len(indexes)]
+        return [(int(indexes[low]), timestamps[low:high], values[low:high])
+                for low, high in zip(edges[:-1], edges[1:])]
+
+    ret = []
+    for timestamp, value in zip(timestamps, values):
+        if value != value:
+            continue
+        bucket = min(points - 1, max(0, int((timestamp - start) // width)))
+        if not ret or ret[-1][0] != bucket:
+            ret.append((bucket, array('d'), array('d')))
+        ret[-1][1].append(timestamp)
+        ret[-1][2].append(value)
+    return ret
+
+
+def buckets(chunks, start, end, points):
+    """
+    Yields (timestamps, values) of every bucket holding samples, oldest first
+    """
+    width = float(end - start) / points
+    current = None
+    pieces = []
+    for timestamps, values in chunks:
+        for bucket, bucket_timestamps, bucket_values in _split(timestamps, values, start, width, points):
+            if bucket != current and pieces:
+                yield _concatenate([t for t, v in pieces]), _concatenate([v for t, v in pieces])
+                pieces = []
+            current = bucket
+            pieces.append((bucket_timestamps, bucket_values))
+    if pieces:
+        yield _concatenate([t for t, v in pieces]), _concatenate([v for t, v in pieces])
+
+
+def _argmin_max(values):
+    if numpy is not None:
+        return int(values.argmin()), int(values.argmax())
+    indexes = xrange(len(values))
+    return min(indexes, key=values.__getitem__), max(indexes, key=values.__getitem__)
+
+
+def min_max(chunks, start, end, points):
+    """
+    Yields up to 2 * points (timestamp, value)
+    """
+    for timestamps, values in buckets(chunks, start, end, points):
+        low, high = _argmin_max(values)
+        for i in sorted(set((low, high))):
+            yield float(timestamps[i]), float(values[i])
+
+
+def _largest_triangle(timestamps, values, a, c):
+    """
+    Index of the point forming the largest triangle with points a and c
+    """
+    at, av = a
+    ct, cv = c
+    if numpy is not None:
+        areas = numpy.abs((at - ct) * (values - av) - (at - timestamps) * (cv - av))
+        return int(areas.argmax())
+    return max(xrange(len(values)),
+               key=lambda i: abs((at - ct) * (values[i] - av) - (at - timestamps[i]) * (cv - av)))
+
+
+def _mean(column):
+    if numpy is not None:
+        return float(column.mean())
+    return sum(column) / len(column)
+
+
+def lttb(chunks, start, end, points):
+    """
+    Yields up to points + 2 (timestamp, value), the first and last samples included
+    """
+    selected = None
+    pending = None
+    for timestamps, values in buckets(chunks, start, end, points):
+        if selected is None:
+            # first sample as is
+            selected = (float(timestamps[0]), float(values[0]))
+            yield selected
+            timestamps = timestamps[1:]
+            values = values[1:]
+            if not len(timestamps):
+                continue
+        if pending is not None:
+            average = (_mean(timestamps), _mean(values))
+            i = _largest_triangle(pending[0], pending[1], selected, average)
+            selected = (float(pending[0][i]), float(pending[1][i]))
+            yield selected
+        pending = (timestamps, values)
+
+    if pending is not None:
+        # last sample as is, the rest of its bucket against it
+        last = (float(pending[0][-1]), float(pending[1][-1]))
+        if len(pending[0]) > 1:
+            i = _largest_triangle(pending[0][:-1], pending[1][:-1], selected, last)
+            yield float(pending[0][i]), float(pending[1][i])
+        yield last
+
+
+METHODS = {
+    'lttb': lttb,
+    'min_max': min_max,
+}
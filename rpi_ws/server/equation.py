@@ -0,0 +1,404 @@
+import ast
+import copy
+import math
+from collections import OrderedDict
+from itertools import izip
+from rpi_ws import settings
+
+try:
+    import numpy
+except ImportError:
+    # batches fall back to evaluating one value at a time
+    numpy = None
+
+__author__ = 'kenny'
+
+
+class EquationError(Exception):
+    pass
+
+
+# AST nodes an equation is allowed to contain, anything else is rejected
+# (attribute access, subscripts, lambdas, comprehensions...)
+_ALLOWED_NODE_NAMES = (
+    'Expression', 'Expr', 'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp',
+    'Call', 'Name', 'Load', 'Num', 'Constant', 'NameConstant',
+    'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow',
+    'LShift', 'RShift', 'BitOr', 'BitXor', 'BitAnd',
+    'UAdd', 'USub', 'Not', 'Invert', 'And', 'Or',
+    'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE',
+)
+ALLOWED_NODES = tuple(getattr(ast, name) for name in _ALLOWED_NODE_NAMES if hasattr(ast, name))
+
+# names an equation can reference besides the input value x
+EQUATION_NAMES = {
+    'abs': abs,
+    'min': min,
+    'max': max,
+    'round': round,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'sqrt': math.sqrt,
+    'exp': math.exp,
+    'log': math.log,
+    'log10': math.log10,
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'asin': math.asin,
+    'acos': math.acos,
+    'atan': math.atan,
+    'floor': math.floor,
+    'ceil': math.ceil,
+    'pi': math.pi,
+    'e': math.e,
+    'True': True,
+    'False': False,
+}
+
+INPUT_NAME = 'x'
+
+# subset of the whitelist that maps onto numpy array operations,
+# comparisons, conditionals and python casts have no elementwise equivalent
+_VECTOR_NODE_NAMES = (
+    'Expression', 'Expr', 'BinOp', 'UnaryOp', 'Call', 'Name', 'Load', 'Num', 'Constant',
+    'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow',
+    'LShift', 'RShift', 'BitOr', 'BitXor', 'BitAnd',
+    'UAdd', 'USub', 'Invert',
+)
+VECTOR_NODES = tuple(getattr(ast, name) for name in _VECTOR_NODE_NAMES if hasattr(ast, name))
+
+if numpy is not None:
+    VECTOR_NAMES = {
+        'abs': numpy.absolute,
+        'sqrt': numpy.sqrt,
+        'exp': numpy.exp,
+        'log': numpy.log,
+        'log10': numpy.log10,
+        'sin': numpy.sin,
+        'cos': numpy.cos,
+        'tan': numpy.tan,
+        'asin': numpy.arcsin,
+        'acos': numpy.arccos,
+        'atan': numpy.arctan,
+        'floor': numpy.floor,
+        'ceil': numpy.ceil,
+        'pi': math.pi,
+        'e': math.e,
+    }
+else:
+    VECTOR_NAMES = {}
+
+# value types a batch can be evaluated on as an array
+VECTOR_TYPES = (int, float, bool)
+
+# ** and << grow without bound and 9**9**9 would block the reactor,
+# exponents and shift counts not depending on x can't go past MAX_EXPONENT
+# and integer results past MAX_RESULT_BITS fail like any other runtime error
+MAX_EXPONENT = 256
+MAX_RESULT_BITS = 4096
+
+_INTEGER_TYPES = (int, long)
+
+
+def _pow(base, exponent):
+    if _is_object_array(base) or _is_object_array(exponent):
+        return _object_pow(base, exponent)
+    if isinstance(base, _INTEGER_TYPES) and isinstance(exponent, _INTEGER_TYPES) and exponent > 0 \
+            and (abs(base).bit_length() - 1) * exponent > MAX_RESULT_BITS:
+        raise OverflowError('power past %d bits' % MAX_RESULT_BITS)
+    return base ** exponent
+
+
+def _lshift(value, count):
+    if _is_object_array(value) or _is_object_array(count):
+        return _object_lshift(value, count)
+    if isinstance(value, _INTEGER_TYPES) and isinstance(count, _INTEGER_TYPES) \
+            and value and abs(value).bit_length() + count > MAX_RESULT_BITS:
+        raise OverflowError('shift past %d bits' % MAX_RESULT_BITS)
+    return value << count
+
+
+def _is_object_array(value):
+    return getattr(value, 'dtype', None) == object
+
+
+if numpy is not None:
+    # batches of ints are object arrays, every element goes through the guard
+    _object_pow = numpy.frompyfunc(_pow, 2, 1)
+    _object_lshift = numpy.frompyfunc(_lshift, 2, 1)
+
+
+# ** and << are compiled as calls to these so the bytecode
+# never holds a BINARY_POWER that the compiler could constant fold
+_GUARDED_NAMES = {'_pow': _pow, '_lshift': _lshift}
+
+
+class _GuardOperators(ast.NodeTransformer):
+    """
+    Rewrites a ** b to _pow(a, b) and a << b to _lshift(a, b)
+    """
+    FUNCTIONS = {ast.Pow: '_pow', ast.LShift: '_lshift'}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        name = self.FUNCTIONS.get(type(node.op))
+        if name is None:
+            return node
+        call = ast.Call(ast.Name(name, ast.Load()), [node.left, node.right], [], None, None)
+        return ast.copy_location(call, node)
+
+
+def _identity(x):
+    return x
+
+
+def validate(eq):
+    """
+    Parses eq and checks it against the whitelisted AST.
+    Returns the parsed expression, raises EquationError when it isn't allowed.
+    """
+    try:
+        tree = ast.parse(eq.strip(), mode='eval')
+    except SyntaxError, e:
+        raise EquationError("Equation '%s' is not valid: %s" % (eq, e))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise EquationError("Equation '%s' uses %s which is not allowed" % (eq, node.__class__.__name__))
+        if isinstance(node, ast.Name) and node.id != INPUT_NAME and node.id not in EQUATION_NAMES:
+            raise EquationError("Equation '%s' uses unknown name '%s'" % (eq, node.id))
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.keywords \
+                    or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+                raise EquationError("Equation '%s' has an unsupported function call" % eq)
+
+    # only once every node is known to be allowed
+    for node in ast.walk(tree):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Pow, ast.LShift)):
+            _check_exponent(eq, node.right)
+
+    return tree
+
+
+def _check_exponent(eq, node):
+    """
+    Evaluates an exponent or shift count that doesn't depend on x,
+    raises EquationError when it fails or is larger than MAX_EXPONENT
+    """
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and child.id == INPUT_NAME:
+            # bounded at runtime by MAX_RESULT_BITS
+            return
+
+    try:
+        value = _make_function(ast.Expression(copy.deepcopy(node)), EQUATION_NAMES)(None)
+        too_large = abs(value) > MAX_EXPONENT
+    except Exception, e:
+        raise EquationError("Equation '%s' is not valid: %s" % (eq, e))
+    if too_large:
+        raise EquationError("Equation '%s' has an exponent or shift count past %d" % (eq, MAX_EXPONENT))
+
+
+def compile_equation(eq):
+    """
+    Returns a function of x evaluating eq, an empty equation maps to identity.
+    Raises EquationError if eq fails validation.
+    """
+    if not eq or not eq.strip():
+        return _identity
+
+    return _make_function(validate(eq), EQUATION_NAMES)
+
+
+def compile_vector_equation(eq):
+    """
+    Returns a function evaluating eq on a numpy array of x values,
+    None if numpy is missing or eq can't be evaluated elementwise.
+    Raises EquationError if eq fails validation.
+    """
+    if numpy is None:
+        return None
+    if not eq or not eq.strip():
+        return _identity
+
+    tree = validate(eq)
+    for node in ast.walk(tree):
+        if not isinstance(node, VECTOR_NODES):
+            return None
+        if isinstance(node, ast.Name) and node.id != INPUT_NAME and node.id not in VECTOR_NAMES:
+            return None
+    return _make_function(tree, VECTOR_NAMES)
+
+
+def _make_function(tree, names):
+    """
+    Compiles the validated expression tree into lambda x: <expression>
+    """
+    body = _GuardOperators().visit(tree).body
+    args = ast.arguments([ast.Name(INPUT_NAME, ast.Param())], None, None, [])
+    expression = ast.fix_missing_locations(ast.Expression(ast.Lambda(args, body)))
+
+    namespace = dict(names)
+    namespace.update(_GUARDED_NAMES)
+    namespace['__builtins__'] = {}
+    return eval(compile(expression, '<eq>', 'eval'), namespace)
+
+
+def evaluate(func, value):
+    """
+    Applies a compiled equation, returns value unchanged if the equation fails
+    """
+    try:
+        return func(value)
+    except:
+        # runtime failure, ex) division by zero or a None value
+        return value
+
+
+class EquationCache(object):
+    """
+    Compiled equations keyed by expression text, least recently used are evicted
+    once max_size is reached
+    """
+
+    def __init__(self, max_size, compiler=compile_equation):
+        self.max_size = max_size
+        self.compiler = compiler
+        self.compiled = OrderedDict()
+
+    def get(self, eq):
+        try:
+            func = self.compiled.pop(eq)
+        except KeyError:
+            func = self.compiler(eq)
+            if len(self.compiled) >= self.max_size:
+                self.compiled.popitem(last=False)
+        self.compiled[eq] = func
+        return func
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def clear(self):
+        self.compiled.clear()
+
+
+equation_cache = EquationCache(settings.EQUATION_CACHE_SIZE)
+vector_equation_cache = EquationCache(settings.EQUATION_CACHE_SIZE, compiler=compile_vector_equation)
+
+
+def get_equation(eq):
+    return equation_cache.get(eq)
+
+
+def get_vector_equation(eq):
+    return vector_equation_cache.get(eq)
+
+
+def compile_all(equations):
+    """
+    Compiles every equation, raises EquationError on the first bad one
+    Returns dict of equation text to function
+    """
+    compiled = {}
+    for eq in equations:
+        if eq not in compiled:
+            compiled[eq] = get_equation(eq)
+    return compiled
+
+
+class EquationBatch(object):
+    """
+    Collects values from every channel of every RPI that needs an equation applied.
+    Values sharing an equation are evaluated together as one numpy array operation,
+    results are scattered back with target.update(zip(keys, results)).
+    """
+
+    def __init__(self, min_vector_size=None):
+        if min_vector_size is None:
+            min_vector_size = settings.EQUATION_BATCH_MIN_SIZE
+        self.min_vector_size = min_vector_size
+        # equation: [(values, target, keys), ...]
+        self.groups = {}
+
+    def add(self, eq, values, target, keys):
+        group = self.groups.get(eq)
+        if group is None:
+            group = self.groups[eq] = []
+        group.append((values, target, keys))
+
+    def __len__(self):
+        return len(self.groups)
+
+    def evaluate(self):
+        if numpy is not None:
+            # any error (x/0, sqrt(-1)...) re-runs the values one by one so
+            # the failing ones keep their raw value like evaluate_eq
+            with numpy.errstate(all='raise'):
+                self._evaluate()
+        else:
+            self._evaluate()
+
+    def _evaluate(self):
+        for eq, chunks in self.groups.iteritems():
+            if len(chunks) == 1:
+                values = chunks[0][0]
+            else:
+                values = [value for chunk_values, target, keys in chunks for value in chunk_values]
+
+            results = self.evaluate_values(eq, values)
+
+            offset = 0
+            for chunk_values, target, keys in chunks:
+                end = offset + len(chunk_values)
+                target.update(izip(keys, results[offset:end]))
+                offset = end
+
+        self.groups.clear()
+
+    def evaluate_values(self, eq, values):
+        value_types = set(map(type, values))
+        if len(value_types) > 1:
+            # mixed types, ex) int and float, are evaluated per type
+            # since 3 / 2 and 3.0 / 2 don't agree
+            results = [None] * len(values)
+            for value_type in value_types:
+                indexes = [i for i, value in enumerate(values) if type(value) is value_type]
+                type_results = self.evaluate_values(eq, [values[i] for i in indexes])
+                for i, result in izip(indexes, type_results):
+                    results[i] = result
+            return results
+
+        results = None
+        if len(values) >= self.min_vector_size and value_types.pop() in VECTOR_TYPES:
+            results = self._evaluate_vector(eq, values)
+        if results is None:
+            func = get_equation(eq)
+            results = [evaluate(func, value) for value in values]
+        return results
+
+    def _evaluate_vector(self, eq, values):
+        """
+        Returns list of results or None if the values have to be evaluated one by one
+        """
+        func = get_vector_equation(eq)
+        if func is None:
+            return None
+
+        if isinstance(values[0], float):
+            values_array = numpy.array(values, dtype=float)
+        else:
+            # ints and bools stay python objects, int64 would silently wrap
+            # on x**5 or x*10**12 where python goes on with longs
+            values_array = numpy.array(values, dtype=object)
+
+        try:
+            results = func(values_array)
+            if numpy.shape(results) != values_array.shape:
+                # constant equation, ex) '2'
+                results = numpy.resize(results, values_array.shape)
+            return results.tolist()
+        except:
+            return None
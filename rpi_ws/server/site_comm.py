@@ -1,14 +1,195 @@
+from collections import OrderedDict
+from cStringIO import StringIO
 import json
+import math
+import time
 from twisted.internet import reactor
-from twisted.python import log
-from twisted.web import resource
+from twisted.python import failure, log
+from twisted.web import resource, server
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
 import urllib
-import urllib2
-from rpi_ws import settings
+from rpi_ws import metrics, settings
+from rpi_ws.server import downsample
 
 __author__ = 'kenny'
 
 
+class SiteError(Exception):
+    pass
+
+
+class SiteNotifier(object):
+    """
+    RPI register/disconnect notifications to the site server, without blocking the reactor.
+
+    Events wait SITE_NOTIFY_DELAY for others, an RPI's events of the same kind
+    in a row collapse into the last one and the rest go out as one request per
+    kind, a list of payloads instead of one, over up to SITE_NOTIFY_CONNECTIONS
+    persistent connections. An RPI's events are sent in order, one at a time,
+    every callback of a collapsed event is called once it is sent.
+    Whatever comes in while connections are busy waits for the next free one.
+
+    Only a 2xx answer is a success. Failed requests and timeouts are retried
+    SITE_NOTIFY_RETRIES times, SITE_NOTIFY_RETRY_DELAY doubling every time,
+    before the next events of their RPIs. Callbacks are called after the
+    last attempt either way, the RPI did connect or disconnect.
+    """
+
+    def __init__(self, address=None):
+        self.address = address or settings.SITE_SERVER_ADDRESS
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = settings.SITE_NOTIFY_CONNECTIONS
+        self.agent = Agent(reactor, connectTimeout=settings.SITE_NOTIFY_TIMEOUT, pool=self.pool)
+
+        # mac: [[kind, payload, [(callback, rpi), ...]], ...], events of an RPI oldest first
+        self.pending = OrderedDict()
+        self.flush_call = None
+        self.in_flight = 0
+        # RPIs with an event being sent or waiting for a retry
+        self.in_flight_macs = set()
+        # (kind, batch, attempt) due for a retry, sent ahead of pending events
+        self.retrying = []
+        self.retry_calls = []
+
+        self.events = 0
+        self.coalesced = 0
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.given_up = 0
+
+    def notify(self, kind, payload, callback, rpi):
+        """
+        Queue a kind ('register', 'disconnect') notification, callback(rpi) once the site server answered
+        """
+        mac = payload['mac']
+        events = self.pending.setdefault(mac, [])
+        if events and events[-1][0] == kind:
+            # the site only needs the latest, every RPI object is still told
+            self.coalesced += 1
+            events[-1][1] = payload
+            events[-1][2].append((callback, rpi))
+        else:
+            events.append([kind, payload, [(callback, rpi)]])
+        self.events += 1
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(settings.SITE_NOTIFY_DELAY, self.flush)
+
+    def flush(self):
+        self.flush_call = None
+        while self.in_flight < settings.SITE_NOTIFY_CONNECTIONS:
+            if self.retrying:
+                self.post(*self.retrying.pop(0))
+                continue
+            kind, batch = self.take_batch()
+            if not batch:
+                return
+            self.post(kind, batch)
+
+    def take_batch(self):
+        """
+        Next event of every RPI not being sent, of the oldest one's kind
+        """
+        kind = None
+        batch = []
+        for mac, events in self.pending.items():
+            if mac in self.in_flight_macs:
+                continue
+            if kind is None:
+                kind = events[0][0]
+            elif events[0][0] != kind:
+                continue
+            batch.append(events.pop(0))
+            if not events:
+                del self.pending[mac]
+            self.in_flight_macs.add(mac)
+            if len(batch) >= settings.SITE_NOTIFY_BULK:
+                break
+        return kind, batch
+
+    def post(self, kind, batch, attempt=0):
+        if len(batch) == 1:
+            payload = batch[0][1]
+        else:
+            payload = [event[1] for event in batch]
+        body = urllib.urlencode({'json': json.dumps(payload)})
+
+        self.in_flight += 1
+        self.requests += 1
+        d = self.agent.request('POST', 'http://%s/ws_comm/%s/' % (self.address, kind),
+                               Headers({'Content-Type': ['application/x-www-form-urlencoded']}),
+                               FileBodyProducer(StringIO(body)))
+        timeout_call = reactor.callLater(settings.SITE_NOTIFY_TIMEOUT, d.cancel)
+        d.addCallback(self.response)
+        d.addBoth(self.done, timeout_call, kind, batch, attempt)
+
+    @staticmethod
+    def response(response):
+        # read to the end, the connection goes back to the pool
+        d = readBody(response)
+        if not 200 <= response.code < 300:
+            d.addCallback(SiteNotifier.bad_response, response.code)
+        return d
+
+    @staticmethod
+    def bad_response(body, code):
+        raise SiteError('HTTP %d, %s' % (code, body[:200]))
+
+    def done(self, result, timeout_call, kind, batch, attempt):
+        if timeout_call.active():
+            timeout_call.cancel()
+        self.in_flight -= 1
+        if isinstance(result, failure.Failure):
+            self.failures += 1
+            if attempt < settings.SITE_NOTIFY_RETRIES:
+                self.retries += 1
+                delay = settings.SITE_NOTIFY_RETRY_DELAY * 2 ** attempt
+                log.err('SiteNotifier - %s of %d rpi failed, retry in %gs, %s' %
+                        (kind, len(batch), delay, result.getErrorMessage()))
+                self.retry_calls.append(reactor.callLater(delay, self.retry, kind, batch, attempt + 1))
+                self.flush_next()
+                return
+            self.given_up += 1
+            log.err('SiteNotifier - %s of %d rpi failed %d times, given up, %s' %
+                    (kind, len(batch), attempt + 1, result.getErrorMessage()))
+
+        for kind, payload, callbacks in batch:
+            self.in_flight_macs.discard(payload['mac'])
+            for callback, rpi in callbacks:
+                callback(rpi)
+        self.flush_next()
+
+    def retry(self, kind, batch, attempt):
+        self.retry_calls = [call for call in self.retry_calls if call.active()]
+        self.retrying.append((kind, batch, attempt))
+        self.flush_next()
+
+    def flush_next(self):
+        if (self.pending or self.retrying) and self.flush_call is None:
+            self.flush()
+
+    def stats(self):
+        return {'events': self.events,
+                'coalesced': self.coalesced,
+                'requests': self.requests,
+                'failures': self.failures,
+                'retries': self.retries,
+                'given_up': self.given_up,
+                'pending': sum(len(events) for events in self.pending.itervalues()),
+                'in_flight': self.in_flight}
+
+    def close(self):
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+            self.flush_call = None
+        for call in self.retry_calls:
+            if call.active():
+                call.cancel()
+        self.retry_calls = []
+        return self.pool.closeCachedConnections()
+
+
 class SiteComm(resource.Resource):
     """
     To handle requests from the website
@@ -19,11 +200,155 @@ class SiteComm(resource.Resource):
         resource.Resource.__init__(self, *args, **kwargs)
 
         self.ws_factory = ws_factory
+        # query key: encoded response, least recently used first
+        self.history_cache = OrderedDict()
+        self.notifier = SiteNotifier()
 
     def render_GET(self, request):
+        if request.postpath and request.postpath[0] == 'history':
+            return self.render_history(request)
+        if request.postpath and request.postpath[0] == 'metrics':
+            return self.render_metrics(request)
         request.setHeader("Content-Type", "application/json")
         return "%s" % (str(self.ws_factory.rpi_clients),)
 
+    def render_metrics(self, request):
+        """
+        GET /metrics, Prometheus text format
+        """
+        request.setHeader("Content-Type", metrics.CONTENT_TYPE)
+        out = metrics.Exposition()
+        self.ws_factory.metrics(out)
+        out.family('history_query_cache_entries', 'gauge', 'Cached /history responses')
+        out.sample('history_query_cache_entries', len(self.history_cache))
+        out.stats('site_notify',
+                  {'events': 'counter', 'coalesced': 'counter', 'requests': 'counter', 'failures': 'counter',
+                   'retries': 'counter', 'given_up': 'counter', 'pending': 'gauge', 'in_flight': 'gauge'},
+                  {'events': 'RPI register/disconnect events',
+                   'coalesced': 'Events collapsed into a later one of the same RPI and kind',
+                   'requests': 'Requests to the site server',
+                   'failures': 'Failed, timed out or non 2xx requests',
+                   'retries': 'Failed requests sent again',
+                   'given_up': 'Requests that failed SITE_NOTIFY_RETRIES + 1 times',
+                   'pending': 'Events waiting to be sent',
+                   'in_flight': 'Requests waiting on the site server'},
+                  [(None, self.notifier.stats())])
+        return out.text()
+
+    @staticmethod
+    def error(request, code, message):
+        request.setResponseCode(code)
+        return json.dumps({'error': message})
+
+    def render_history(self, request):
+        """
+        GET /history?mac=&channel=&start=&end=&points=&method=
+        range=seconds before now instead of start/end, method is lttb or min_max.
+        Streams {"mac", "channel", "start", "end", "method", "points": [[timestamp, value], ...]}
+        """
+        request.setHeader("Content-Type", "application/json")
+        if self.ws_factory.store is None:
+            return self.error(request, 503, 'history store disabled')
+        try:
+            query = self.parse_history_query(request.args)
+        except KeyError, e:
+            return self.error(request, 400, 'bad query, missing %s' % e.args[0])
+        except ValueError, e:
+            return self.error(request, 400, 'bad query, %s' % e)
+
+        body = self.history_cache.pop(query['key'], None)
+        if body is not None:
+            self.history_cache[query['key']] = body
+            return body
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        # scans block on the store's writer
+        reactor.callInThread(self.stream_history, request, query, finished)
+        return server.NOT_DONE_YET
+
+    @staticmethod
+    def parse_history_query(args):
+        points = int(args.get('points', [settings.HISTORY_QUERY_POINTS])[0])
+        points = min(points, settings.HISTORY_QUERY_MAX_POINTS)
+        if points < 1:
+            raise ValueError('points < 1')
+        method = args.get('method', ['lttb'])[0]
+        if method not in downsample.METHODS:
+            raise ValueError('unknown method %s' % method)
+
+        now = time.time()
+        if 'range' in args:
+            span = float(args['range'][0])
+            if span <= 0:
+                raise ValueError('range <= 0')
+            # end on a point so repeated queries are the same until the next one
+            width = span / points
+            end = math.ceil(now / width) * width
+            start = end - span
+            cacheable = True
+        else:
+            start = float(args['start'][0])
+            end = float(args['end'][0]) if 'end' in args else now
+            # no new samples can come
+            cacheable = end < now
+            if end <= start:
+                raise ValueError('end <= start')
+
+        mac = args['mac'][0]
+        channel = args['channel'][0].decode('utf-8')
+        key = (mac, channel, start, end, points, method) if cacheable else None
+        return {'mac': mac, 'channel': channel, 'start': start, 'end': end,
+                'points': points, 'method': method, 'key': key}
+
+    def stream_history(self, request, query, finished):
+        """
+        Runs in a thread, points are written as they are reduced. The store decodes one
+        segment at a time, what is held is that segment and the buckets being reduced
+        """
+        parts = []
+
+        def write(data):
+            if query['key'] is not None:
+                parts.append(data)
+            reactor.callFromThread(self.write_history, request, data, finished)
+
+        try:
+            write('{"mac": %s, "channel": %s, "start": %r, "end": %r, "method": %s, "points": [' %
+                  (json.dumps(query['mac']), json.dumps(query['channel']), query['start'], query['end'],
+                   json.dumps(query['method'])))
+            chunks = self.ws_factory.store.scan(query['mac'], query['channel'], query['start'], query['end'])
+            reduce_points = downsample.METHODS[query['method']]
+            batch = []
+            separator = ''
+            for point in reduce_points(chunks, query['start'], query['end'], query['points']):
+                if finished:
+                    # client went away
+                    return
+                batch.append('[%r, %r]' % point)
+                if len(batch) >= 1000:
+                    write(separator + ', '.join(batch))
+                    separator = ', '
+                    batch = []
+            write(separator + ', '.join(batch) + ']}')
+        except Exception, e:
+            log.err('SiteComm.stream_history - %s %s, %s' % (query['mac'], query['channel'], e))
+            parts = None
+        reactor.callFromThread(self.finish_history, request, query['key'], parts, finished)
+
+    @staticmethod
+    def write_history(request, data, finished):
+        if not finished:
+            request.write(data)
+
+    def finish_history(self, request, key, parts, finished):
+        if key is not None and parts is not None:
+            self.history_cache[key] = ''.join(parts)
+            while len(self.history_cache) > settings.HISTORY_QUERY_CACHE:
+                self.history_cache.popitem(last=False)
+        if not finished:
+            request.finish()
+
     def render_POST(self, request):
         # should be called to update configs by admin change
 
@@ -50,32 +375,8 @@ class SiteComm(resource.Resource):
         payload = {'mac': rpi.mac,
                    'ip': rpi.protocol.peer.host,
                    'inter_face': rpi.inter_face}
-
-        post_data = {'json': json.dumps(payload)}
-        post_data = urllib.urlencode(post_data)
-        try:
-            url = urllib2.Request('http://%s/ws_comm/register/' % settings.SITE_SERVER_ADDRESS, post_data)
-            url_response = urllib2.urlopen(url)
-            url_response.read()
-        except:
-            pass
-            # TODO: success validation
-
-        # notify users
-        reactor.callFromThread(self.ws_factory.register_rpi_wsite, rpi)
-        # register should return configs
+        # notify users once registered, register should return configs
+        self.notifier.notify('register', payload, self.ws_factory.register_rpi_wsite, rpi)
 
     def disconnect_rpi(self, rpi):
-        payload = {'mac': rpi.mac}
-
-        post_data = {'json': json.dumps(payload)}
-        post_data = urllib.urlencode(post_data)
-        try:
-            url = urllib2.Request('http://%s/ws_comm/disconnect/' % settings.SITE_SERVER_ADDRESS, post_data)
-            url_response = urllib2.urlopen(url)
-            url_response.read()
-        except:
-            pass
-
-        # notify users
-        reactor.callFromThread(self.ws_factory.disconnect_rpi_wsite, rpi)
\ No newline at end of file
+        self.notifier.notify('disconnect', {'mac': rpi.mac}, self.ws_factory.disconnect_rpi_wsite, rpi)
@@ -2,11 +2,14 @@ import binascii
 import hashlib
 from hashlib import sha1
 import hmac
+from itertools import izip
 import json
 import os
 import time
 from twisted.python import log
-from rpi_ws import common_protocol, settings
+from twisted.internet import reactor, task
+from rpi_ws import common_protocol, settings, buffer, flow, framing
+from rpi_ws.server import equation
 
 
 class ServerState(common_protocol.State):
@@ -21,6 +24,10 @@ class ServerState(common_protocol.State):
         if self.client.protocol.debug:
             log.msg("%s.deactivated()" % self.__class__.__name__)
 
+    def onBinaryMessage(self, msg):
+        if self.client.protocol.debug:
+            log.msg("%s.onBinaryMessage - Unexpected binary message, ignored" % self.__class__.__name__)
+
     def sendJsonMessage(self, msg):
         self.client.protocol.sendMessage(json.dumps(msg))
 
@@ -30,6 +37,8 @@ class RPIRegisterState(ServerState):
         super(RPIRegisterState, self).__init__(client)
         self.registered = False
         self.re_message_count = 0
+        # chosen from the RPI's offer, None for older RPIs
+        self.compression = None
 
     def onMessage(self, msg):
         if self.re_message_count == 0 and not self.registered:
@@ -37,6 +46,9 @@ class RPIRegisterState(ServerState):
             parsed = json.loads(msg)
             self.client.mac = parsed['mac']
             self.client.inter_face = parsed['inter_face']
+            # older RPIs don't offer framings and stay on JSON
+            self.client.framing = framing.choose_framing(parsed.get('framing'))
+            self.compression = self.client.protocol.factory.rpi_compression.choose(parsed.get('compression'))
             if self.client.protocol.debug:
                 log.msg("RPIClient.onMessage - Register Request from %s" % self.client.mac)
 
@@ -59,7 +71,12 @@ class RPIRegisterState(ServerState):
                 self.re_message_count = 0
                 if self.client.protocol.debug:
                     log.msg("RPIClient.onMessage - Successful registration")
-                self.sendJsonMessage({'cmd': common_protocol.ServerCommands.ACK})
+                self.sendJsonMessage({'cmd': common_protocol.ServerCommands.ACK,
+                                      'framing': self.client.framing,
+                                      'compression': self.compression})
+                if self.compression is not None:
+                    # the RPI compresses once it has the ACK, it goes out plain
+                    self.client.protocol.start_compression(self.client.protocol.factory.rpi_compression)
                 self.client.push_state(RPIConfigState(self.client))
                 # add to dictionary of clients in the factory
                 self.client.protocol.factory.register_rpi(self.client)
@@ -98,9 +115,11 @@ class RPIConfigState(ServerState):
         msg = json.loads(msg)
 
         if msg['cmd'] == common_protocol.RPIClientCommands.CONFIG_OK:
+            # older RPIs ignore the channel IDs and keep sending keys
             self.client.push_state(RPIStreamState(self.client,
                                                   reads=self.config_reads,
-                                                  writes=self.config_writes
+                                                  writes=self.config_writes,
+                                                  channel_ids=msg.get('channel_ids', False)
             ))
         elif msg['cmd'] == common_protocol.RPIClientCommands.CONFIG_FAIL:
             if self.client.protocol.debug:
@@ -113,6 +132,9 @@ class RPIConfigState(ServerState):
             'ch_port':  integer or boolean (check cls req)
             'equation': empty, or python style math
             'cls_name': class name as string, ex) 'ADC'
+            'sample_period': optional, seconds between samples on the RPI
+            'edge': optional, 'rising', 'falling' or 'both', push edges instead of sampling
+            'debounce': optional, ms between edges
 
         Returns True/False for success
         """
@@ -134,6 +156,7 @@ class RPIConfigState(ServerState):
                 cls_str = io['cls_name']
                 ch_port = io['ch_port']
                 equation = io['equation']
+                sample_period = io.get('sample_period')
 
                 key = 'cls:%s, port:%s' % (cls_str, ch_port)
                 if key not in instanced_io_dict:
@@ -148,10 +171,38 @@ class RPIConfigState(ServerState):
                     if equation not in equations:
                         equations.append(equation)
 
+                if sample_period:
+                    # the fastest display decides
+                    existing_period = instanced_io_dict[key].get('sample_period')
+                    if existing_period is None or sample_period < existing_period:
+                        instanced_io_dict[key]['sample_period'] = sample_period
+
+                for option in ('edge', 'debounce'):
+                    # the first display asking decides
+                    if io.get(option) and option not in instanced_io_dict[key]:
+                        instanced_io_dict[key][option] = io[option]
+
             return instanced_io_dict
 
-        self.config_reads = format_io(reads)
-        self.config_writes = format_io(writes)
+        config_reads = format_io(reads)
+        config_writes = format_io(writes)
+
+        # compile equations up front, a bad equation rejects the whole config
+        try:
+            for io in config_reads.values() + config_writes.values():
+                equation.compile_all(io['equations'])
+        except equation.EquationError, e:
+            log.err('RPIConfigState - Config rejected, %s' % e)
+            return False
+
+        # every channel gets a small integer ID, DATA and WRITE_DATA carry it instead of the key
+        ordered = [config_reads[key] for key in sorted(config_reads)] + \
+                  [config_writes[key] for key in sorted(config_writes)]
+        for channel_id, io in enumerate(ordered):
+            io['id'] = channel_id
+
+        self.config_reads = config_reads
+        self.config_writes = config_writes
 
         log.msg(self.config_reads)
         log.msg(self.config_writes)
@@ -163,6 +214,7 @@ class RPIConfigState(ServerState):
                'payload': {'read': self.config_reads, 'write': self.config_writes}}
 
         self.sendJsonMessage(msg)
+        return True
 
 
 class RPIStreamState(ServerState):
@@ -170,34 +222,365 @@ class RPIStreamState(ServerState):
     In this state the RPI has been configured and is streaming data
     """
 
-    def __init__(self, client, reads, writes):
+    def __init__(self, client, reads, writes, channel_ids=False):
         super(RPIStreamState, self).__init__(client)
-        # {'cls:ADC, port:3': {'cls_name':'ADC', 'ch_port':3, 'equations': ['zzzz', 'asdfadfad']}}
+        # {'cls:ADC, port:3': {'cls_name':'ADC', 'ch_port':3, 'equations': ['zzzz', 'asdfadfad'], 'id': 0}}
         self.config_reads = reads
         self.config_writes = writes
+        # DATA and WRITE_DATA exchanged with the RPI carry channel IDs instead of keys
+        self.channel_ids = channel_ids
+        # channel ID as decoded from DATA: config key
+        self.id_keys = {}
+        for key, io in reads.items() + writes.items():
+            if 'id' in io:
+                self.id_keys[unicode(io['id'])] = key
         self.read_data_buffer = {}
-        self.read_data_buffer_eq = {}
+        self.read_data_buffer_eq = buffer.VersionedDict()
         self.write_data_buffer = {}
-        self.write_data_buffer_eq = {}
+        self.write_data_buffer_eq = buffer.VersionedDict()
         self.write_data_eq_map = {}
-        self.datamsgcount_ack = 0
+        # grants the RPI its DATA window, acks go at half the window or FLOW_ACK_DELAY late
+        self.flow = flow.FlowReceiver()
+        self.ack_call = None
+
+        # equations were validated by the config state, these are cache hits
+        self.equations = {}
+        for io in reads.values() + writes.values():
+            self.equations.update(equation.compile_all(io['equations']))
+
+        # every equation output has an integer eq ID, the eq buffers are keyed by it
+        # eq ID: name, 'cls:%s, port:%s, eq:%s', sent to users once or used for users without IDs
+        self.eq_names = {}
+        # config key: [(eq, eq ID), ...]
+        self.read_eq_keys = self.format_eq_keys(reads)
+        self.write_eq_keys = self.format_eq_keys(writes)
+        # users write with either, IDs come back as the JSON object keys they were sent as
+        for key, eq_keys in self.write_eq_keys.iteritems():
+            for eq, eq_key in eq_keys:
+                self.write_data_eq_map[eq_key] = key
+                self.write_data_eq_map[unicode(eq_key)] = key
+                self.write_data_eq_map[self.eq_names[eq_key]] = key
+
+        # same mapping grouped by equation for batches
+        # eq: ((config key, ...), (eq ID, ...))
+        self.read_eq_groups = self.group_eq_keys(self.read_eq_keys)
+        self.write_eq_groups = self.group_eq_keys(self.write_eq_keys)
+
+        # raw values received since equations were last evaluated
+        self.pending_reads = {}
+        self.pending_writes = {}
+        # timestamped samples received since equations were last evaluated
+        # config key: [(timestamp, value), ...]
+        self.pending_read_series = {}
+        self.pending_write_series = {}
+
+        # every eq output's history, timestamped samples and values that changed
+        self.history = buffer.ChannelHistory(self.eq_names)
+        # cursor of the eq buffers for the history, values after it aren't recorded yet
+        self.history_version = buffer.version_clock.version
+        # receive time of the last DATA frame, values without a sample are recorded at it
+        self.received_time = time.time()
+        # seconds from the RPI clock to the server clock, see server_time
+        self.clock_offset = None
+        # outputs recorded from samples since the last record_history
+        self.sampled_eq_ids = set()
+        # windows of users with a max update rate, see subscribe_aggregates
+        self.aggregates = buffer.Aggregates(skip=self.sampled_eq_ids)
+        # period: LoopingCall sending the window
+        self.aggregate_calls = {}
+        self.write_eq_ids = set(eq_id for eq_keys in self.write_eq_keys.itervalues() for eq, eq_id in eq_keys)
+        # eq ID: on-disk history writer keyed by eq name, names outlive configs
+        self.store_writers = {}
+        store = self.client.protocol.factory.store
+        if store is not None:
+            self.store_writers = dict((eq_id, store.writer(self.client.mac, name))
+                                      for eq_id, name in self.eq_names.iteritems())
+        # batched write results, eq ID: calculated
+        self.write_calculated = {}
+
+        # version of the eq buffers as of the last broadcast to users
+        self.broadcast_version = buffer.version_clock.version
+
+        # binary DATA frames if negotiated at registration
+        self.codec = None
+        if self.client.framing == framing.FRAMING_BINARY:
+            # class name: IO_TYPE, from the interfaces the RPI registered
+            io_types = {}
+            for descs in self.client.inter_face.itervalues():
+                for desc in descs:
+                    io_types[desc['name']] = desc['io_type']
+            self.codec = framing.DataFrameCodec.from_config(
+                reads, writes, lambda key, io: io_types.get(io['cls_name'], framing.IO_TYPE_BINARY))
+
+    def format_eq_keys(self, config):
+        eq_keys = {}
+        for key in sorted(config):
+            io = config[key]
+            eq_keys[key] = []
+            for eq in io['equations']:
+                eq_id = len(self.eq_names)
+                self.eq_names[eq_id] = 'cls:%s, port:%s, eq:%s' % (io['cls_name'], io['ch_port'], eq)
+                eq_keys[key].append((eq, eq_id))
+        return eq_keys
+
+    def symbol_table(self):
+        """
+        eq ID: name of every equation output, for users receiving IDs
+        """
+        return {'read': dict((eq_id, self.eq_names[eq_id])
+                             for eq_keys in self.read_eq_keys.itervalues() for eq, eq_id in eq_keys),
+                'write': dict((eq_id, self.eq_names[eq_id])
+                              for eq_keys in self.write_eq_keys.itervalues() for eq, eq_id in eq_keys)}
+
+    def data_message(self, read_changes, write_changes, channel_ids):
+        """
+        WRITE_DATA frame for users, keyed by eq ID or by name for users without IDs
+        """
+        if not channel_ids:
+            names = self.eq_names
+            read_changes = dict((names[eq_id], value) for eq_id, value in read_changes.iteritems())
+            write_changes = dict((names[eq_id], value) for eq_id, value in write_changes.iteritems())
+        return {'cmd': common_protocol.ServerCommands.WRITE_DATA,
+                'read': read_changes,
+                'write': write_changes}
+
+    @staticmethod
+    def group_eq_keys(eq_keys):
+        groups = {}
+        for key, key_eq_keys in eq_keys.iteritems():
+            for eq, eq_key in key_eq_keys:
+                groups.setdefault(eq, []).append((key, eq_key))
+        for eq, key_pairs in groups.items():
+            groups[eq] = tuple(zip(*key_pairs))
+        return groups
 
     def evaluate_eq(self, eq, value):
-        if eq != '':
-            # TODO: fix security
-            x = value
-            try:
-                new_value = eval(eq)
-            except:
-                if self.client.protocol.debug:
-                    log.err('evaluate_eq error  eval')
-                new_value = value
+        try:
+            return self.equations[eq](value)
+        except:
+            # runtime failure, ex) division by zero or a None value
+            if self.client.protocol.debug:
+                log.err('evaluate_eq error %s' % eq)
+            return value
+
+    def evaluate_pending(self, batch=None):
+        """
+        Applies equations to the values received since the last call.
+        With a batch the values are queued on it per equation,
+        equations_evaluated has to be called once the batch was evaluated.
+        """
+        self.queue_series(self.pending_read_series, self.read_eq_keys, batch)
+        self.queue_series(self.pending_write_series, self.write_eq_keys, batch)
+
+        aggregates = self.aggregates
+        if batch is not None:
+            read_target = self.read_data_buffer_eq
+            if aggregates:
+                read_target = buffer.Tee(read_target, aggregates)
+            self.queue_pending(self.pending_reads, self.read_eq_groups, read_target, batch)
+            self.queue_pending(self.pending_writes, self.write_eq_groups, self.write_calculated, batch)
         else:
-            new_value = value
-        return new_value
+            for key, value in self.pending_reads.iteritems():
+                for eq, eq_key in self.read_eq_keys[key]:
+                    calculated = self.evaluate_eq(eq, value)
+                    self.read_data_buffer_eq[eq_key] = calculated
+                    if aggregates and eq_key not in self.sampled_eq_ids:
+                        aggregates.add(eq_key, calculated)
+
+            # equations for write interfaces are applied on the returned value
+            # input value to interfaces are unchanged
+            for key, value in self.pending_writes.iteritems():
+                for eq, eq_key in self.write_eq_keys[key]:
+                    calculated = self.evaluate_eq(eq, value)
+                    self.write_data_buffer_eq[eq_key] = {
+                        'calculated': calculated,
+                        'real': value,
+                    }
+                    if aggregates and eq_key not in self.sampled_eq_ids:
+                        aggregates.add(eq_key, calculated)
+            self.pending_writes.clear()
+            self.record_history()
+
+        self.pending_reads.clear()
+
+    @staticmethod
+    def queue_pending(pending, eq_groups, target, batch):
+        if not pending:
+            return
+        for eq, (keys, eq_keys) in eq_groups.iteritems():
+            try:
+                # usually every channel has a value
+                values = map(pending.__getitem__, keys)
+            except KeyError:
+                present = [(pending[key], eq_key) for key, eq_key in izip(keys, eq_keys) if key in pending]
+                if not present:
+                    continue
+                values, eq_keys = zip(*present)
+            if eq == '':
+                target.update(izip(eq_keys, values))
+            else:
+                batch.add(eq, values, target, eq_keys)
+
+    def queue_series(self, pending_series, eq_keys, batch=None):
+        """
+        Applies equations to every timestamped sample, results go to the history
+        """
+        for key, samples in pending_series.iteritems():
+            timestamps, values = zip(*samples)
+            for eq, eq_id in eq_keys[key]:
+                self.sampled_eq_ids.add(eq_id)
+                target = self.history[eq_id]
+                if self.store_writers or self.aggregates:
+                    targets = [target]
+                    if self.store_writers:
+                        targets.append(self.store_writers[eq_id])
+                    if self.aggregates:
+                        targets.append(self.aggregates.samples(eq_id))
+                    target = buffer.Tee(*targets)
+                if eq == '':
+                    target.update(samples)
+                elif batch is not None:
+                    batch.add(eq, values, target, timestamps)
+                else:
+                    target.update((timestamp, self.evaluate_eq(eq, value)) for timestamp, value in samples)
+        pending_series.clear()
+
+    def equations_evaluated(self):
+        """
+        Batch results are in, wrap write results with their real values
+        """
+        aggregates = self.aggregates
+        for eq_key, calculated in self.write_calculated.iteritems():
+            self.write_data_buffer_eq[eq_key] = {
+                'calculated': calculated,
+                'real': self.pending_writes[self.write_data_eq_map[eq_key]],
+            }
+            if aggregates and eq_key not in self.sampled_eq_ids:
+                aggregates.add(eq_key, calculated)
+        self.write_calculated.clear()
+        self.pending_writes.clear()
+        self.record_history()
+
+    def record_history(self):
+        """
+        Eq outputs that changed since the last call go to the history at the
+        frame's receive time, outputs that came with samples are in already
+        """
+        reads = self.read_data_buffer_eq.changed_since(self.history_version)
+        writes = self.write_data_buffer_eq.changed_since(self.history_version)
+        self.history_version = buffer.version_clock.version
+        sampled = self.sampled_eq_ids
+        items = [(eq_id, value) for eq_id, value in reads.iteritems() if eq_id not in sampled]
+        items.extend((eq_id, value['calculated']) for eq_id, value in writes.iteritems() if eq_id not in sampled)
+        sampled.clear()
+        self.history.record(self.received_time, items)
+        if self.store_writers:
+            for eq_id, value in items:
+                self.store_writers[eq_id].append(self.received_time, value)
+
+    def history_message(self, seconds, channel_ids):
+        """
+        RPI_HISTORY frame of the last seconds of every eq output, columns of
+        ms after t0 and values, keyed like data_message. NaN values are None.
+        """
+        since = time.time() - seconds
+        read_ids = [eq_id for eq_keys in self.read_eq_keys.itervalues() for eq, eq_id in eq_keys]
+        write_ids = [eq_id for eq_keys in self.write_eq_keys.itervalues() for eq, eq_id in eq_keys]
+        reads = self.history.window(since, read_ids)
+        writes = self.history.window(since, write_ids)
+        columns = reads.values() + writes.values()
+        if not columns:
+            return None
+        t0 = min(timestamps[0] for timestamps, values in columns)
+
+        def format_columns(data):
+            ret = {}
+            for eq_id, (timestamps, values) in data.iteritems():
+                if not channel_ids:
+                    eq_id = self.eq_names[eq_id]
+                ret[eq_id] = [[round((timestamp - t0) * 1000, 3) for timestamp in timestamps],
+                              [None if value != value else value for value in values]]
+            return ret
+
+        return {'cmd': common_protocol.ServerCommands.RPI_HISTORY,
+                'rpi_mac': self.client.mac,
+                't0': t0,
+                'read': format_columns(reads),
+                'write': format_columns(writes)}
+
+    def subscribe_aggregates(self, period):
+        """
+        Aggregates every eq output over windows of period seconds, sent to the users
+        with that update period until none is left
+        """
+        if period in self.aggregate_calls:
+            return
+        self.aggregates.add_window(period)
+        call = self.aggregate_calls[period] = task.LoopingCall(self.send_aggregates, period)
+        call.start(period, now=False)
+
+    def stop_aggregates(self, period):
+        self.aggregates.remove_window(period)
+        call = self.aggregate_calls.pop(period, None)
+        if call is not None and call.running:
+            call.stop()
+
+    def send_aggregates(self, period):
+        factory = self.client.protocol.factory
+        users = []
+        if factory.rpi_clients.get(self.client.mac) is self.client:
+            users = [user for user in factory.rpi_clients_registered_users[self.client.mac]
+                     if user.update_period == period]
+        if not users:
+            self.stop_aggregates(period)
+            return
+
+        window = self.aggregates.take(period)
+        if not window:
+            return
+        reads = {}
+        writes = {}
+        for eq_id, aggregate in window.iteritems():
+            if eq_id in self.write_eq_ids:
+                writes[eq_id] = aggregate
+            else:
+                reads[eq_id] = aggregate
+
+        # channel_ids: payload, one encoding per kind of user
+        payloads = {}
+        for user in users:
+            payload = payloads.get(user.channel_ids)
+            if payload is None:
+                msg = self.data_message(reads, writes, user.channel_ids)
+                msg['cmd'] = common_protocol.ServerCommands.AGGREGATE_DATA
+                msg['rpi_mac'] = self.client.mac
+                msg['window'] = period
+                payload = payloads[user.channel_ids] = json.dumps(msg)
+            user.send_aggregates(payload)
+
+    def changes_since(self, version):
+        """
+        Returns (read changes, write changes, version) of the eq buffers
+        after version, the returned version is the cursor for the next call
+        """
+        current_version = buffer.version_clock.version
+        return (self.read_data_buffer_eq.changed_since(version),
+                self.write_data_buffer_eq.changed_since(version),
+                current_version)
+
+    def broadcast_changes(self):
+        """
+        Returns changes_since the last broadcast and moves the broadcast cursor
+        """
+        changes = self.changes_since(self.broadcast_version)
+        self.broadcast_version = changes[2]
+        return changes
 
     def deactivated(self):
         super(RPIStreamState, self).deactivated()
+        self.cancel_ack()
+        for period in self.aggregate_calls.keys():
+            self.stop_aggregates(period)
         self.client.protocol.factory.notify_clients_rpi_state_change(self.client, state='drop_stream')
 
     def activated(self):
@@ -205,6 +588,7 @@ class RPIStreamState(ServerState):
         self.client.protocol.factory.notify_clients_rpi_state_change(self.client, state='stream')
 
     def onMessage(self, msg):
+        self.client.data_bytes += len(msg)
         msg = json.loads(msg)
 
         if msg['cmd'] == common_protocol.RPIClientCommands.DROP_TO_CONFIG_OK:
@@ -213,55 +597,143 @@ class RPIStreamState(ServerState):
             self.client.current_state().config_io(self.delegate_config_reads, self.delegate_config_writes)
 
         if msg['cmd'] == common_protocol.RPIClientCommands.DATA:
-            self.datamsgcount_ack += 1
+            start = time.time()
             read_data = msg['read']
             write_data = msg['write']
-            for key, value in read_data.iteritems():
-                self.read_data_buffer[key] = value
-                # perform equation operations here on values
-                # key: 'cls:%s, port:%d, eq:%s'
-                if key in self.config_reads:
-                    for eq in self.config_reads[key]['equations']:
-                        new_key = 'cls:%s, port:%s, eq:%s' % (
-                            self.config_reads[key]['cls_name'],
-                            self.config_reads[key]['ch_port'],
-                            eq,
-                        )
-                        self.read_data_buffer_eq[new_key] = self.evaluate_eq(eq, value)
-                else:
-                    # TODO: drop to config state or something, remote config seems to be invalid
-                    pass
+            samples = msg.get('samples')
+            read_samples = write_samples = None
+            if samples is not None:
+                t0 = self.server_time(start, samples['t0'], samples['read'], samples['write'])
+                read_samples = self.unpack_samples(t0, samples['read'])
+                write_samples = self.unpack_samples(t0, samples['write'])
+            if self.channel_ids:
+                read_data = self.from_ids(read_data)
+                write_data = self.from_ids(write_data)
+                if samples is not None:
+                    read_samples = self.from_ids(read_samples)
+                    write_samples = self.from_ids(write_samples)
+            self.data_received(read_data, write_data, read_samples, write_samples, msg.get('echo'))
+            self.flow.processed(time.time() - start)
+
+        elif msg['cmd'] == common_protocol.RPIClientCommands.STATS:
+            try:
+                self.client.merge_stats(msg)
+            except (KeyError, TypeError, ValueError), e:
+                log.err('RPIStreamState - Bad STATS from %s, %s' % (self.client.mac, e))
+
+    def server_time(self, now, t0, *series):
+        """
+        Maps t0 of the RPI clock onto the server clock, the history, store and
+        history windows are all server time. The offset is the smallest receive
+        time minus newest sample seen, so samples are never after they arrived.
+        """
+        newest = [samples[-1][0] for data in series for samples in data.itervalues() if samples]
+        if not newest:
+            return t0 + (self.clock_offset or 0)
+        offset = now - (t0 + max(newest) / 1000.0)
+        if self.clock_offset is None or offset < self.clock_offset \
+                or offset > self.clock_offset + settings.CLOCK_STEP:
+            self.clock_offset = offset
+        return t0 + self.clock_offset
+
+    @staticmethod
+    def unpack_samples(t0, data):
+        """
+        {key: [[ms after t0, value], ...]} to {key: [(timestamp, value), ...]}
+        """
+        return dict((key, [(t0 + offset / 1000.0, value) for offset, value in samples])
+                    for key, samples in data.iteritems() if samples)
+
+    def from_ids(self, data):
+        keys = self.id_keys
+        return dict((keys[channel_id], value) for channel_id, value in data.iteritems() if channel_id in keys)
+
+    def onBinaryMessage(self, msg):
+        if self.codec is None:
+            super(RPIStreamState, self).onBinaryMessage(msg)
+            return
+        self.client.data_bytes += len(msg)
+        start = time.time()
+        try:
+            read_data, write_data, echo = self.codec.decode(msg)
+        except framing.FrameFormatError, e:
+            log.err('RPIStreamState - Bad DATA frame from %s, %s' % (self.client.mac, e))
+            return
+        self.data_received(read_data, write_data, echo=echo)
+        self.flow.processed(time.time() - start)
+
+    def data_received(self, read_data, write_data, read_samples=None, write_samples=None, echo=None):
+        """
+        Raw values of one DATA frame, JSON or binary.
+        Timestamped samples go to the series, the newest one of each channel
+        is its latest value for users.
+        """
+        self.received_time = time.time()
+        self.client.data_frames += 1
+        self.flow.received(echo)
+        if self.flow.should_ack():
+            self.send_ack()
+        elif self.ack_call is None:
+            self.ack_call = reactor.callLater(settings.FLOW_ACK_DELAY, self.send_ack)
+        if read_samples:
+            self.series_received(read_samples, read_data, self.config_reads, self.pending_read_series)
+        if write_samples:
+            self.series_received(write_samples, write_data, self.config_writes, self.pending_write_series)
+        for key, value in read_data.iteritems():
+            self.read_data_buffer[key] = value
+            if key in self.config_reads:
+                self.pending_reads[key] = value
+            else:
+                # TODO: drop to config state or something, remote config seems to be invalid
+                pass
+
+        for key, value in write_data.iteritems():
+            self.write_data_buffer[key] = value
+            if key in self.config_writes:
+                self.pending_writes[key] = value
+            else:
+                # TODO: drop to config state or something, remote config seems to be invalid
+                pass
+
+        if settings.EQUATION_BATCH:
+            # the factory evaluates every RPI's equations together and
+            # notifies listening clients afterwards
+            self.client.protocol.factory.queue_equations(self)
+        else:
+            start = time.time()
+            self.evaluate_pending()
+            self.client.protocol.factory.equation_seconds.observe(time.time() - start)
             if self.client.protocol.debug:
                 log.msg('RPIStreamState - EQs: %s' % str(self.read_data_buffer_eq))
-
-            for key, value in write_data.iteritems():
-                # equations for write interfaces are applied on the returned value
-                # input value to interfaces are unchanged
-                self.write_data_buffer[key] = value
-                # key: 'cls:%s, port:%d, eq:%s'
-                if key in self.config_writes:
-                    for eq in self.config_writes[key]['equations']:
-                        new_key = 'cls:%s, port:%s, eq:%s' % (
-                            self.config_writes[key]['cls_name'],
-                            self.config_writes[key]['ch_port'],
-                            eq,
-                        )
-                        self.write_data_eq_map[new_key] = key
-                        self.write_data_buffer_eq[new_key] = {
-                            'calculated': self.evaluate_eq(eq, value),
-                            'real': value,
-                        }
-                else:
-                    # TODO: drop to config state or something, remote config seems to be invalid
-                    pass
-                    # notify factory to update listening clients
-            if self.datamsgcount_ack >= 5:
-                msg = {'cmd': common_protocol.ServerCommands.ACK_DATA, 'ack_count': self.datamsgcount_ack}
-                self.sendJsonMessage(msg)
-                self.datamsgcount_ack = 0
-                # notify factory of new data event
+            # notify factory of new data event
             self.client.protocol.factory.rpi_new_data_event(self.client)
 
+    def send_ack(self):
+        self.ack_call = None
+        if self.flow.unacked and self.client.protocol.factory.rpi_clients.get(self.client.mac) is self.client:
+            # sendJsonMessage adds the ack
+            self.sendJsonMessage({'cmd': common_protocol.ServerCommands.ACK_DATA})
+
+    def cancel_ack(self):
+        if self.ack_call is not None and self.ack_call.active():
+            self.ack_call.cancel()
+        self.ack_call = None
+
+    def sendJsonMessage(self, msg):
+        # acks and credit ride on whatever goes to the RPI
+        if self.flow.unacked:
+            self.cancel_ack()
+            msg.update(self.flow.grant())
+        super(RPIStreamState, self).sendJsonMessage(msg)
+
+    @staticmethod
+    def series_received(samples, data, config, pending_series):
+        for key, key_samples in samples.iteritems():
+            if key not in config:
+                continue
+            pending_series.setdefault(key, []).extend(key_samples)
+            data[key] = key_samples[-1][1]
+
     def resume_streaming(self):
         msg = {'cmd': common_protocol.ServerCommands.RESUME_STREAMING}
         self.sendJsonMessage(msg)
@@ -272,12 +744,19 @@ class RPIStreamState(ServerState):
 
     def write_interface_data(self, key, value):
         # removes the EQ from the key sent by the client
-        config_key = self.write_data_eq_map[key]
+        config_key = self.write_data_eq_map.get(key)
+        if config_key is None:
+            log.err('RPIStreamState.write_interface_data - %r is not a write channel of %s' % (key, self.client.mac))
+            return False
         msg = {'cmd': common_protocol.ServerCommands.WRITE_DATA,
-               'inter_face_port': config_key,
                'value': value}
+        if self.channel_ids:
+            msg['channel_id'] = self.config_writes[config_key]['id']
+        else:
+            msg['inter_face_port'] = config_key
 
         self.sendJsonMessage(msg)
+        return True
 
     def drop_to_config(self, reads, writes):
         # drop remote RPI to config state
@@ -0,0 +1,613 @@
+"""
+Append-only on-disk history of every RPI channel.
+
+<root>/<mac>/<sha1 of channel>/ holds a channel's segments, the mac is url
+quoted and the channel key, which holds the equation, is in the 'key' file.
+Timestamps never go back, an older one is written at the newest so far.
+A segment holds up to STORE_SEGMENT_SAMPLES samples:
+
+    <number>.open   being written, fixed size and memory mapped
+        '<4sHHII'     'RPIO', version, flags, capacity, count
+        capacity '<d' timestamps, then capacity '<d' values
+    <number>.seg    sealed once full
+        '<4sHHIddII'  'RPIS', version, flags, count, first and last timestamp,
+                      bytes of each column
+        zlib of the timestamps, delta-of-delta of int microseconds
+        zlib of the values, each float's bits XOR the previous ones
+
+Writes are queued from the reactor and done by one worker thread.
+Scans hold the store lock only to list a channel's segments and copy the
+open one, sealed ones are decompressed one at a time after, columns are
+numpy arrays, array('d') without numpy.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import urllib
+import zlib
+
+from twisted.python import log
+from rpi_ws import settings
+from rpi_ws.buffer import to_float
+
+try:
+    import numpy
+except ImportError:
+    # columns are array('d') and segments are sealed in python
+    numpy = None
+
+__author__ = 'kenny'
+
+VERSION = 1
+OPEN_MAGIC = 'RPIO'
+SEALED_MAGIC = 'RPIS'
+OPEN_HEADER = struct.Struct('<4sHHII')
+SEALED_HEADER = struct.Struct('<4sHHIddII')
+# offset of count in OPEN_HEADER
+COUNT_OFFSET = 12
+# file of a channel's directory holding its utf-8 key
+KEY_NAME = 'key'
+
+
+class StoreError(Exception):
+    pass
+
+
+def _column(data, offset, count):
+    """
+    count little endian doubles at offset of data, copied
+    """
+    if numpy is not None:
+        return numpy.frombuffer(data, '<f8', count, offset).copy()
+    column = array('d')
+    column.fromstring(data[offset:offset + count * 8])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def _empty():
+    if numpy is not None:
+        return numpy.empty(0)
+    return array('d')
+
+
+def _overlaps(segment, start, end):
+    first = segment.first()
+    return first is not None and (end is None or first <= end) and (start is None or segment.last() >= start)
+
+
+def _segment_range(segment, start, end):
+    """
+    (timestamps, values) of segment from start to end, both included, None if there are none
+    """
+    if not _overlaps(segment, start, end):
+        return None
+    timestamps, values = segment.columns()
+    low = 0 if start is None else bisect_left(timestamps, start)
+    high = len(timestamps) if end is None else bisect_right(timestamps, end)
+    if low >= high:
+        return None
+    return timestamps[low:high], values[low:high]
+
+
+def encode_timestamps(timestamps):
+    if numpy is not None:
+        ints = numpy.round(numpy.asarray(timestamps) * 1e6).astype('<i8')
+        delta = ints.copy()
+        delta[1:] -= ints[:-1]
+        dod = delta.copy()
+        dod[1:] -= delta[:-1]
+        return dod.tostring()
+
+    dod = []
+    previous = previous_delta = 0
+    for timestamp in timestamps:
+        value = int(round(timestamp * 1e6))
+        delta = value - previous
+        dod.append(delta - previous_delta)
+        previous = value
+        previous_delta = delta
+    return struct.pack('<%dq' % len(dod), *dod)
+
+
+def decode_timestamps(data, count):
+    if numpy is not None:
+        ints = numpy.frombuffer(data, '<i8', count).cumsum().cumsum()
+        return ints / 1e6
+
+    timestamps = array('d')
+    value = delta = 0
+    for dod in struct.unpack('<%dq' % count, data):
+        delta += dod
+        value += delta
+        timestamps.append(value / 1e6)
+    return timestamps
+
+
+def encode_values(values):
+    if numpy is not None:
+        bits = numpy.asarray(values, '<f8').view('<u8')
+        xored = bits.copy()
+        xored[1:] ^= bits[:-1]
+        return xored.tostring()
+
+    count = len(values)
+    bits = struct.unpack('<%dQ' % count, struct.pack('<%dd' % count, *values))
+    xored = [bits[0]] if count else []
+    xored.extend(bits[i] ^ bits[i - 1] for i in xrange(1, count))
+    return struct.pack('<%dQ' % count, *xored)
+
+
+def decode_values(data, count):
+    if numpy is not None:
+        xored = numpy.frombuffer(data, '<u8', count)
+        return numpy.bitwise_xor.accumulate(xored).view('<f8')
+
+    bits = []
+    previous = 0
+    for xored in struct.unpack('<%dQ' % count, data):
+        previous ^= xored
+        bits.append(previous)
+    return array('d', struct.unpack('<%dd' % count, struct.pack('<%dQ' % count, *bits)))
+
+
+class OpenSegment(object):
+    """
+    Fixed size memory mapped segment being appended to
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(OPEN_HEADER.pack(OPEN_MAGIC, VERSION, 0, capacity, 0))
+                # sparse until written
+                f.truncate(OPEN_HEADER.size + capacity * 16)
+
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, version, flags, self.capacity, self.count = OPEN_HEADER.unpack_from(self.mm)
+        if magic != OPEN_MAGIC or version != VERSION:
+            self.close()
+            raise StoreError('%s is not a version %d open segment' % (path, VERSION))
+        self.values_offset = OPEN_HEADER.size + self.capacity * 8
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, timestamps, values, start=0):
+        """
+        Appends from start of the columns, returns how many fit
+        """
+        n = min(self.capacity - self.count, len(timestamps) - start)
+        if n <= 0:
+            return 0
+        offset = self.count * 8
+        fmt = '<%dd' % n
+        struct.pack_into(fmt, self.mm, OPEN_HEADER.size + offset, *timestamps[start:start + n])
+        struct.pack_into(fmt, self.mm, self.values_offset + offset, *values[start:start + n])
+        # count last, a crash loses the samples after it
+        self.count += n
+        struct.pack_into('<I', self.mm, COUNT_OFFSET, self.count)
+        return n
+
+    def columns(self):
+        return (_column(self.mm, OPEN_HEADER.size, self.count),
+                _column(self.mm, self.values_offset, self.count))
+
+    def first(self):
+        return struct.unpack_from('<d', self.mm, OPEN_HEADER.size)[0] if self.count else None
+
+    def last(self):
+        return struct.unpack_from('<d', self.mm, OPEN_HEADER.size + (self.count - 1) * 8)[0] if self.count else None
+
+    def seal(self, path):
+        """
+        Writes the sealed segment to path, removes this one
+        """
+        timestamps, values = self.columns()
+        timestamp_data = zlib.compress(encode_timestamps(timestamps))
+        value_data = zlib.compress(encode_values(values))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SEALED_HEADER.pack(SEALED_MAGIC, VERSION, 0, self.count, timestamps[0], timestamps[-1],
+                                       len(timestamp_data), len(value_data)))
+            f.write(timestamp_data)
+            f.write(value_data)
+        os.rename(tmp_path, path)
+        self.close()
+        os.remove(self.path)
+        return SealedSegment(path)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+
+
+class OpenSegmentCopy(object):
+    """
+    Samples of an open segment no writer holds, read without mapping it
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(OPEN_HEADER.size)
+            if len(header) < OPEN_HEADER.size:
+                raise StoreError('%s is truncated' % path)
+            magic, version, flags, capacity, count = OPEN_HEADER.unpack(header)
+            if magic != OPEN_MAGIC or version != VERSION:
+                raise StoreError('%s is not a version %d open segment' % (path, VERSION))
+            timestamps = f.read(count * 8)
+            f.seek(OPEN_HEADER.size + capacity * 8)
+            values = f.read(count * 8)
+        if len(timestamps) < count * 8 or len(values) < count * 8:
+            raise StoreError('%s is truncated' % path)
+        self.timestamps = _column(timestamps, 0, count)
+        self.values = _column(values, 0, count)
+
+    def first(self):
+        return self.timestamps[0] if len(self.timestamps) else None
+
+    def last(self):
+        return self.timestamps[-1] if len(self.timestamps) else None
+
+    def columns(self):
+        return self.timestamps, self.values
+
+
+class SealedSegment(object):
+    """
+    Compressed full segment, only its header is read until scanned
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(SEALED_HEADER.size)
+        if len(header) < SEALED_HEADER.size:
+            raise StoreError('%s is truncated' % path)
+        (magic, version, flags, self.count, self.first_timestamp, self.last_timestamp,
+         self.timestamp_bytes, self.value_bytes) = SEALED_HEADER.unpack(header)
+        if magic != SEALED_MAGIC or version != VERSION:
+            raise StoreError('%s is not a version %d sealed segment' % (path, VERSION))
+
+    def first(self):
+        return self.first_timestamp
+
+    def last(self):
+        return self.last_timestamp
+
+    def columns(self):
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = SEALED_HEADER.size
+                middle = start + self.timestamp_bytes
+                timestamps = zlib.decompress(mm[start:middle])
+                values = zlib.decompress(mm[middle:middle + self.value_bytes])
+            finally:
+                mm.close()
+        return decode_timestamps(timestamps, self.count), decode_values(values, self.count)
+
+
+class ChannelLog(object):
+    """
+    Segments of one channel, oldest first, the last one open
+    """
+
+    def __init__(self, path, capacity, key=None):
+        self.path = path
+        self.capacity = capacity
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if key is not None and not os.path.exists(os.path.join(path, KEY_NAME)):
+            write_key(path, key)
+
+        self.sealed = []
+        self.number = 0
+        open_names = []
+        for name in sorted(os.listdir(path)):
+            number, ext = os.path.splitext(name)
+            if ext == '.seg':
+                self.sealed.append(SealedSegment(os.path.join(path, name)))
+                self.number = int(number) + 1
+            elif ext == '.open':
+                open_names.append(name)
+        for name in open_names:
+            if int(os.path.splitext(name)[0]) < self.number:
+                # sealed right before a crash
+                os.remove(os.path.join(path, name))
+        self.open = OpenSegment(self.segment_path('.open'), capacity)
+
+        self.newest = self.open.last()
+        if self.newest is None:
+            self.newest = self.sealed[-1].last() if self.sealed else float('-inf')
+
+    def segment_path(self, ext):
+        return os.path.join(self.path, '%010d%s' % (self.number, ext))
+
+    def append(self, timestamps, values):
+        newest = self.newest
+        for i, timestamp in enumerate(timestamps):
+            if timestamp < newest:
+                # scans bisect the timestamps
+                timestamps[i] = newest
+            else:
+                newest = timestamp
+        self.newest = newest
+
+        done = 0
+        while done < len(timestamps):
+            done += self.open.append(timestamps, values, done)
+            if self.open.full:
+                self.sealed.append(self.open.seal(self.segment_path('.seg')))
+                self.number += 1
+                self.open = OpenSegment(self.segment_path('.open'), self.capacity)
+
+    def snapshot(self, start=None, end=None):
+        """
+        Returns (sealed segments overlapping start to end, the open segment's samples in range or None)
+        """
+        return ([segment for segment in self.sealed if _overlaps(segment, start, end)],
+                _segment_range(self.open, start, end))
+
+    def close(self):
+        self.open.close()
+
+
+def write_key(path, key):
+    tmp_path = os.path.join(path, KEY_NAME + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(key.encode('utf-8'))
+    os.rename(tmp_path, os.path.join(path, KEY_NAME))
+
+
+def read_key(path):
+    """
+    Returns the channel key of a channel directory, None if it has none
+    """
+    try:
+        with open(os.path.join(path, KEY_NAME), 'rb') as f:
+            return f.read().decode('utf-8')
+    except IOError:
+        return None
+
+
+def read_snapshot(path, start=None, end=None):
+    """
+    ChannelLog.snapshot of a channel no writer holds, straight from its files
+    """
+    sealed = []
+    number = 0
+    open_names = []
+    for name in sorted(os.listdir(path)):
+        segment_number, ext = os.path.splitext(name)
+        if ext == '.seg':
+            segment = SealedSegment(os.path.join(path, name))
+            if _overlaps(segment, start, end):
+                sealed.append(segment)
+            number = int(segment_number) + 1
+        elif ext == '.open':
+            open_names.append(name)
+    chunk = None
+    for name in open_names:
+        # older ones were sealed right before a crash
+        if int(os.path.splitext(name)[0]) >= number:
+            chunk = _segment_range(OpenSegmentCopy(os.path.join(path, name)), start, end)
+    return sealed, chunk
+
+
+class HistoryStore(object):
+    """
+    Per RPI mac and channel store, appends are queued and written by a worker thread.
+    Scans wait for the write in progress to list segments, call them from a thread.
+    """
+
+    def __init__(self, root, segment_samples=None, max_open=None, max_pending=None):
+        self.root = root
+        self.segment_samples = segment_samples or settings.STORE_SEGMENT_SAMPLES
+        self.max_open = max_open or settings.STORE_MAX_OPEN
+        self.max_pending = max_pending or settings.STORE_MAX_PENDING
+
+        # guards the channel logs, held by the worker while writing
+        self.lock = threading.Lock()
+        # (mac, channel): ChannelLog with an open segment, least recently used first
+        self.logs = OrderedDict()
+
+        self.condition = threading.Condition()
+        # (mac, channel): (timestamps, values) waiting for the worker
+        self.pending = {}
+        self.pending_count = 0
+        self.worker = None
+        self.running = False
+
+        # stats
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.worker = threading.Thread(target=self.run, name='history-store')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def close(self):
+        """
+        Writes what is queued and closes every segment
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        self.write(self.take_pending())
+        with self.lock:
+            for channel_log in self.logs.itervalues():
+                channel_log.close()
+            self.logs.clear()
+
+    def append(self, mac, channel, samples):
+        """
+        Queues iterable of (timestamp, value), never blocks on the disk
+        """
+        self.start()
+        with self.condition:
+            entry = self.pending.get((mac, channel))
+            if entry is None:
+                entry = self.pending[(mac, channel)] = (array('d'), array('d'))
+            timestamps, values = entry
+            for timestamp, value in samples:
+                if self.pending_count >= self.max_pending:
+                    # the disk can't keep up
+                    self.dropped += 1
+                    continue
+                timestamps.append(timestamp)
+                values.append(to_float(value))
+                self.pending_count += 1
+            self.condition.notify()
+
+    def writer(self, mac, channel):
+        return ChannelWriter(self, mac, channel)
+
+    def mac_path(self, mac):
+        return os.path.join(self.root, urllib.quote(mac, safe=''))
+
+    def channel_path(self, mac, channel):
+        # keys hold whole equations, too long for a file name
+        return os.path.join(self.mac_path(mac), hashlib.sha1(channel.encode('utf-8')).hexdigest())
+
+    def channel_log(self, mac, channel):
+        """
+        Called with the lock held
+        """
+        key = (mac, channel)
+        channel_log = self.logs.pop(key, None)
+        if channel_log is None:
+            channel_log = ChannelLog(self.channel_path(mac, channel), self.segment_samples, channel)
+            while len(self.logs) >= self.max_open:
+                # every open segment holds a descriptor
+                self.logs.popitem(last=False)[1].close()
+        self.logs[key] = channel_log
+        return channel_log
+
+    def take_pending(self):
+        with self.condition:
+            pending = self.pending
+            self.pending = {}
+            self.pending_count = 0
+        return pending
+
+    def write(self, pending):
+        with self.lock:
+            for (mac, channel), (timestamps, values) in pending.iteritems():
+                if not timestamps:
+                    continue
+                try:
+                    self.channel_log(mac, channel).append(timestamps, values)
+                    self.written += len(timestamps)
+                except (IOError, OSError, StoreError), e:
+                    self.errors += 1
+                    log.err('HistoryStore.write - %s %s, %s' % (mac, channel, e))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+            self.write(self.take_pending())
+
+    def scan(self, mac, channel, start=None, end=None):
+        """
+        Yields (timestamps, values) chunks of the samples from start to end, oldest first,
+        one segment at a time. Segments sealed after the scan started are not seen.
+        """
+        with self.lock:
+            channel_log = self.logs.get((mac, channel))
+            if channel_log is not None:
+                sealed, chunk = channel_log.snapshot(start, end)
+            else:
+                path = self.channel_path(mac, channel)
+                if not os.path.isdir(path):
+                    return
+                # read only, no open segment is created nor writer's log evicted
+                sealed, chunk = read_snapshot(path, start, end)
+
+        # sealed segments are never rewritten, decompressed without the lock
+        for segment in sealed:
+            sealed_chunk = _segment_range(segment, start, end)
+            if sealed_chunk is not None:
+                yield sealed_chunk
+        if chunk is not None:
+            yield chunk
+
+    def range(self, mac, channel, start=None, end=None):
+        """
+        Returns (timestamps, values) of the samples from start to end
+        """
+        chunks = list(self.scan(mac, channel, start, end))
+        if not chunks:
+            return _empty(), _empty()
+        if len(chunks) == 1:
+            return chunks[0]
+        if numpy is not None:
+            return (numpy.concatenate([timestamps for timestamps, values in chunks]),
+                    numpy.concatenate([values for timestamps, values in chunks]))
+        timestamps = array('d')
+        values = array('d')
+        for chunk_timestamps, chunk_values in chunks:
+            timestamps.extend(chunk_timestamps)
+            values.extend(chunk_values)
+        return timestamps, values
+
+    def channels(self, mac):
+        """
+        Returns the channel keys stored for mac, those of edited equations included
+        """
+        path = self.mac_path(mac)
+        if not os.path.isdir(path):
+            return []
+        keys = (read_key(os.path.join(path, name)) for name in os.listdir(path))
+        return [key for key in keys if key is not None]
+
+    def stats(self):
+        with self.condition:
+            return {'pending': self.pending_count,
+                    'written': self.written,
+                    'dropped': self.dropped,
+                    'errors': self.errors,
+                    'open_channels': len(self.logs)}
+
+
+class ChannelWriter(object):
+    """
+    Scatter target queueing (timestamp, value) samples of one channel
+    """
+
+    def __init__(self, store, mac, channel):
+        self.store = store
+        self.mac = mac
+        self.channel = channel
+
+    def append(self, timestamp, value):
+        self.store.append(self.mac, self.channel, ((timestamp, value),))
+
+    def update(self, samples):
+        self.store.append(self.mac, self.channel, samples)
@@ -1,9 +1,13 @@
+import json
+import time
 from twisted.python import log
 from twisted.internet import reactor
 import twisted.internet.protocol as twistedsockets
 from autobahn.websocket import WebSocketServerFactory, WebSocketServerProtocol, HttpException
 import autobahn.httpstatus as httpstatus
 from rpi_ws.server.client import UserClient, RPIClient
+from rpi_ws.server.equation import EquationBatch
+from rpi_ws import common_protocol, compression, metrics
 
 import settings
 
@@ -24,6 +28,32 @@ class RPIServerProtocol(WebSocketServerProtocol):
 
     def __init__(self):
         self.client = None
+        # set once compression is negotiated, see compression
+        self.compressor = None
+        self.decompressor = None
+
+    def start_compression(self, options):
+        self.compressor = compression.MessageCompressor(options)
+        self.decompressor = compression.MessageDecompressor()
+
+    def sendMessage(self, payload, binary=False, payload_frag_size=None, sync=False):
+        if self.compressor is not None:
+            payload, binary = self.compressor.compress(payload, binary)
+        WebSocketServerProtocol.sendMessage(self, payload, binary, payload_frag_size, sync)
+
+    def compression_stats(self):
+        if self.compressor is None:
+            return None
+        return self.compressor.stats()
+
+    def transport_pending(self):
+        """
+        Bytes written and not handed to the socket yet
+        """
+        if self.transport is None:
+            return 0
+        return (len(getattr(self.transport, 'dataBuffer', '')) - getattr(self.transport, 'offset', 0) +
+                getattr(self.transport, '_tempDataLen', 0))
 
     def onConnect(self, connectionRequest):
         def user(headers):
@@ -60,7 +90,15 @@ class RPIServerProtocol(WebSocketServerProtocol):
                 log.msg("RPIServerProtocol.onMessage - No Client type")
             self.failConnection()
 
-        self.client.onMessage(msg)
+        if binary and self.decompressor is not None:
+            try:
+                msg, binary = self.decompressor.decompress(msg)
+            except compression.CompressionError, e:
+                log.err("RPIServerProtocol.onMessage - Bad compressed message, %s" % e)
+                self.failConnection()
+                return
+
+        self.client.onMessage(msg, binary)
 
     def onOpen(self):
         WebSocketServerProtocol.onOpen(self)
@@ -99,6 +137,43 @@ class RPISocketServerFactory(WebSocketServerFactory):
         # key RPI mac, value list of user clients
         self.rpi_clients_registered_users = {}
 
+        # RPI stream states with data waiting on equations
+        self.equation_batch = EquationBatch()
+        self.equation_states = []
+        self.equation_call = None
+
+        # key RPI mac, pending broadcast call
+        self.rpi_broadcast_calls = {}
+        # subscribed users with broadcasts queued, sent one RPI_DATA frame each per reactor iteration
+        self.send_cycle_users = set()
+        self.send_cycle_call = None
+
+        # users by the RPIs whose state changes they get, mac: set of users,
+        # and users getting every RPI's, see notify_clients_rpi_state_change
+        self.rpi_interest = {}
+        self.rpi_interest_all = set()
+        # users with state changes waiting for the next digest
+        self.rpi_state_users = set()
+        self.rpi_state_call = None
+
+        # deflate per endpoint, /rpi/ and / for users
+        self.rpi_compression = compression.CompressionOptions(**settings.COMPRESSION_RPI)
+        self.user_compression = compression.CompressionOptions(**settings.COMPRESSION_USER)
+        # options: compressor of broadcast frames shared by users without context takeover,
+        # users' own compressors only count what is compressed for them
+        self.shared_compressors = {}
+
+        # on-disk history, a server.store.HistoryStore if enabled
+        self.store = None
+
+        # hot path counters, see metrics
+        self.equation_seconds = metrics.Histogram()
+        self.data_events = 0
+        self.broadcasts = 0
+        self.broadcast_encodings = 0
+        self.broadcast_fanout = metrics.Histogram(metrics.FANOUT_BUCKETS)
+        self.reactor_lag = metrics.ReactorLag(settings.METRICS_LAG_INTERVAL)
+
     def register_user_to_rpi(self, client, rpi):
         if len(self.rpi_clients_registered_users[rpi.mac]) == 0:
             # RPI wasn't streaming, start streaming!
@@ -111,6 +186,9 @@ class RPISocketServerFactory(WebSocketServerFactory):
 
     def unregister_user_to_rpi(self, client, rpi):
         client.unregister_to_rpi()
+        self.remove_user_from_rpi(client, rpi)
+
+    def remove_user_from_rpi(self, client, rpi):
         if rpi is None:
             return
         if rpi.mac in self.rpi_clients_registered_users:
@@ -124,25 +202,180 @@ class RPISocketServerFactory(WebSocketServerFactory):
             rpi.pause_streaming()
 
     def rpi_new_data_event(self, rpi):
-        # resume streaming on any RPIs waiting for new data
-        for client in self.rpi_clients_registered_users[rpi.mac]:
-            client.resume_streaming()
+        self.data_events += 1
+        # broadcast once per reactor iteration however many frames arrived
+        if rpi.mac not in self.rpi_broadcast_calls:
+            self.rpi_broadcast_calls[rpi.mac] = reactor.callLater(0, self.broadcast_rpi_data, rpi)
 
-    def copy_rpi_buffers(self, rpi, read_buffer, write_buffer):
-        rpi.copy_buffers(read_buffer, write_buffer)
+    def broadcast_rpi_data(self, rpi):
+        """
+        Encodes what changed on the RPI once and sends the same frame to every
+        registered user that is in sync, the others catch up individually
+        """
+        del self.rpi_broadcast_calls[rpi.mac]
+        if self.rpi_clients.get(rpi.mac) is not rpi:
+            return
+
+        changes = rpi.broadcast_buffers()
+        if changes is None:
+            return
+        read_changes, write_changes, data_version = changes
+        users = self.rpi_clients_registered_users[rpi.mac]
+        if len(users) == 0 or (len(read_changes) == 0 and len(write_changes) == 0):
+            return
+        self.broadcasts += 1
+        self.broadcast_fanout.observe(len(users))
+
+        # channel_ids: payload, (channel_ids, compressed): prepared, one encoding per kind of user
+        payloads = {}
+        frames = {}
+        # channel_ids: RPI_DATA entry, for users subscribed to several RPIs
+        parts = {}
+        for client in users:
+            if client.multiplexed:
+                part = parts.get(client.channel_ids)
+                if part is None:
+                    part = parts[client.channel_ids] = rpi.data_part(read_changes, write_changes, client.channel_ids)
+                client.queue_broadcast(rpi, part, data_version)
+                continue
+
+            payload = payloads.get(client.channel_ids)
+            if payload is None:
+                payload = payloads[client.channel_ids] = \
+                    json.dumps(rpi.data_message(read_changes, write_changes, client.channel_ids))
+
+            compressor = client.protocol.compressor
+            if compressor is not None and compressor.context_takeover:
+                # its own deflate stream, compressed for this user only
+                client.send_broadcast(payload, None, data_version)
+                continue
+
+            kind = (client.channel_ids, compressor.options if compressor is not None else None)
+            prepared = frames.get(kind)
+            if prepared is None:
+                # frame once as well, messages without context compress the same for everyone
+                if compressor is not None:
+                    prepared = self.prepareMessage(*self.shared_compressor(compressor.options).compress(payload))
+                else:
+                    prepared = self.prepareMessage(payload)
+                frames[kind] = prepared
+            client.send_broadcast(payload, prepared, data_version)
+        self.broadcast_encodings += len(payloads) + len(parts)
+
+    def shared_compressor(self, options):
+        compressor = self.shared_compressors.get(options)
+        if compressor is None:
+            compressor = self.shared_compressors[options] = compression.MessageCompressor(options)
+        return compressor
+
+    def queue_send_cycle(self, user):
+        """
+        Send user's queued broadcasts once every RPI broadcast this iteration
+        """
+        self.send_cycle_users.add(user)
+        if self.send_cycle_call is None:
+            self.send_cycle_call = reactor.callLater(0, self.send_cycle)
+
+    def send_cycle(self):
+        self.send_cycle_call = None
+        users = self.send_cycle_users
+        self.send_cycle_users = set()
+        for user in users:
+            user.send_subscriptions()
+
+    def queue_equations(self, state):
+        """
+        Evaluate the equations of state with every other RPI's on the next reactor iteration
+        """
+        if state not in self.equation_states:
+            self.equation_states.append(state)
+        if self.equation_call is None:
+            self.equation_call = reactor.callLater(0, self.evaluate_equations)
+
+    def evaluate_equations(self):
+        self.equation_call = None
+        states = self.equation_states
+        self.equation_states = []
+
+        start = time.time()
+        for state in states:
+            state.evaluate_pending(self.equation_batch)
+        self.equation_batch.evaluate()
+        self.equation_seconds.observe(time.time() - start)
+
+        for state in states:
+            state.equations_evaluated()
+            # skip RPIs that disconnected while waiting
+            if self.rpi_clients.get(state.client.mac) is state.client:
+                self.rpi_new_data_event(state.client)
+
+    def copy_rpi_buffers(self, rpi, data_version):
+        return rpi.copy_buffers(data_version)
 
     def get_rpi(self, rpi_mac):
         if rpi_mac in self.rpi_clients:
             return self.rpi_clients[rpi_mac]
         return None
 
+    def set_rpi_interest(self, user, macs):
+        """
+        Indexes user under the RPI macs it wants state changes of, None for every RPI
+        """
+        if user.interest is None:
+            self.rpi_interest_all.discard(user)
+        else:
+            for mac in user.interest:
+                users = self.rpi_interest[mac]
+                users.discard(user)
+                if not users:
+                    del self.rpi_interest[mac]
+        user.interest = macs
+        if macs is None:
+            self.rpi_interest_all.add(user)
+        else:
+            for mac in macs:
+                self.rpi_interest.setdefault(mac, set()).add(user)
+
     def notify_clients_rpi_state_change(self, rpi, state='offline'):
-        for peerstr, user in self.user_client.iteritems():
-            user.notifyRPIState(rpi, state)
+        """
+        Users streaming the RPI and users that never sent RPI_WATCH are told right away,
+        users watching the RPI get the latest state of every RPI that changed every
+        RPI_STATE_DIGEST_PERIOD. Users subscribed to the RPI's mac start or stop streaming it.
+        """
+        # RPI_STATE_CHANGE of the users without a watch list, encoded once
+        payload = None
+        for users in (self.rpi_interest.get(rpi.mac, ()), self.rpi_interest_all):
+            for user in users:
+                if user.multiplexed and state in ('online', 'offline') and rpi.mac in user.rpi_macs:
+                    # subscriptions follow RPIs coming and going
+                    user.refresh_subscriptions()
+                if user.streams(rpi):
+                    user.notifyRPIState(rpi, state)
+                elif state == 'config':
+                    continue
+                elif user.watched is None:
+                    if payload is None:
+                        payload = json.dumps({'cmd': common_protocol.ServerCommands.RPI_STATE_CHANGE,
+                                              'rpi_mac': rpi.mac,
+                                              'rpi_state': state})
+                    user.protocol.sendMessage(payload)
+                else:
+                    user.pending_rpi_states[rpi.mac] = state
+                    self.rpi_state_users.add(user)
+        if self.rpi_state_users and self.rpi_state_call is None:
+            self.rpi_state_call = reactor.callLater(settings.RPI_STATE_DIGEST_PERIOD, self.send_rpi_states)
+
+    def send_rpi_states(self):
+        self.rpi_state_call = None
+        users = self.rpi_state_users
+        self.rpi_state_users = set()
+        for user in users:
+            user.send_rpi_states()
 
     def register_user(self, user):
         if user.protocol.peerstr not in self.user_client:
             self.user_client[user.protocol.peerstr] = user
+            self.set_rpi_interest(user, user.rpi_interest())
             if self.debug:
                 log.msg('RPISocketServerFactory.register_user %s' % user.protocol.peerstr)
 
@@ -150,12 +383,16 @@ class RPISocketServerFactory(WebSocketServerFactory):
         if self.debug:
             log.msg('RPISocketServerFactory.disconnect_user %s' % user.protocol.peerstr)
         del self.user_client[user.protocol.peerstr]
+        self.set_rpi_interest(user, frozenset())
+        self.rpi_state_users.discard(user)
+        self.send_cycle_users.discard(user)
+        user.unsubscribe_rpis()
         self.unregister_user_to_rpi(user, user.associated_rpi)
 
     def register_rpi(self, rpi):
         # this is called when the RPI has been authenticated with the WS server
         # register on the site server
-        reactor.callInThread(self.sitecomm.register_rpi, rpi)
+        self.sitecomm.register_rpi(rpi)
         # register locally to the factory
         self.rpi_clients[rpi.mac] = rpi
         self.rpi_clients_registered_users[rpi.mac] = []
@@ -171,7 +408,9 @@ class RPISocketServerFactory(WebSocketServerFactory):
             if self.debug:
                 log.msg("RPISocketServerFactory.disconnect_rpi - %s rpi disconnected" % rpi.mac)
 
-            reactor.callInThread(self.sitecomm.disconnect_rpi, rpi)
+            self.sitecomm.disconnect_rpi(rpi)
+            if rpi.mac in self.rpi_broadcast_calls:
+                self.rpi_broadcast_calls.pop(rpi.mac).cancel()
             del self.rpi_clients[rpi.mac]
             del self.rpi_clients_registered_users[rpi.mac]
 
@@ -204,6 +443,140 @@ class RPISocketServerFactory(WebSocketServerFactory):
 
         return rpi_client.config_io(reads=configs['read'], writes=configs['write'])
 
+    def metrics(self, out):
+        """
+        Writes the server's counters and the state of every RPI and user to a metrics.Exposition
+        """
+        rpis = sorted(self.rpi_clients.iteritems())
+        users = sorted(self.user_client.iteritems())
+        rpi_labels = [{'mac': mac} for mac, rpi in rpis]
+        user_labels = [{'peer': peerstr, 'rpi': ','.join(sorted(rpi.mac for rpi in user.streamed_rpis()))}
+                       for peerstr, user in users]
+
+        out.family('rpis', 'gauge', 'Registered RPIs')
+        out.sample('rpis', len(rpis))
+        out.family('users', 'gauge', 'Connected users')
+        out.sample('users', len(users))
+        out.family('users_watching_all', 'gauge', 'Users getting the state changes of every RPI, no RPI_WATCH sent')
+        out.sample('users_watching_all', len(self.rpi_interest_all))
+
+        # RPIs
+        out.family('rpi_data_frames_total', 'counter', 'DATA frames received')
+        for labels, (mac, rpi) in zip(rpi_labels, rpis):
+            out.sample('rpi_data_frames_total', rpi.data_frames, labels)
+        out.family('rpi_data_bytes_total', 'counter', 'Bytes of messages received while streaming, after decompression')
+        for labels, (mac, rpi) in zip(rpi_labels, rpis):
+            out.sample('rpi_data_bytes_total', rpi.data_bytes, labels)
+        out.family('rpi_users', 'gauge', 'Users registered to the RPI')
+        for labels, (mac, rpi) in zip(rpi_labels, rpis):
+            out.sample('rpi_users', len(self.rpi_clients_registered_users.get(mac, ())), labels)
+        out.stats('rpi_flow',
+                  {'window': 'gauge', 'unacked': 'gauge', 'rate': 'gauge', 'rtt': 'gauge', 'processing': 'gauge'},
+                  {'window': 'DATA frames the RPI may have in flight',
+                   'unacked': 'DATA frames received and not acked',
+                   'rate': 'DATA frames per second',
+                   'rtt': 'Seconds from an ack to the frame echoing it',
+                   'processing': 'Seconds handling one DATA frame'},
+                  [(labels, rpi.flow_stats()) for labels, (mac, rpi) in zip(rpi_labels, rpis)])
+
+        # hardware and reactor of the RPIs, from their STATS reports
+        io_timings = [(dict(labels, op=op, channel=key), timings)
+                      for labels, (mac, rpi) in zip(rpi_labels, rpis)
+                      for (op, key), timings in sorted(rpi.io_timings.iteritems())]
+        out.family('rpi_io_seconds', 'histogram', 'Seconds from a hardware read/write call to its result or failure')
+        for labels, timings in io_timings:
+            out.histogram('rpi_io_seconds', timings.latency, labels)
+        out.family('rpi_io_max_seconds', 'gauge', 'Slowest hardware call of the last STATS report')
+        for labels, timings in io_timings:
+            out.sample('rpi_io_max_seconds', timings.last_max, labels)
+        out.family('rpi_io_errors_total', 'counter', 'Failed or timed out hardware calls')
+        for labels, timings in io_timings:
+            out.sample('rpi_io_errors_total', timings.errors, labels)
+        out.family('rpi_io_busy_total', 'counter', 'Hardware calls refused while the previous one was running')
+        for labels, timings in io_timings:
+            out.sample('rpi_io_busy_total', timings.busy, labels)
+        out.family('rpi_reactor_lag_seconds', 'histogram', 'Seconds calls ran later than scheduled on the RPI')
+        for labels, (mac, rpi) in zip(rpi_labels, rpis):
+            out.histogram('rpi_reactor_lag_seconds', rpi.reactor_lag, labels)
+        out.stats('rpi_i2c',
+                  {'queue_depth': 'gauge', 'transactions': 'counter', 'errors': 'counter',
+                   'latency_avg': 'gauge', 'latency_max': 'gauge'},
+                  {'queue_depth': 'Transactions waiting for the I2C bus',
+                   'transactions': 'I2C transactions run',
+                   'errors': 'Failed I2C transactions',
+                   'latency_avg': 'Average seconds from queueing an I2C transaction to its result',
+                   'latency_max': 'Slowest I2C transaction in seconds, queueing included'},
+                  [(dict(labels, bus=bus), stats)
+                   for labels, (mac, rpi) in zip(rpi_labels, rpis)
+                   for bus, stats in sorted(rpi.i2c_stats.iteritems())])
+
+        # equations and fan-out
+        out.family('equation_seconds', 'histogram',
+                   'Seconds evaluating equations, per batch or per DATA frame without EQUATION_BATCH')
+        out.histogram('equation_seconds', self.equation_seconds)
+        out.family('data_events_total', 'counter', 'New data events, DATA frames with equations evaluated')
+        out.sample('data_events_total', self.data_events)
+        out.family('broadcasts_total', 'counter', 'Broadcasts of RPI changes to its users')
+        out.sample('broadcasts_total', self.broadcasts)
+        out.family('broadcast_encodings_total', 'counter', 'WRITE_DATA payloads encoded for broadcasts')
+        out.sample('broadcast_encodings_total', self.broadcast_encodings)
+        out.family('broadcast_fanout', 'histogram', 'Users registered to the RPI per broadcast')
+        out.histogram('broadcast_fanout', self.broadcast_fanout)
+
+        # users
+        user_flows = [(labels, user.flow_stats()) for labels, (peerstr, user) in zip(user_labels, users)]
+        out.family('user_frames_sent_total', 'counter', 'Data frames sent to the user since it registered to the RPI')
+        for labels, stats in user_flows:
+            out.sample('user_frames_sent_total', stats['sent'], labels)
+        out.stats('user_flow',
+                  {'window': 'gauge', 'in_flight': 'gauge', 'rate': 'gauge', 'rtt': 'gauge'},
+                  {'window': 'Data frames the user may have in flight',
+                   'in_flight': 'Data frames sent and not acked',
+                   'rate': 'Data frames sent per second',
+                   'rtt': 'Seconds from a frame to its ack'},
+                  user_flows)
+        out.family('user_transport_pending_bytes', 'gauge', 'Bytes written to the user and not sent yet')
+        for labels, (peerstr, user) in zip(user_labels, users):
+            out.sample('user_transport_pending_bytes', user.protocol.transport_pending(), labels)
+
+        # deflate of both endpoints
+        out.stats('compression',
+                  {'messages': 'counter', 'bytes_in': 'counter', 'bytes_out': 'counter', 'seconds': 'counter'},
+                  {'messages': 'Messages sent with compression on',
+                   'bytes_in': 'Bytes of messages before compression',
+                   'bytes_out': 'Bytes of messages sent',
+                   'seconds': 'Seconds compressing'},
+                  [(dict(labels, endpoint='rpi'), rpi.protocol.compression_stats())
+                   for labels, (mac, rpi) in zip(rpi_labels, rpis)] +
+                  [(dict(labels, endpoint='user'), user.protocol.compression_stats())
+                   for labels, (peerstr, user) in zip(user_labels, users)])
+        shared = dict.fromkeys(('messages', 'bytes_in', 'bytes_out', 'seconds'), 0)
+        for compressor in self.shared_compressors.itervalues():
+            for key, value in compressor.stats().iteritems():
+                if key in shared:
+                    shared[key] += value
+        out.stats('broadcast_compression',
+                  {'messages': 'counter', 'bytes_in': 'counter', 'bytes_out': 'counter', 'seconds': 'counter'},
+                  {'messages': 'Broadcast frames compressed once for every user without context takeover',
+                   'bytes_in': 'Bytes of shared broadcast frames before compression',
+                   'bytes_out': 'Bytes of shared broadcast frames after compression, sent once per user',
+                   'seconds': 'Seconds compressing shared broadcast frames'},
+                  [(None, shared)])
+
+        if self.store is not None:
+            out.stats('store',
+                      {'pending': 'gauge', 'written': 'counter', 'dropped': 'counter', 'errors': 'counter',
+                       'open_channels': 'gauge'},
+                      {'pending': 'Samples queued for the writer',
+                       'written': 'Samples written',
+                       'dropped': 'Samples dropped on a full queue',
+                       'errors': 'Write errors',
+                       'open_channels': 'Channels with an open segment'},
+                      [(None, self.store.stats())])
+
+        out.family('reactor_lag_seconds', 'histogram', 'Seconds calls ran later than scheduled')
+        out.histogram('reactor_lag_seconds', self.reactor_lag.histogram)
+
 
 class FlashSocketPolicyServerProtocol(twistedsockets.Protocol):
     """
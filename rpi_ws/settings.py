@@ -1,10 +1,92 @@
 RPI_USER_AGENT = "Raspberry Pi WS"
 SITE_SERVER_ADDRESS = "piio-ss.wakeland.net"
 SITE_USER_AGENT = "Raspberry Site"
+# register/disconnect notifications to the site server, see server.site_comm.SiteNotifier
+# seconds events wait to be coalesced and sent together
+SITE_NOTIFY_DELAY = 0.05
+# most RPIs in one request, 1 sends every event on its own as the site server expects,
+# only raise it for a site server that takes json lists
+SITE_NOTIFY_BULK = 1
+# persistent connections, requests at once
+SITE_NOTIFY_CONNECTIONS = 4
+SITE_NOTIFY_TIMEOUT = 10
+# attempts after the first failed one, seconds before the first, doubling
+SITE_NOTIFY_RETRIES = 3
+SITE_NOTIFY_RETRY_DELAY = 1
+
 HMAC_TOKEN = "super secret token"
 
 WS_SERVER_IP = 'piio-ss.wakeland.net'
 WS_HTTP_PORT = 8090
 WS_PORT = 9000
 WS_HTTP_SSL = False
-WS_USE_SSL = False
\ No newline at end of file
+WS_USE_SSL = False
+
+# number of compiled equations kept by the server
+EQUATION_CACHE_SIZE = 512
+
+# evaluate equations of every RPI together once per reactor iteration
+EQUATION_BATCH = True
+# smallest group of values evaluated as a numpy array
+EQUATION_BATCH_MIN_SIZE = 8
+
+# RPI client sampling, seconds
+# channels due within SAMPLE_COALESCE of each other are sent in one frame
+SAMPLE_COALESCE = 0.002
+MIN_SAMPLE_PERIOD = 0.005
+
+# RPI client, batches timestamped samples into one DATA frame, sent once the oldest
+# sample is SAMPLE_BATCH_WINDOW_MS old or SAMPLE_BATCH_COUNT samples wait, 0 disables either
+SAMPLE_BATCH_WINDOW_MS = 0
+SAMPLE_BATCH_COUNT = 0
+# samples and edges kept per channel while the RPI client waits on acks
+SAMPLE_BUFFER_SIZE = 256
+
+# history the server keeps of every equation output, see buffer.ChannelHistory
+# samples per output, fewer when an RPI's outputs don't fit its budget
+HISTORY_LENGTH = 1000
+# bytes per RPI, a sample takes 16
+HISTORY_BUDGET = 4 * 1024 * 1024
+# seconds of history sent to users on CONNECT_RPI, users ask for another window with 'history'
+HISTORY_BACKFILL = 60
+# RPI sample timestamps are moved onto the server clock, a frame arriving this many
+# seconds later than the offset so far expects means the RPI clock was set back
+CLOCK_STEP = 5
+
+# deflate of messages per endpoint, see compression, level 0 disables it
+# context takeover compresses repetitive JSON best for ~300KB of zlib state per
+# connection, without it user broadcasts are compressed once for every user
+COMPRESSION_RPI = {'level': 6, 'context_takeover': True, 'min_size': 64}
+COMPRESSION_USER = {'level': 1, 'context_takeover': False, 'min_size': 256}
+
+# on-disk history of every eq output, see server.store, None disables it
+STORE_PATH = None
+# samples per segment file, an open segment takes 16 bytes a sample
+STORE_SEGMENT_SAMPLES = 8192
+# channels with a mapped open segment, each holds a file descriptor
+STORE_MAX_OPEN = 256
+# samples waiting on the writer thread before new ones are dropped
+STORE_MAX_PENDING = 1000000
+
+# /history range queries on the site comm HTTP port, see server.downsample
+HISTORY_QUERY_POINTS = 1000
+HISTORY_QUERY_MAX_POINTS = 10000
+# encoded responses of ranges that won't change, relative ranges count
+# as they end on a point, dashboards polling one hit it until the next point
+HISTORY_QUERY_CACHE = 128
+
+# seconds between checks of how late the reactor runs calls, see metrics.ReactorLag
+METRICS_LAG_INTERVAL = 0.5
+# seconds between STATS reports of a streaming RPI, 0 disables them
+STATS_INTERVAL = 60
+
+# seconds state changes of RPIs a user watches wait to go out together, see
+# RPISocketServerFactory.notify_clients_rpi_state_change
+RPI_STATE_DIGEST_PERIOD = 0.5
+
+# flow control, frames a receiver lets a sender have in flight, see flow
+FLOW_INITIAL_WINDOW = 10
+FLOW_MIN_WINDOW = 4
+FLOW_MAX_WINDOW = 128
+# receivers ack at the latest this many seconds after a frame
+FLOW_ACK_DELAY = 0.05
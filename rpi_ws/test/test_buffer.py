@@ -0,0 +1,126 @@
+"""
+History and aggregate buffers, run with:
+    trial rpi_ws.test
+"""
+from array import array
+
+from twisted.trial import unittest
+
+from rpi_ws import buffer
+
+__author__ = 'kenny'
+
+
+class RingBufferTestCase(unittest.TestCase):
+
+    def test_out_of_order(self):
+        # an RPI sample older than a value recorded at receive time
+        ring = buffer.RingBuffer(8)
+        ring.update([(10.0, 1), (12.0, 2), (11.0, 3), (13.0, 4)])
+        self.assertEqual(list(ring), [(10.0, 1.0), (12.0, 2.0), (12.0, 3.0), (13.0, 4.0)])
+        self.assertEqual(list(ring.since(11.5)[1]), [2.0, 3.0, 4.0])
+
+    def test_under_capacity(self):
+        ring = buffer.RingBuffer(4)
+        self.assertEqual(ring.last(), None)
+        self.assertEqual(ring.since(0), (array('d'), array('d')))
+        ring.update([(1.0, 10), (2.0, 20)])
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(list(ring), [(1.0, 10.0), (2.0, 20.0)])
+        self.assertEqual(ring.last(), (2.0, 20.0))
+
+    def test_wrap_around(self):
+        ring = buffer.RingBuffer(3)
+        for i in range(7):
+            ring.append(float(i), i * 10)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(list(ring), [(4.0, 40.0), (5.0, 50.0), (6.0, 60.0)])
+        self.assertEqual(ring.last(), (6.0, 60.0))
+
+    def test_since(self):
+        ring = buffer.RingBuffer(3)
+        for i in range(5):
+            ring.append(float(i), i)
+        timestamps, values = ring.since(2.0)
+        # after, not at
+        self.assertEqual((list(timestamps), list(values)), ([3.0, 4.0], [3.0, 4.0]))
+        self.assertEqual(list(ring.since(-1)[0]), [2.0, 3.0, 4.0])
+        self.assertEqual(list(ring.since(4.0)[0]), [])
+
+    def test_not_numbers(self):
+        ring = buffer.RingBuffer(4)
+        ring.update([(1.0, None), (2.0, 'on'), (3.0, True)])
+        values = [value for timestamp, value in ring]
+        self.assertTrue(values[0] != values[0])
+        self.assertTrue(values[1] != values[1])
+        self.assertEqual(values[2], 1.0)
+
+
+class ChannelHistoryTestCase(unittest.TestCase):
+
+    def test_budget(self):
+        # 4 channels of 16 byte samples in 640 bytes
+        history = buffer.ChannelHistory(['a', 'b', 'c', 'd'], budget=640, max_samples=100)
+        self.assertEqual(history.capacity, 10)
+        self.assertEqual(buffer.ChannelHistory(['a'], budget=640, max_samples=5).capacity, 5)
+        self.assertEqual(buffer.ChannelHistory(['a'] * 100, budget=16, max_samples=5).capacity, 1)
+
+    def test_record_window(self):
+        history = buffer.ChannelHistory(['a', 'b'], budget=1024, max_samples=10)
+        history.record(1.0, [('a', 1), ('b', 2)])
+        history.record(2.0, [('a', 3)])
+        self.assertEqual(history.nbytes(), 3 * buffer.RingBuffer.SAMPLE_SIZE)
+        window = history.window(1.5, ['a', 'b'])
+        self.assertEqual(window.keys(), ['a'])
+        self.assertEqual(map(list, window['a']), [[2.0], [3.0]])
+
+
+class AggregatesTestCase(unittest.TestCase):
+
+    def test_window(self):
+        aggregates = buffer.Aggregates()
+        self.assertFalse(aggregates)
+        aggregates.add_window(1)
+        self.assertTrue(aggregates)
+        aggregates.update([('a', 4), ('a', 2), ('a', 9), ('b', 1.5)])
+        self.assertEqual(aggregates.take(1), {'a': [9, 2.0, 9.0, 5.0, 3], 'b': [1.5, 1.5, 1.5, 1.5, 1]})
+        # next window starts empty
+        self.assertEqual(aggregates.take(1), {})
+        aggregates.add('a', 1)
+        self.assertEqual(aggregates.take(1), {'a': [1, 1.0, 1.0, 1.0, 1]})
+
+    def test_not_numbers(self):
+        aggregates = buffer.Aggregates()
+        aggregates.add_window(1)
+        aggregates.update([('a', 'off'), ('a', None)])
+        # counted, last kept as is, no min/max/mean
+        self.assertEqual(aggregates.take(1), {'a': [None, None, None, None, 2]})
+        aggregates.update([('a', None), ('a', -3), ('a', 'off'), ('a', 5)])
+        self.assertEqual(aggregates.take(1), {'a': [5, -3.0, 5.0, 1.0, 4]})
+
+    def test_windows(self):
+        aggregates = buffer.Aggregates()
+        aggregates.add_window(1)
+        aggregates.add_window(5)
+        aggregates.update([('a', 1), ('a', 3)])
+        self.assertEqual(aggregates.take(1), {'a': [3, 1.0, 3.0, 2.0, 2]})
+        aggregates.add('a', 5)
+        self.assertEqual(aggregates.take(1), {'a': [5, 5.0, 5.0, 5.0, 1]})
+        self.assertEqual(aggregates.take(5), {'a': [5, 1.0, 5.0, 3.0, 3]})
+        aggregates.remove_window(5)
+        self.assertEqual(aggregates.take(5), {})
+        aggregates.remove_window(1)
+        self.assertFalse(aggregates)
+
+    def test_skip_and_samples(self):
+        aggregates = buffer.Aggregates(skip=set(['a']))
+        aggregates.add_window(1)
+        aggregates.update([('a', 100), ('b', 1)])
+        # sampled outputs come in as (timestamp, value) instead
+        aggregates.samples('a').update([(1.0, 2), (2.0, 4)])
+        self.assertEqual(aggregates.take(1), {'a': [4, 2.0, 4.0, 3.0, 2], 'b': [1, 1.0, 1.0, 1.0, 1]})
+
+    def test_without_windows(self):
+        aggregates = buffer.Aggregates()
+        aggregates.update([('a', 1)])
+        self.assertEqual(aggregates.take(1), {})
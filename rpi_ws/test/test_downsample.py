@@ -0,0 +1,121 @@
+"""
+Downsampling of history scans, run with:
+    trial rpi_ws.test
+"""
+from array import array
+import math
+
+from twisted.trial import unittest
+
+from rpi_ws.server import downsample
+
+__author__ = 'kenny'
+
+NAN = float('nan')
+
+
+class DownsampleTestCase(unittest.TestCase):
+    """
+    Every test runs with numpy, if installed, and with the python fallback
+    """
+
+    def run_both(self, check):
+        check()
+        if downsample.numpy is not None:
+            self.patch(downsample, 'numpy', None)
+            check()
+
+    def chunks(self, samples, size=None):
+        """
+        (timestamps, values) chunks of samples like HistoryStore.scan yields them
+        """
+        size = size or max(1, len(samples))
+        ret = []
+        for i in range(0, len(samples), size):
+            timestamps = [timestamp for timestamp, value in samples[i:i + size]]
+            values = [value for timestamp, value in samples[i:i + size]]
+            if downsample.numpy is not None:
+                ret.append((downsample.numpy.array(timestamps), downsample.numpy.array(values)))
+            else:
+                ret.append((array('d', timestamps), array('d', values)))
+        return ret
+
+    def sine(self, count):
+        return [(float(i), math.sin(i / 10.0)) for i in range(count)]
+
+    def test_lttb_first_last(self):
+        samples = self.sine(1000)
+
+        def check():
+            points = list(downsample.lttb(self.chunks(samples), 0, 1000, 50))
+            self.assertTrue(len(points) <= 52)
+            self.assertEqual(points[0], samples[0])
+            self.assertEqual(points[-1], samples[-1])
+            timestamps = [timestamp for timestamp, value in points]
+            self.assertEqual(timestamps, sorted(set(timestamps)))
+            # every point is a sample
+            for point in points:
+                self.assertEqual(samples[int(point[0])], point)
+        self.run_both(check)
+
+    def test_lttb_spike(self):
+        samples = [(float(i), 0.0) for i in range(100)]
+        samples[57] = (57.0, 100.0)
+
+        def check():
+            points = list(downsample.lttb(self.chunks(samples, 7), 0, 100, 10))
+            self.assertIn((57.0, 100.0), points)
+        self.run_both(check)
+
+    def test_lttb_nan(self):
+        samples = self.sine(100)
+        samples[0] = (0.0, NAN)
+        samples[50] = (50.0, NAN)
+        samples[-1] = (99.0, NAN)
+
+        def check():
+            points = list(downsample.lttb(self.chunks(samples), 0, 100, 10))
+            # first and last numbers
+            self.assertEqual(points[0], samples[1])
+            self.assertEqual(points[-1], samples[-2])
+            self.assertNotIn(50.0, [timestamp for timestamp, value in points])
+            self.assertFalse([value for timestamp, value in points if value != value])
+        self.run_both(check)
+
+    def test_lttb_few_samples(self):
+        def check():
+            self.assertEqual(list(downsample.lttb(self.chunks([]), 0, 10, 5)), [])
+            self.assertEqual(list(downsample.lttb(self.chunks([(1.0, NAN)]), 0, 10, 5)), [])
+            self.assertEqual(list(downsample.lttb(self.chunks([(1.0, 2.0)]), 0, 10, 5)), [(1.0, 2.0)])
+            self.assertEqual(list(downsample.lttb(self.chunks([(1.0, 2.0), (1.5, 3.0)]), 0, 10, 5)),
+                             [(1.0, 2.0), (1.5, 3.0)])
+        self.run_both(check)
+
+    def test_min_max(self):
+        samples = [(0.0, 5.0), (1.0, 9.0), (2.0, 1.0), (3.0, 4.0),
+                   (4.0, 2.0), (5.0, 2.0), (6.0, 7.0), (7.0, 3.0)]
+
+        def check():
+            # one bucket per 4 seconds, min and max in time order
+            expected = [(1.0, 9.0), (2.0, 1.0), (4.0, 2.0), (6.0, 7.0)]
+            self.assertEqual(list(downsample.min_max(self.chunks(samples), 0, 8, 2)), expected)
+            # a bucket spread over chunks is reduced as one
+            self.assertEqual(list(downsample.min_max(self.chunks(samples, 3), 0, 8, 2)), expected)
+        self.run_both(check)
+
+    def test_min_max_flat_and_nan(self):
+        samples = [(0.0, 1.0), (1.0, NAN), (2.0, 1.0), (5.0, NAN), (6.0, NAN)]
+
+        def check():
+            # one point for a flat bucket, none for one of NaN only
+            self.assertEqual(list(downsample.min_max(self.chunks(samples), 0, 8, 2)), [(0.0, 1.0)])
+        self.run_both(check)
+
+    def test_out_of_range(self):
+        samples = [(-5.0, 1.0), (3.0, 2.0), (20.0, 3.0)]
+
+        def check():
+            # samples past start or end fall in the first or last bucket
+            self.assertEqual(list(downsample.min_max(self.chunks(samples), 0, 10, 2)),
+                             [(-5.0, 1.0), (3.0, 2.0), (20.0, 3.0)])
+        self.run_both(check)
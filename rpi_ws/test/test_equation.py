@@ -0,0 +1,123 @@
+"""
+Equation whitelist and compilation, run with:
+    trial rpi_ws.test
+"""
+import time
+
+from twisted.trial import unittest
+
+from rpi_ws.server import equation
+
+__author__ = 'kenny'
+
+
+class ValidateTestCase(unittest.TestCase):
+
+    REJECTED = [
+        'x.__class__',
+        '().__class__.__bases__',
+        '__import__("os")',
+        'open("/etc/passwd")',
+        'x[0]',
+        'lambda: 1',
+        '[i for i in (1, 2)]',
+        'abs.__call__(x)',
+        'round(x, ndigits=2)',
+        'y + 1',
+        'x +',
+        '9**9**9',
+        '2**1000',
+        'x**(10**9)',
+        'x<<10**9',
+        '1<<1000',
+        'x**log(-1)',
+    ]
+
+    ACCEPTED = [
+        'x',
+        'x*0.1 + 3',
+        'sqrt(abs(x))',
+        'x**2',
+        'x**(1/3.0)',
+        '10**-3 * x',
+        '2**16 - x',
+        'x << 4',
+        'x >> 100',
+        'x if x > 0 else 0',
+        'max(min(x, 100), 0)',
+        'x  # raw',
+    ]
+
+    def test_rejected(self):
+        for eq in self.REJECTED:
+            self.assertRaises(equation.EquationError, equation.validate, eq)
+            self.assertRaises(equation.EquationError, equation.compile_equation, eq)
+
+    def test_accepted(self):
+        for eq in self.ACCEPTED:
+            equation.validate(eq)
+            self.assertTrue(callable(equation.compile_equation(eq)))
+
+    def test_empty(self):
+        self.assertEqual(equation.compile_equation('')(5), 5)
+        self.assertEqual(equation.compile_equation('  ')(5), 5)
+
+
+class CompileTestCase(unittest.TestCase):
+
+    def test_results(self):
+        cases = [
+            ('x*0.1 + 3', 10, 4.0),
+            ('x**2', 12, 144),
+            ('10**-3 * x', 2000, 2.0),
+            ('x << 4', 3, 48),
+            ('x if x > 0 else 0', -4, 0),
+            ('x  # raw', 7, 7),
+        ]
+        for eq, value, result in cases:
+            self.assertEqual(equation.compile_equation(eq)(value), result)
+
+    def test_oversized_result(self):
+        # exponents that depend on x are bounded when evaluated
+        start = time.time()
+        self.assertEqual(equation.evaluate(equation.compile_equation('x**x'), 10 ** 6), 10 ** 6)
+        self.assertEqual(equation.evaluate(equation.compile_equation('1 << x'), 10 ** 9), 10 ** 9)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(equation.compile_equation('x**x')(10), 10 ** 10)
+
+    def test_no_builtins(self):
+        func = equation.compile_equation('x')
+        self.assertEqual(func.func_globals['__builtins__'], {})
+
+
+class BatchTestCase(unittest.TestCase):
+
+    EQUATIONS = ['', 'x**5', 'x*10**12', 'x << 40', 'x/3', '-x % 7', 'sqrt(abs(x))', 'x**x', '1/x']
+
+    def setUp(self):
+        if equation.numpy is None:
+            raise unittest.SkipTest('numpy is not installed')
+
+    def assertMatchesScalar(self, values):
+        batch = equation.EquationBatch(min_vector_size=1)
+        targets = {}
+        for eq in self.EQUATIONS:
+            targets[eq] = {}
+            batch.add(eq, values, targets[eq], range(len(values)))
+        batch.evaluate()
+
+        for eq in self.EQUATIONS:
+            func = equation.compile_equation(eq)
+            expected = [equation.evaluate(func, value) for value in values]
+            results = [targets[eq][i] for i in range(len(values))]
+            self.assertEqual(results, expected, eq)
+            self.assertEqual(map(type, results), map(type, expected), eq)
+
+    def test_large_ints(self):
+        self.assertMatchesScalar([0, 3, 1023, 2 ** 31, 2 ** 40, -(10 ** 9), 10 ** 6])
+
+    def test_bools(self):
+        self.assertMatchesScalar([True, False, True])
+
+    def test_floats(self):
+        self.assertMatchesScalar([0.0, 1.5, -2.25, 1e6])
@@ -0,0 +1,161 @@
+"""
+Credit based flow control of DATA frames, run with:
+    trial rpi_ws.test
+"""
+from twisted.trial import unittest
+
+from rpi_ws import flow, settings
+
+__author__ = 'kenny'
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FlowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(settings, 'FLOW_INITIAL_WINDOW', 10)
+        self.patch(settings, 'FLOW_MIN_WINDOW', 4)
+        self.patch(settings, 'FLOW_MAX_WINDOW', 128)
+        # times are binary fractions, exact in floats
+        self.patch(settings, 'FLOW_ACK_DELAY', 0.0625)
+        self.clock = Clock()
+
+
+class WindowTestCase(FlowTestCase):
+
+    def test_window_for(self):
+        self.assertEqual(flow.window_for(0, 0.1), 10)
+        self.assertEqual(flow.window_for(100, None), 10)
+        # 2 * ceil(100 * (0.1875 + 0.0625))
+        self.assertEqual(flow.window_for(100, 0.1875), 50)
+        self.assertEqual(flow.window_for(1, 0.01), 4)
+        self.assertEqual(flow.window_for(10000, 1), 128)
+
+
+class FlowSenderTestCase(FlowTestCase):
+
+    def test_credit(self):
+        sender = flow.FlowSender(self.clock)
+        for i in range(10):
+            self.assertTrue(sender.can_send())
+            sender.sent()
+        # out of credit until acked
+        self.assertFalse(sender.can_send())
+        self.clock.now += 0.25
+        sender.acked(4, window=12)
+        self.assertEqual(sender.in_flight, 6)
+        self.assertEqual(sender.window, 12)
+        self.assertEqual(sender.rtt, 0.25)
+        for i in range(6):
+            self.assertTrue(sender.can_send())
+            sender.sent()
+        self.assertFalse(sender.can_send())
+        self.assertEqual(sender.stats()['sent'], 16)
+
+    def test_shrunk_window(self):
+        sender = flow.FlowSender(self.clock)
+        for i in range(8):
+            sender.sent()
+        sender.acked(2, window=4)
+        # 6 in flight, nothing more until below 4
+        self.assertFalse(sender.can_send())
+        sender.acked(2)
+        self.assertFalse(sender.can_send())
+        sender.acked(1)
+        self.assertTrue(sender.can_send())
+
+    def test_over_acked(self):
+        sender = flow.FlowSender(self.clock)
+        sender.sent()
+        sender.acked(5)
+        self.assertEqual(sender.in_flight, 0)
+        self.assertEqual(len(sender.send_times), 0)
+
+    def test_echo(self):
+        sender = flow.FlowSender(self.clock)
+        self.assertEqual(sender.take_echo(), None)
+        sender.acked(0, ts=500.0)
+        self.clock.now += 0.25
+        # held here for 0.25s, echoed once
+        self.assertEqual(sender.take_echo(), 500.25)
+        self.assertEqual(sender.take_echo(), None)
+
+    def test_reset(self):
+        sender = flow.FlowSender(self.clock)
+        for i in range(10):
+            sender.sent()
+        sender.acked(0, window=20, ts=1.0)
+        sender.reset()
+        self.assertEqual(sender.in_flight, 0)
+        self.assertEqual(sender.take_echo(), None)
+        # the grant outlives a reconnect of the same sender
+        self.assertEqual(sender.window, 20)
+
+
+class FlowReceiverTestCase(FlowTestCase):
+
+    def test_ack_at_half_window(self):
+        receiver = flow.FlowReceiver(self.clock)
+        for i in range(4):
+            receiver.received()
+            self.assertFalse(receiver.should_ack())
+        receiver.received()
+        self.assertTrue(receiver.should_ack())
+        ack = receiver.grant()
+        self.assertEqual(ack['ack_count'], 5)
+        self.assertEqual(ack['ts'], self.clock.now)
+        self.assertEqual(receiver.unacked, 0)
+
+    def test_grant(self):
+        receiver = flow.FlowReceiver(self.clock)
+        for i in range(20):
+            self.clock.now += 0.0078125
+            receiver.received(echo=self.clock.now - 0.125)
+        self.assertEqual(receiver.rtt, 0.125)
+        # twice the 128 frames/s coming in, 2 * ceil(256 * 0.1875)
+        self.assertEqual(receiver.grant()['window'], 96)
+
+    def test_grant_processing(self):
+        receiver = flow.FlowReceiver(self.clock)
+        for i in range(20):
+            self.clock.now += 0.0078125
+            receiver.received(echo=self.clock.now - 0.125)
+            receiver.processed(0.015625)
+        # no faster than the 64 frames/s handled, 2 * ceil(64 * 0.1875)
+        self.assertEqual(receiver.grant()['window'], 24)
+
+    def test_echo_from_the_future(self):
+        receiver = flow.FlowReceiver(self.clock)
+        receiver.received(echo=self.clock.now + 5)
+        self.assertEqual(receiver.rtt, 0.0)
+
+
+class RoundTripTestCase(FlowTestCase):
+
+    def test_never_past_credit(self):
+        """
+        Sender and receiver acking each other, frames in flight stay within the last grant
+        """
+        sender = flow.FlowSender(self.clock)
+        receiver = flow.FlowReceiver(self.clock)
+        delivered = 0
+        for step in range(1000):
+            self.clock.now += 0.005
+            while sender.can_send():
+                sender.sent()
+                receiver.received(sender.take_echo())
+                self.assertTrue(sender.in_flight <= sender.window)
+            if receiver.should_ack():
+                ack = receiver.grant()
+                delivered += ack['ack_count']
+                sender.acked(ack['ack_count'], ack['window'], ack['ts'])
+        self.assertEqual(delivered + receiver.unacked, sender.frames_sent)
+        self.assertEqual(sender.in_flight, receiver.unacked)
+        self.assertTrue(settings.FLOW_MIN_WINDOW <= sender.window <= settings.FLOW_MAX_WINDOW)
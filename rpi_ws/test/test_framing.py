@@ -0,0 +1,105 @@
+"""
+Binary DATA frames, run with:
+    trial rpi_ws.test
+"""
+import struct
+
+from twisted.trial import unittest
+
+from rpi_ws import framing
+
+__author__ = 'kenny'
+
+B = framing.IO_TYPE_BINARY
+I = framing.IO_TYPE_INTEGER
+
+
+def make_codec(reads, writes):
+    """
+    reads/writes are {key: io type}
+    """
+    return framing.DataFrameCodec.from_config(reads, writes, lambda key, io_type: io_type)
+
+
+class DataFrameCodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = make_codec({'gpio 17': B, 'adc 1': I, 'adc 2': I, 'mod 1': B},
+                                {'relay 1': B, 'pwm 1': I})
+
+    def round_trip(self, reads, writes, echo=None):
+        frame = self.codec.encode(reads, writes, echo)
+        self.assertNotEqual(frame, None)
+        return self.codec.decode(frame)
+
+    def test_table(self):
+        # reads then writes, each sorted
+        self.assertEqual([key for is_write, key, io_type in self.codec.channels],
+                         ['adc 1', 'adc 2', 'gpio 17', 'mod 1', 'pwm 1', 'relay 1'])
+
+    def test_round_trip(self):
+        reads = {'gpio 17': True, 'adc 1': -(2 ** 62), 'adc 2': 0.1, 'mod 1': u'1'}
+        writes = {'relay 1': None, 'pwm 1': 2 ** 40}
+        self.assertEqual(self.round_trip(reads, writes, echo=1234.5), (reads, writes, 1234.5))
+
+    def test_binary_values(self):
+        for value in framing.BINARY_VALUES:
+            reads, writes, echo = self.round_trip({'gpio 17': value}, {})
+            self.assertEqual(reads, {'gpio 17': value})
+            # False and 0 are told apart
+            self.assertIs(type(reads['gpio 17']), type(value))
+        # MOD-IO characters come back as unicode
+        self.assertEqual(self.round_trip({'mod 1': '0'}, {})[0], {'mod 1': u'0'})
+
+    def test_partial_and_empty(self):
+        self.assertEqual(self.round_trip({'adc 2': 7}, {}), ({'adc 2': 7}, {}, None))
+        self.assertEqual(self.round_trip({}, {}), ({}, {}, None))
+
+    def test_none_and_nan(self):
+        reads, writes, echo = self.round_trip({'adc 1': None, 'adc 2': float('nan')}, {})
+        self.assertEqual(reads, {'adc 1': None, 'adc 2': None})
+
+    def test_no_binary_form(self):
+        # unknown key, binary value outside the table, integer past 64 bits, not a number
+        self.assertEqual(self.codec.encode({'adc 9': 1}, {}), None)
+        self.assertEqual(self.codec.encode({'gpio 17': 2}, {}), None)
+        self.assertEqual(self.codec.encode({}, {'pwm 1': 2 ** 70}), None)
+        self.assertEqual(self.codec.encode({'adc 1': 'high'}, {}), None)
+        # reads and writes don't share keys
+        self.assertEqual(self.codec.encode({'pwm 1': 1}, {}), None)
+
+    def test_bitmap_sizes(self):
+        for count in (1, 7, 8, 9, 16, 17):
+            codec = make_codec(dict(('adc %02d' % i, I) for i in range(count)), {})
+            reads = dict(('adc %02d' % i, i) for i in range(count))
+            self.assertEqual(codec.decode(codec.encode(reads, {})), (reads, {}, None))
+
+    def test_padding_bits(self):
+        # 6 channels, bit 6 of the one bitmap byte is padding
+        frame = bytearray(self.codec.encode({'adc 1': 1}, {}))
+        frame[4] |= 1 << 6
+        self.assertRaises(framing.FrameFormatError, self.codec.decode, str(frame))
+
+    def test_bad_frames(self):
+        frame = self.codec.encode({'adc 1': 1, 'gpio 17': True}, {}, echo=1.0)
+        # short header, truncated values
+        self.assertRaises(framing.FrameFormatError, self.codec.decode, frame[:3])
+        self.assertRaises(framing.FrameFormatError, self.codec.decode, frame[:-1])
+        # other version, other table
+        self.assertRaises(framing.FrameFormatError, self.codec.decode,
+                          struct.pack('<B', framing.FRAME_VERSION + 1) + frame[1:])
+        self.assertRaises(framing.FrameFormatError, make_codec({'adc 1': I}, {}).decode, frame)
+
+    def test_unknown_binary_code(self):
+        frame = bytearray(self.codec.encode({'gpio 17': True}, {}))
+        frame[-1] = len(framing.BINARY_VALUES)
+        self.assertRaises(framing.FrameFormatError, self.codec.decode, str(frame))
+
+
+class ChooseFramingTestCase(unittest.TestCase):
+
+    def test_choose(self):
+        self.assertEqual(framing.choose_framing(None), framing.FRAMING_JSON)
+        self.assertEqual(framing.choose_framing([]), framing.FRAMING_JSON)
+        self.assertEqual(framing.choose_framing(['json', 'binary']), framing.FRAMING_BINARY)
+        self.assertEqual(framing.choose_framing(['json', 'msgpack']), framing.FRAMING_JSON)
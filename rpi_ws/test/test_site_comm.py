@@ -0,0 +1,163 @@
+"""
+SiteNotifier against a local HTTP fixture standing in for the site server, run with:
+    trial rpi_ws.test
+"""
+import json
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from rpi_ws import settings
+from rpi_ws.server import site_comm
+
+__author__ = 'kenny'
+
+
+class SiteFixture(resource.Resource):
+    """
+    Records every POST, answers with the queued status codes then 200
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        # (path, content type, decoded json)
+        self.requests = []
+        self.codes = []
+        self.hang = False
+
+    def render_POST(self, request):
+        self.requests.append((request.path, request.getHeader('content-type'),
+                              json.loads(request.args['json'][0])))
+        if self.hang:
+            return server.NOT_DONE_YET
+        if self.codes:
+            request.setResponseCode(self.codes.pop(0))
+            return 'error'
+        return 'ok'
+
+
+class SiteNotifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.site = SiteFixture()
+        self.port = reactor.listenTCP(0, server.Site(self.site), interface='127.0.0.1')
+        self.patch(settings, 'SITE_NOTIFY_DELAY', 0.01)
+        self.patch(settings, 'SITE_NOTIFY_RETRY_DELAY', 0.01)
+        self.patch(settings, 'SITE_NOTIFY_TIMEOUT', 5)
+        self.notifier = site_comm.SiteNotifier('127.0.0.1:%d' % self.port.getHost().port)
+        # (callback name, rpi) in the order they were called
+        self.calls = []
+
+    def tearDown(self):
+        d = self.notifier.close()
+        d.addCallback(lambda ignored: self.port.stopListening())
+        return d
+
+    def notify(self, kind, mac, name, **payload):
+        """
+        Returns a Deferred fired once the callback of the event was called
+        """
+        called = defer.Deferred()
+
+        def callback(rpi):
+            self.calls.append((name, rpi))
+            called.callback(rpi)
+
+        payload['mac'] = mac
+        self.notifier.notify(kind, payload, callback, name)
+        return called
+
+    def test_bulk_body(self):
+        self.patch(settings, 'SITE_NOTIFY_BULK', 100)
+        d = defer.gatherResults([self.notify('register', 'a', 'a', ip='1.2.3.4'),
+                                 self.notify('register', 'b', 'b', ip='1.2.3.5')])
+
+        def check(ignored):
+            self.assertEqual(self.site.requests,
+                             [('/ws_comm/register/', 'application/x-www-form-urlencoded',
+                               [{'mac': 'a', 'ip': '1.2.3.4'}, {'mac': 'b', 'ip': '1.2.3.5'}])])
+            self.assertEqual(self.notifier.stats()['requests'], 1)
+        return d.addCallback(check)
+
+    def test_one_event_per_request(self):
+        d = defer.gatherResults([self.notify('register', 'a', 'a', ip='1.2.3.4'),
+                                 self.notify('register', 'b', 'b', ip='1.2.3.5')])
+
+        def check(ignored):
+            # by default the site server never gets a list
+            self.assertEqual(sorted(body for path, content_type, body in self.site.requests),
+                             [{'mac': 'a', 'ip': '1.2.3.4'}, {'mac': 'b', 'ip': '1.2.3.5'}])
+            self.assertEqual(self.notifier.stats()['requests'], 2)
+        return d.addCallback(check)
+
+    def test_single_body(self):
+        d = self.notify('disconnect', 'a', 'a')
+
+        def check(ignored):
+            # one event is sent as is, not as a list
+            self.assertEqual(self.site.requests, [('/ws_comm/disconnect/', 'application/x-www-form-urlencoded',
+                                                   {'mac': 'a'})])
+        return d.addCallback(check)
+
+    def test_coalesced_same_kind(self):
+        d = defer.gatherResults([self.notify('register', 'a', 'first', ip='1.2.3.4'),
+                                 self.notify('register', 'a', 'second', ip='1.2.3.5')])
+
+        def check(ignored):
+            # the site gets the latest, both callbacks are called
+            self.assertEqual([body for path, content_type, body in self.site.requests],
+                             [{'mac': 'a', 'ip': '1.2.3.5'}])
+            self.assertEqual(self.calls, [('first', 'first'), ('second', 'second')])
+            self.assertEqual(self.notifier.stats()['coalesced'], 1)
+        return d.addCallback(check)
+
+    def test_disconnect_then_register_in_order(self):
+        d = defer.gatherResults([self.notify('disconnect', 'a', 'old'),
+                                 self.notify('register', 'a', 'new', ip='1.2.3.4'),
+                                 self.notify('register', 'b', 'b', ip='1.2.3.5')])
+
+        def check(ignored):
+            # b goes along, a's register waits for its disconnect
+            requests_a = [(path, body) for path, content_type, body in self.site.requests if body['mac'] == 'a']
+            self.assertEqual(requests_a, [('/ws_comm/disconnect/', {'mac': 'a'}),
+                                          ('/ws_comm/register/', {'mac': 'a', 'ip': '1.2.3.4'})])
+            self.assertEqual(len(self.site.requests), 3)
+            self.assertTrue(self.calls.index(('old', 'old')) < self.calls.index(('new', 'new')))
+        return d.addCallback(check)
+
+    def test_failure_retried(self):
+        self.site.codes = [500]
+        d = self.notify('register', 'a', 'a')
+
+        def check(ignored):
+            self.assertEqual(len(self.site.requests), 2)
+            self.assertEqual(self.calls, [('a', 'a')])
+            stats = self.notifier.stats()
+            self.assertEqual((stats['failures'], stats['retries'], stats['given_up']), (1, 1, 0))
+        return d.addCallback(check)
+
+    def test_failure_given_up(self):
+        self.patch(settings, 'SITE_NOTIFY_RETRIES', 1)
+        self.site.codes = [500, 503]
+        d = self.notify('register', 'a', 'a')
+
+        def check(ignored):
+            # users are still told, the RPI did connect
+            self.assertEqual(len(self.site.requests), 2)
+            self.assertEqual(self.calls, [('a', 'a')])
+            stats = self.notifier.stats()
+            self.assertEqual((stats['failures'], stats['retries'], stats['given_up']), (2, 1, 1))
+        return d.addCallback(check)
+
+    def test_timeout(self):
+        self.patch(settings, 'SITE_NOTIFY_TIMEOUT', 0.1)
+        self.patch(settings, 'SITE_NOTIFY_RETRIES', 0)
+        self.site.hang = True
+        d = self.notify('disconnect', 'a', 'a')
+
+        def check(ignored):
+            self.assertEqual(self.calls, [('a', 'a')])
+            self.assertEqual(self.notifier.stats()['given_up'], 1)
+        return d.addCallback(check)
@@ -0,0 +1,140 @@
+"""
+On-disk history store and its segment codecs, run with:
+    trial rpi_ws.test
+"""
+import os
+import random
+import struct
+
+from twisted.trial import unittest
+
+from rpi_ws.server import store
+
+__author__ = 'kenny'
+
+MAC = '00:11:22:33:44:55'
+
+
+class CodecTestCase(unittest.TestCase):
+    """
+    Every test runs with numpy, if installed, and with the python fallback
+    """
+
+    def run_both(self, check):
+        check()
+        if store.numpy is not None:
+            self.patch(store, 'numpy', None)
+            check()
+
+    def round_trip(self, timestamps, values):
+        count = len(timestamps)
+        decoded_timestamps = store.decode_timestamps(store.encode_timestamps(timestamps), count)
+        decoded_values = store.decode_values(store.encode_values(values), count)
+        return list(decoded_timestamps), list(decoded_values)
+
+    def test_round_trip(self):
+        rnd = random.Random(1)
+        timestamps = [1.4e9 + i * 0.01 + rnd.random() * 0.001 for i in range(1000)]
+        values = [rnd.choice([0.0, 1.0, -1.5, rnd.random() * 1e6]) for i in range(1000)]
+
+        def check():
+            decoded_timestamps, decoded_values = self.round_trip(timestamps, values)
+            # microseconds
+            for timestamp, decoded in zip(timestamps, decoded_timestamps):
+                self.assertAlmostEqual(timestamp, decoded, places=5)
+            self.assertEqual(decoded_values, values)
+        self.run_both(check)
+
+    def test_special_values(self):
+        nan = float('nan')
+        values = [nan, float('inf'), -float('inf'), -0.0, 1e-300, 1e300, nan]
+
+        def check():
+            decoded_timestamps, decoded_values = self.round_trip([1.0] * len(values), values)
+            # bit exact, NaN and -0.0 included
+            self.assertEqual(struct.pack('<7d', *decoded_values), struct.pack('<7d', *values))
+            self.assertEqual(decoded_timestamps, [1.0] * len(values))
+        self.run_both(check)
+
+    def test_irregular_timestamps(self):
+        timestamps = [0.0, 1e-6, 1e-6, 5.0, 5.000001, 1.4e9, 1.4e9 + 3600]
+
+        def check():
+            decoded_timestamps, decoded_values = self.round_trip(timestamps, [0.0] * len(timestamps))
+            self.assertEqual(decoded_timestamps, timestamps)
+        self.run_both(check)
+
+    def test_empty(self):
+        self.run_both(lambda: self.assertEqual(self.round_trip([], []), ([], [])))
+
+    def test_numpy_matches_fallback(self):
+        if store.numpy is None:
+            raise unittest.SkipTest('numpy is not installed')
+        timestamps = [1.4e9 + i * 0.5 for i in range(100)]
+        values = [i * 0.25 for i in range(100)]
+        encoded = store.encode_timestamps(timestamps), store.encode_values(values)
+        self.patch(store, 'numpy', None)
+        self.assertEqual((store.encode_timestamps(timestamps), store.encode_values(values)), encoded)
+
+
+class HistoryStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = self.mktemp()
+        self.store = self.make_store()
+
+    def make_store(self):
+        history_store = store.HistoryStore(self.root, segment_samples=10, max_open=2)
+        # written by the test instead of the worker thread
+        history_store.start = lambda: None
+        return history_store
+
+    def tearDown(self):
+        self.store.close()
+
+    def write(self, channel, samples):
+        self.store.append(MAC, channel, samples)
+        self.store.write(self.store.take_pending())
+
+    def test_range_across_segments(self):
+        samples = [(float(i), i * 2.0) for i in range(35)]
+        self.write(u'cls:ADC, port:0, eq:', samples)
+        timestamps, values = self.store.range(MAC, u'cls:ADC, port:0, eq:')
+        self.assertEqual(zip(timestamps, values), samples)
+        timestamps, values = self.store.range(MAC, u'cls:ADC, port:0, eq:', 8, 12)
+        self.assertEqual(list(timestamps), [8.0, 9.0, 10.0, 11.0, 12.0])
+
+    def test_long_equation(self):
+        # longer than any file name can be
+        channel = u'cls:ADC, port:0, eq:' + u'+x' * 500
+        self.write(channel, [(1.0, 2.0)])
+        self.assertEqual(self.store.channels(MAC), [channel])
+        self.assertEqual(list(self.store.range(MAC, channel)[1]), [2.0])
+
+    def test_edited_equation(self):
+        self.write(u'cls:ADC, port:0, eq:x', [(1.0, 1.0)])
+        self.write(u'cls:ADC, port:0, eq:x*2', [(2.0, 4.0)])
+        self.assertEqual(sorted(self.store.channels(MAC)), [u'cls:ADC, port:0, eq:x', u'cls:ADC, port:0, eq:x*2'])
+        self.assertEqual(list(self.store.range(MAC, u'cls:ADC, port:0, eq:x')[1]), [1.0])
+
+    def test_out_of_order(self):
+        channel = u'cls:ADC, port:0, eq:'
+        self.write(channel, [(float(i), float(i)) for i in range(10, 25)])
+        self.write(channel, [(5.0, 100.0), (30.0, 101.0), (29.0, 102.0)])
+        timestamps, values = self.store.range(MAC, channel)
+        self.assertEqual(list(timestamps[-4:]), [24.0, 24.0, 30.0, 30.0])
+        self.assertEqual(list(values[-3:]), [100.0, 101.0, 102.0])
+        self.assertEqual(list(self.store.range(MAC, channel, 24, 24)[1]), [24.0, 100.0])
+
+    def test_reopen(self):
+        channel = u'cls:ADC, port:0, eq:'
+        self.write(channel, [(float(i), float(i)) for i in range(15)])
+        self.store.close()
+        self.store = self.make_store()
+        # read from the files, then appended to after the last sample on disk
+        self.assertEqual(len(self.store.range(MAC, channel)[0]), 15)
+        self.write(channel, [(3.0, 99.0)])
+        timestamps, values = self.store.range(MAC, channel)
+        self.assertEqual((timestamps[-1], values[-1]), (14.0, 99.0))
+        self.assertEqual(os.listdir(os.path.dirname(self.store.channel_path(MAC, channel))),
+                         [os.path.basename(self.store.channel_path(MAC, channel))])
@@ -5,6 +5,7 @@ from twisted.internet import reactor, ssl
 import twisted.internet.protocol as twistedsockets
 from twisted.python import log
 from rpi_ws.server.site_comm import SiteComm
+from rpi_ws.server.store import HistoryStore
 from rpi_ws.server_protocol import RPIServerProtocol, RPISocketServerFactory
 from twisted.web import server
 
@@ -33,8 +34,15 @@ def main():
     factory = RPISocketServerFactory(server_url, debug=DEBUG, debugCodePaths=DEBUG)
     factory.protocol = RPIServerProtocol
 
+    if settings.STORE_PATH:
+        factory.store = HistoryStore(settings.STORE_PATH)
+        # what is queued goes to disk
+        reactor.addSystemEventTrigger('before', 'shutdown', factory.store.close)
+
     sitecomm = SiteComm(factory)
     factory.sitecomm = sitecomm
+    reactor.addSystemEventTrigger('before', 'shutdown', sitecomm.notifier.close)
+    factory.reactor_lag.start()
     site = server.Site(sitecomm)
 
     if settings.WS_USE_SSL: